@@ -21,6 +21,19 @@ __license__ = 'Copyright 2010 Splunk, Inc.'
 
 import os
 import sys
+import json
+import zlib
+import base64
+import signal
+import errno
+import fcntl
+import hashlib
+import random
+import ntpath
+import posixpath
+import threading
+import weakref
+import types
 import logging
 import datetime
 
@@ -28,6 +41,1680 @@ from time import *
 from glob import glob
 from logging.handlers import *
 from subprocess import Popen, PIPE
+from tempfile import mkstemp
+from random import getrandbits
+from select import select
+from cStringIO import StringIO
+from contextlib import contextmanager
+from Queue import Queue, Full
+# logging.handlers exports the time module, so be explicit about which time we mean
+from time import time as now
+from functools import wraps
+
+
+class CommandTimeout(object):
+    """What a command returns, instead of an exit code, when it ran out of time.
+    
+    Attributes
+    ==========
+        timeout: (int) The timeout the command was given.
+        duration: (float) Seconds the command ran before it was killed.
+    
+    Notes
+    =====
+        A CommandTimeout is never equal to an exit code and is False, so callers checking for
+        'result == 0' keep working. Any output read before the deadline is still in pipes.
+    """
+    
+    def __init__( self, timeout, duration ):
+        self.timeout  = timeout
+        self.duration = duration
+    
+    
+    def __repr__( self ):
+        return "<CommandTimeout timeout=%s duration=%.1f>" % (self.timeout, self.duration)
+    
+    
+    def __nonzero__( self ):
+        return False
+
+
+class QueueLogHandler(logging.Handler):
+    """Hands log records to a background thread, which passes them on to the real handlers.
+    
+    Description
+    ===========
+        Slow handlers (syslog to a remote host, a file on a busy disk) are only ever called
+        from the dispatch thread, so logging never holds up a command. Each record's message
+        is rendered in the calling thread before it is queued, since its arguments may change
+        by the time the dispatch thread gets to it. If the queue is full the record is dropped
+        and counted in dropped, rather than blocking the caller.
+    
+    Usage
+    =====
+    Required: handlers
+        handlers: (list) logging.Handlers to dispatch records to, filtered by their own levels.
+    Optional: size
+        size: (int) Maximum number of records waiting to be dispatched. (default = 10000)
+    
+    Notes
+    =====
+        Use SSHRPC.setup_logging() rather than building one of these yourself.
+    """
+    
+    def __init__( self, handlers, size=10000 ):
+        logging.Handler.__init__( self )
+        self.handlers = handlers
+        self.queue    = Queue( size )
+        self.dropped  = 0
+        self.thread   = threading.Thread( target=self._dispatch )
+        self.thread.setDaemon( True )
+        self.thread.start()
+    
+    
+    def emit( self, record ):
+        try:
+            record.msg  = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException( record.exc_info )
+                record.exc_info = None
+            self.queue.put_nowait( record )
+        except Full:
+            self.dropped += 1
+        except:
+            self.handleError( record )
+    
+    
+    def _dispatch( self ):
+        """PRIVATE - Hand each queued record to every handler that wants it, until close() queues None."""
+        while True:
+            record = self.queue.get()
+            try:
+                if record == None:
+                    return
+                for handler in self.handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle( record )
+            finally:
+                self.queue.task_done()
+    
+    
+    def flush( self ):
+        """Wait for every queued record to be dispatched, then flush the handlers."""
+        if self.thread.isAlive():
+            self.queue.join()
+        for handler in self.handlers:
+            handler.flush()
+    
+    
+    def close( self ):
+        """Dispatch what's queued, stop the dispatch thread and close the handlers."""
+        if self.thread.isAlive():
+            self.queue.put( None )
+            self.thread.join()
+        for handler in self.handlers:
+            handler.close()
+        logging.Handler.close( self )
+
+
+class _NullHandler(logging.Handler):
+    """PRIVATE - Swallows records, so logging stays quiet about 'No handlers' until SSHRPC.setup_logging()."""
+    
+    def emit( self, record ):
+        pass
+
+
+class _Capped(object):
+    """PRIVATE - Renders obj for a log message, no more than SSHRPC.log_payload_limit characters of it.
+    
+    Nothing is rendered unless a handler actually wants the record, so wrapping command output
+    in _Capped costs next to nothing when logging is off. Dicts (like pipes) are capped per value.
+    """
+    
+    def __init__( self, obj ):
+        self.obj = obj
+    
+    
+    def __str__( self ):
+        limit = SSHRPC.log_payload_limit
+        if isinstance( self.obj, dict ):
+            return str( dict( [ ( key, _Capped( value ).cap( limit ) ) for key, value in self.obj.items() ] ) )
+        return str( self.cap( limit ) )
+    
+    
+    def cap( self, limit ):
+        if not isinstance( self.obj, basestring ):
+            return self.obj
+        if limit and len( self.obj ) > limit:
+            return "%s...(%d more)" % (self.obj[:limit], len( self.obj ) - limit)
+        return self.obj
+
+
+class SSHChannel(object):
+    """A single long-lived ssh session that many commands are streamed over.
+
+    Description
+    ===========
+        Instead of forking a new ssh (and doing a new SSH handshake) for every command,
+        SSHChannel starts one 'ssh host exec /bin/sh' and writes each command to its stdin.
+        Every command is followed by a random marker on both stdout and stderr, the stdout
+        marker carries the exit code, so each command gets its own stdout, stderr and exit
+        code back.
+
+    Notes
+    =====
+        1. Commands are run with ${SHELL:-/bin/sh} -c, just like sshd would, and their stdin
+        is /dev/null so they can't eat the commands that follow them.
+        2. If a command times out, or the session dies, the channel is closed and will be
+        restarted by the next call to run(). Closing it only ends our ssh, a command that
+        timed out may carry on running on the remote host.
+        3. Use SSHRPC(transport='channel') instead of using this class directly.
+    """
+
+    def __init__( self, ssh_cmd, logger=None ):
+        self.ssh_cmd = ssh_cmd
+        self.logger  = logger or logging.getLogger( 'SSHRPC' )
+        self.po      = None
+
+
+    def start( self ):
+        """Start the ssh session if it isn't already running.
+
+        Returns: (bool) True if the session is running.
+        """
+        if self.po and self.po.poll() == None:
+            return True
+        self.logger.debug( "ssh_cmd=%s", self.ssh_cmd )
+        try:
+            self.po = Popen( self.ssh_cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE )
+        except OSError as e:
+            raise Exception, "OSError running command '%s':%s" % (self.ssh_cmd,e)
+        return True
+
+
+    def close( self ):
+        """Tear down the ssh session."""
+        if self.po:
+            if self.po.poll() == None:
+                try:
+                    self.po.stdin.close()
+                    self.po.terminate()
+                except:
+                    self.logger.debug( "Non-fatal error closing channel: %s", sys.exc_info() )
+            self.po.wait()
+            self.po = None
+        return True
+
+
+    def run( self, cmd, pipes={}, timeout=0 ):
+        """Run cmd over the channel.
+
+        Usage
+        =====
+        Returns: (int) The exit code of cmd, 255 if the session died (like ssh), a CommandTimeout if timeout was hit.
+        Required: cmd
+            cmd: (str) The command to run on the remote host.
+        Optional: pipes, timeout
+            pipes: (dict) Populated with the stdout and stderr of cmd. If None, output is
+                written to our own stdout and stderr.
+            timeout: (int) Seconds to wait for cmd before giving up and closing the channel.
+        """
+        self.start()
+        marker = 'SSHRPC%016x' % getrandbits( 64 )
+        wrapped = "${SHELL:-/bin/sh} -c '%s' </dev/null; __sshrpc_rc=$?; printf '%%s %%d\\n' %s $__sshrpc_rc; printf '%%s\\n' %s >&2\n" % (
+            cmd.replace( "'", "'\\''" ), marker, marker )
+        try:
+            self.po.stdin.write( wrapped )
+            self.po.stdin.flush()
+        except IOError as e:
+            self.logger.debug( "channel write failed: %s", e )
+            self.close()
+            return 255
+
+        fds = { self.po.stdout.fileno(): [], self.po.stderr.fileno(): [] }
+        stdout_fd, stderr_fd = self.po.stdout.fileno(), self.po.stderr.fileno()
+        # enough of the end of each stream to hold the marker and an exit code
+        keep = len( marker ) + 16
+        tails = { stdout_fd: '', stderr_fd: '' }
+        return_code = None
+        done = {}
+        start_time = now()
+        deadline = timeout > 0 and start_time + timeout or None
+        try:
+            while len( done ) < 2:
+                wait = None
+                if deadline:
+                    wait = deadline - now()
+                    if wait <= 0:
+                        self.logger.debug( "timeout=%s hit, closing channel", timeout )
+                        self.close()
+                        return_code = CommandTimeout( timeout, now() - start_time )
+                        break
+                ready = select( [ fd for fd in fds if not fd in done ], [], [], wait )[0]
+                for fd in ready:
+                    chunk = os.read( fd, 65536 )
+                    if not chunk:
+                        # EOF before our marker, the session is gone
+                        self.logger.debug( "channel closed unexpectedly" )
+                        self.close()
+                        return_code = 255
+                        done = { stdout_fd: True, stderr_fd: True }
+                        break
+                    fds[ fd ].append( chunk )
+                    # the marker can only be in (or straddle into) the newest chunk, don't rescan the rest
+                    tail = tails[ fd ] + chunk
+                    tails[ fd ] = tail[ -keep: ]
+                    if fd == stdout_fd:
+                        idx = tail.find( marker + ' ' )
+                        if idx < 0 or tail.find( '\n', idx ) < 0:
+                            continue
+                    elif tail.find( marker + '\n' ) < 0:
+                        continue
+                    data = ''.join( fds[ fd ] )
+                    if fd == stdout_fd:
+                        idx = data.find( marker + ' ' )
+                        if idx > -1 and data.find( '\n', idx ) > -1:
+                            return_code = int( data[ idx + len( marker ) + 1:data.find( '\n', idx ) ] )
+                            fds[ fd ] = [ data[ :idx ] ]
+                            done[ fd ] = True
+                    else:
+                        idx = data.find( marker + '\n' )
+                        if idx > -1:
+                            fds[ fd ] = [ data[ :idx ] ]
+                            done[ fd ] = True
+        except:
+            # we don't know where the stream is anymore, start over next time
+            self.close()
+            raise
+
+        stdout, stderr = ''.join( fds[ stdout_fd ] ), ''.join( fds[ stderr_fd ] )
+        if pipes == None:
+            sys.stdout.write( stdout )
+            sys.stderr.write( stderr )
+        else:
+            pipes['stdout'], pipes['stderr'] = stdout, stderr
+            self.logger.debug( "pipes=%s", _Capped( pipes ) )
+        return return_code
+
+
+class FSAgent(object):
+    """A small python agent on the remote host that answers batches of filesystem requests.
+    
+    Description
+    ===========
+        SSHRPC's path helpers each start a new remote 'python -c' over a new ssh. FSAgent
+        starts one remote python per session instead, and sends it requests as lines of JSON,
+        each a list of [op, [args]]. The agent answers with a line of JSON, a [ok, value] per
+        request, so any number of operations can share a single round trip (see batch()).
+    
+    Operations
+    ==========
+        exists(path), stat(path), listdir(path), makedirs(path), remove(path), rename(src, dest),
+        abspath(path), join(*paths), read(path, limit), write(path, data)
+        read and write move base64 encoded data, write goes to a temp file that is renamed into place.
+    
+    Notes
+    =====
+        1. Relative paths are relative to our remote home, just like SSHRPC.execute().
+        2. The remote side needs python 2.6 or better (for json), python 3 works too.
+        3. Use SSHRPC(agent=True) instead of using this class directly.
+    """
+    
+    # this runs on the remote side, keep it working on python 2.6 through 3
+    source = """
+import os, sys, json, base64, shutil
+def stat(path):
+    st = os.stat(path)
+    return {'size': st.st_size, 'mtime': st.st_mtime, 'mode': st.st_mode, 'isdir': os.path.isdir(path)}
+def makedirs(path):
+    os.makedirs(path)
+    return True
+def remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+    return True
+def rename(src, dest):
+    os.rename(src, dest)
+    return True
+def read(path, limit=-1):
+    f = open(path, 'rb')
+    try:
+        return base64.b64encode(f.read(limit)).decode('ascii')
+    finally:
+        f.close()
+def write(path, data):
+    tmp = '%s.sshrpc-%d' % (path, os.getpid())
+    f = open(tmp, 'wb')
+    try:
+        f.write(base64.b64decode(data.encode('ascii')))
+    finally:
+        f.close()
+    os.rename(tmp, path)
+    return True
+ops = {'exists': os.path.exists, 'stat': stat, 'listdir': lambda path: sorted(os.listdir(path)),
+       'makedirs': makedirs, 'remove': remove, 'rename': rename, 'abspath': os.path.abspath,
+       'join': os.path.join, 'read': read, 'write': write, 'ping': lambda: True}
+while True:
+    line = sys.stdin.readline()
+    if not line:
+        break
+    replies = []
+    for op, args in json.loads(line):
+        try:
+            replies.append([True, ops[op](*args)])
+        except Exception:
+            replies.append([False, '%s: %s' % (sys.exc_info()[0].__name__, sys.exc_info()[1])])
+    sys.stdout.write(json.dumps(replies) + '\\n')
+    sys.stdout.flush()
+"""
+    
+    def __init__( self, ssh_cmd, logger=None ):
+        self.ssh_cmd = ssh_cmd
+        self.logger  = logger or logging.getLogger( 'SSHRPC' )
+        self.po      = None
+    
+    
+    def start( self ):
+        """Start the remote agent if it isn't already running.
+        
+        Returns: (bool) True if the agent is up and answering.
+        """
+        if self.po and self.po.poll() == None:
+            return True
+        self.logger.debug( "ssh_cmd=%s", self.ssh_cmd )
+        try:
+            self.po = Popen( self.ssh_cmd, stdin=PIPE, stdout=PIPE )
+            # the bootstrap reads the agent itself as the first line of stdin
+            self.po.stdin.write( base64.b64encode( self.source ) + '\n' )
+            return self.batch( [ ( 'ping', () ) ] ) == [ ( True, True ) ]
+        except:
+            self.logger.debug( "agent failed to start: %s", sys.exc_info() )
+            self.close()
+            return False
+    
+    
+    def close( self ):
+        """Stop the remote agent."""
+        if self.po:
+            try:
+                self.po.stdin.close()
+            except:
+                pass
+            if self.po.poll() == None:
+                self.po.terminate()
+            self.po.wait()
+            self.po = None
+        return True
+    
+    
+    def batch( self, requests ):
+        """Send many requests in one round trip.
+        
+        Usage
+        =====
+        Returns: (list) A (ok, value) tuple per request, value is the error text if ok is False.
+        Required: requests
+            requests: (list) (op, args) tuples, e.g. [ ('exists', ['/tmp']), ('listdir', ['/tmp']) ]
+        """
+        if not self.po: raise Exception, "Agent is not running."
+        try:
+            self.po.stdin.write( json.dumps( [ [ op, list( args ) ] for op, args in requests ] ) + '\n' )
+            self.po.stdin.flush()
+            reply = self.po.stdout.readline()
+        except IOError as e:
+            self.close()
+            raise Exception, "Agent went away: %s" % e
+        if not reply:
+            self.close()
+            raise Exception, "Agent went away."
+        return [ ( ok, FactsCache._str( value ) ) for ok, value in json.loads( reply ) ]
+    
+    
+    def call( self, op, *args ):
+        """Send one request.
+        
+        Returns: The value of the operation, raises Exception if it failed on the remote side.
+        """
+        ok, value = self.batch( [ ( op, args ) ] )[0]
+        if not ok: raise Exception, "Agent %s%s failed: %s" % (op,args,value)
+        return value
+
+
+class ExecStream(object):
+    """Output of a remote command, handed out as it arrives instead of all at once.
+    
+    Description
+    ===========
+        Iterating over an ExecStream yields ('stdout', data) and ('stderr', data) tuples, either
+        chunks of up to chunk_size bytes or, with lines=True, whole lines. Output is only read
+        from ssh as fast as it is consumed, so a slow consumer makes the remote command wait
+        (the pipe and the TCP window fill up) instead of filling our memory.
+        Once the iteration is over, return_code holds the exit code of the command.
+    
+    Notes
+    =====
+        1. With lines=True a line longer than max_line is handed out in max_line pieces, so
+        a single huge line can't grow the buffer without bound either.
+        2. Always a new ssh process, even with SSHRPC(transport='channel').
+        3. stdin (str), if given, is fed to the command as it reads it, alongside its output.
+        4. Use SSHRPC.execute_stream() instead of using this class directly.
+    """
+    
+    def __init__( self, ssh_cmd, chunk_size=65536, lines=False, max_line=1048576, logger=None, stdin=None ):
+        self.ssh_cmd     = ssh_cmd
+        self.stdin       = stdin
+        self.chunk_size  = chunk_size
+        self.lines       = lines
+        self.max_line    = max_line
+        self.logger      = logger or logging.getLogger( 'SSHRPC' )
+        self.po          = None
+        self.return_code = None
+    
+    
+    def __iter__( self ):
+        self.logger.debug( "ssh_cmd=%s", self.ssh_cmd )
+        try:
+            self.po = Popen( self.ssh_cmd, stdin=self.stdin != None and PIPE or None, stdout=PIPE, stderr=PIPE )
+        except OSError as e:
+            raise Exception, "OSError running command '%s':%s" % (self.ssh_cmd,e)
+        names = { self.po.stdout.fileno(): 'stdout', self.po.stderr.fileno(): 'stderr' }
+        partial = { 'stdout': '', 'stderr': '' }
+        writing, written = [], 0
+        if self.stdin != None:
+            # written only as fast as the command reads it, so it can't block us while output piles up
+            writing = [ self.po.stdin.fileno() ]
+            fcntl.fcntl( writing[0], fcntl.F_SETFL, fcntl.fcntl( writing[0], fcntl.F_GETFL ) | os.O_NONBLOCK )
+        try:
+            while names:
+                if writing and written >= len( self.stdin ):
+                    self.po.stdin.close()
+                    writing = []
+                readable, writable = select( names.keys(), writing, [] )[:2]
+                if writable:
+                    try:
+                        written += os.write( writing[0], self.stdin[ written:written + self.chunk_size ] )
+                    except OSError as e:
+                        if e.errno != errno.EAGAIN:
+                            # the command went away without reading it all, its output says why
+                            self.po.stdin.close()
+                            writing = []
+                for fd in readable:
+                    name = names[ fd ]
+                    chunk = os.read( fd, self.chunk_size )
+                    if not chunk:
+                        del names[ fd ]
+                        if partial[ name ]:
+                            yield ( name, partial[ name ] )
+                            partial[ name ] = ''
+                        continue
+                    if not self.lines:
+                        yield ( name, chunk )
+                        continue
+                    lines = ( partial[ name ] + chunk ).split( '\n' )
+                    partial[ name ] = lines.pop()
+                    for line in lines:
+                        yield ( name, line + '\n' )
+                    while len( partial[ name ] ) >= self.max_line:
+                        yield ( name, partial[ name ][ :self.max_line ] )
+                        partial[ name ] = partial[ name ][ self.max_line: ]
+            self.return_code = self.po.wait()
+        finally:
+            # the consumer may have stopped early, don't leave ssh behind
+            self.close()
+        self.logger.debug( "return_code=%s", self.return_code )
+    
+    
+    def close( self ):
+        """Stop the command if it is still running."""
+        if self.po and self.po.poll() == None:
+            self.po.terminate()
+            self.po.wait()
+        return True
+
+
+class BatchStep(object):
+    """One queued operation of a Batch, filled in when the Batch is flushed.
+    
+    Attributes
+    ==========
+        return_code: (int) Exit code of the step, None if it was skipped (or hasn't run yet).
+        stdout, stderr: (str) Output of the step.
+        skipped: (bool) True if a step it requires didn't succeed.
+        value: What the step means, e.g. True/False for path_exists(), True if an execute() returned
+            its expected_return.
+    """
+    
+    def __init__( self, index, cmd, requires=(), expected_return=0 ):
+        self.index           = index
+        self.cmd             = cmd
+        self.requires        = requires
+        self.expected_return = expected_return
+        self.return_code     = None
+        self.stdout          = ''
+        self.stderr          = ''
+        self.skipped         = False
+        self.value           = None
+    
+    
+    def __repr__( self ):
+        return "<BatchStep %d cmd=%s return_code=%s skipped=%s>" % (self.index, repr( self.cmd ), self.return_code, self.skipped)
+    
+    
+    def __nonzero__( self ):
+        """True if the step ran and returned 0."""
+        return self.return_code == 0
+
+
+class Batch(object):
+    """Queue up many remote operations and run them all in one round trip.
+    
+    Description
+    ===========
+        Every queued step returns a BatchStep right away. When the batch is flushed (by leaving
+        the with block, or by calling flush()) all steps are sent to the remote host as a single
+        sh script, and each BatchStep gets its own exit code, stdout and stderr back.
+        A step can require other steps, it only runs if every one of them returned 0, otherwise
+        it is skipped.
+    
+    Example & Test
+    ==============
+        >>> my_box = SSHRPC()
+        >>> with my_box.batch() as b:
+        ...     there = b.path_exists( '/tacoburritosalsa' )
+        ...     moved = b.file_move( '/tacoburritosalsa', '/tmp/tacoburritosalsa', requires=there )
+        ...     hi = b.execute( 'echo hi' )
+        >>> there.value, moved.skipped, hi.stdout
+        (False, True, 'hi\\n')
+    """
+    
+    def __init__( self, box ):
+        self.box   = box
+        self.steps = []
+    
+    
+    def __enter__( self ):
+        return self
+    
+    
+    def __exit__( self, exc_type, exc_value, traceback ):
+        # don't run anything if the with block blew up
+        if exc_type == None:
+            self.flush()
+        return False
+    
+    
+    def _add( self, cmd, requires=None, expected_return=0 ):
+        """PRIVATE - Queue cmd as a new BatchStep."""
+        if requires == None:
+            requires = ()
+        elif isinstance( requires, BatchStep ):
+            requires = ( requires, )
+        step = BatchStep( len( self.steps ), cmd, tuple( requires ), expected_return )
+        self.steps.append( step )
+        return step
+    
+    
+    def execute( self, cmd, dir='', env={}, requires=None, expected_return=0 ):
+        """Queue cmd, see SSHRPC.execute(). step.value is True if cmd returned expected_return."""
+        return self._add( self.box._ssh_cmd( cmd, dir=dir, env=env )[1], requires=requires, expected_return=expected_return )
+    
+    
+    def file_copy( self, src, dest, requires=None ):
+        return self._add( "cp %s %s" % (src,dest), requires=requires )
+    
+    
+    def file_move( self, src, dest, requires=None ):
+        return self._add( "mv %s %s" % (src,dest), requires=requires )
+    
+    
+    def path_exists( self, path, requires=None ):
+        """Queue an existence check, step.value is True if path exists. The step 'succeeds' only
+        if path exists, so it can be required by steps that need path.
+        """
+        return self._add( "[ -e %s ]" % path, requires=requires, expected_return=None )
+    
+    
+    def script( self, marker ):
+        """Return the sh script that runs every queued step, framing each step's output with marker."""
+        lines = []
+        for step in self.steps:
+            run = "${SHELL:-/bin/sh} -c '%s' </dev/null; __rc_%d=$?" % (step.cmd.replace( "'", "'\\''" ), step.index)
+            if step.requires:
+                test = ' && '.join( [ '[ "$__rc_%d" = 0 ]' % required.index for required in step.requires ] )
+                run = "if %s; then %s; else __rc_%d=skipped; fi" % (test, run, step.index)
+            lines.append( run )
+            lines.append( "printf '%%s %d %%s\\n' %s $__rc_%d; printf '%%s %d\\n' %s >&2" % (step.index, marker, step.index, step.index, marker) )
+        return '\n'.join( lines )
+    
+    
+    def flush( self ):
+        """Run every queued step in one round trip.
+        
+        Returns: (list) The BatchSteps, in the order they were queued.
+        """
+        if not self.steps:
+            return []
+        cmd, marker = self.command()
+        _std = {}
+        result = self.box._execute( cmd, pipes=_std )
+        return self.parse( marker, result, _std )
+    
+    
+    def command( self ):
+        """Return the remote command that runs every queued step, and the marker framing their output."""
+        marker = 'SSHRPC%016x' % getrandbits( 64 )
+        return ( "sh -c '%s'" % self.script( marker ).replace( "'", "'\\''" ), marker )
+    
+    
+    def parse( self, marker, result, pipes ):
+        """Fill in every queued BatchStep from the output (pipes) of command(), and clear the queue.
+        
+        Returns: (list) The BatchSteps, in the order they were queued.
+        """
+        steps, self.steps = self.steps, []
+        _std = pipes
+        stdout_pos, stderr_pos = 0, 0
+        for step in steps:
+            idx = _std['stdout'].find( '%s %d ' % (marker, step.index), stdout_pos )
+            if idx < 0:
+                raise Exception, "Batch did not complete on %s at step %s. result=%s" % (self.box.host,step,result)
+            end = _std['stdout'].find( '\n', idx )
+            step.stdout = _std['stdout'][ stdout_pos:idx ]
+            status = _std['stdout'][ idx:end ].split()[-1]
+            stdout_pos = end + 1
+            idx = _std['stderr'].find( '%s %d\n' % (marker, step.index), stderr_pos )
+            if idx > -1:
+                step.stderr = _std['stderr'][ stderr_pos:idx ]
+                stderr_pos = _std['stderr'].find( '\n', idx ) + 1
+            if status == 'skipped':
+                step.skipped = True
+            else:
+                step.return_code = int( status )
+                if step.expected_return == None:
+                    step.value = step.return_code == 0
+                else:
+                    step.value = step.return_code == step.expected_return
+        self.box.logger.debug( "steps=%s", steps )
+        return steps
+
+
+class RemoteJob(object):
+    """A command started with SSHRPC.execute_background(), running detached on the remote host.
+    
+    Attributes
+    ==========
+        box: (SSHRPC) The host it runs on.
+        id: (str) Unique name of the job, its spool directory is ~/.sshrpc/jobs/<id>.
+        cmd: (str) The command.
+        pid: (int) Remote process id, the leader of its process group where setsid is available.
+        state: (str) 'running', 'done', 'killed' or 'lost' (gone without an exit code, e.g. the
+            host rebooted), as of the last poll.
+        return_code: (int) Exit code once done, minus the signal once killed, None until then.
+    
+    Notes
+    =====
+        Nothing on our side is tied up while a job runs, no ssh process or file descriptor.
+        The spool (pid, out, err, rc) stays on the host until cleanup(), so a job handle can be
+        rebuilt with RemoteJob( box, id ) by another process, which polls it as 'running'
+        until it learns otherwise.
+    """
+    
+    def __init__( self, box, id, cmd='', pid=None ):
+        self.box         = box
+        self.id          = id
+        self.cmd         = cmd
+        self.pid         = pid
+        self.spool       = '.sshrpc/jobs/%s' % id
+        self.state       = 'running'
+        self.return_code = None
+    
+    
+    def __repr__( self ):
+        return "<RemoteJob host=%s id=%s pid=%s state=%s return_code=%s>" % (self.box.host, self.id, self.pid, self.state, self.return_code)
+    
+    
+    def poll( self ):
+        """Check on the job, see SSHRPC.poll_jobs() to check on many in one round trip.
+        
+        Returns: (str) Its state.
+        """
+        self.box.poll_jobs( [ self ] )
+        return self.state
+    
+    
+    def running( self ):
+        return self.poll() == 'running'
+    
+    
+    def output( self, name='out', offset=0 ):
+        """Return what the job has written to stdout (name='out') or stderr (name='err') so far,
+        from offset on, so a caller can follow it with offset += len( output ).
+        """
+        _std = {}
+        if self.box._execute( "tail -c +%d %s/%s" % (offset + 1, self.spool, name), pipes=_std ) != 0:
+            raise Exception, "Couldn't read the %s of job %s on %s: %s" % (name,self.id,self.box.host,_std.get( 'stderr', '' ).strip())
+        return _std['stdout']
+    
+    
+    def kill( self, sig=signal.SIGTERM ):
+        """Send sig to the job, its whole process group where possible.
+        
+        Returns: (bool) True if it was still there to be signalled.
+        """
+        # the marker goes first, so a poll never sees the exit code the signal caused without it
+        script = ( 'S=%s; pid=`cat $S/pid` && [ ! -f $S/rc ] && echo %d > $S/killed && '
+                   '{ kill -%d -$pid 2>/dev/null || { pkill -%d -P $pid; kill -%d $pid; }; }' ) % (self.spool, sig, sig, sig, sig)
+        return self.box._execute( script, pipes={} ) == 0
+    
+    
+    def wait( self, interval=5, timeout=0 ):
+        """Poll the job every interval seconds until it's no longer running.
+        
+        Returns: (int) Its return_code, None if it was lost, a CommandTimeout if it was still
+            running after timeout seconds (0 for no limit).
+        """
+        start_time = now()
+        while self.poll() == 'running':
+            if timeout and now() - start_time + interval > timeout:
+                return CommandTimeout( timeout, now() - start_time )
+            sleep( interval )
+        return self.return_code
+    
+    
+    def cleanup( self ):
+        """Remove the job's spool from the host, once its output isn't needed anymore."""
+        return self.box._execute( "rm -rf %s" % self.spool, pipes={} ) == 0
+
+
+def _write_atomic( path, data ):
+    """PRIVATE - Replace the file path with data, by way of a temp file next to it that's renamed
+    into place, so nobody reading it ever sees half a file. The last writer wins.
+    """
+    directory = os.path.dirname( path )
+    if not os.path.isdir( directory ):
+        try:
+            os.makedirs( directory )
+        except OSError:
+            # somebody else beat us to it
+            if not os.path.isdir( directory ): raise
+    fd, tmp_file = mkstemp( dir=directory, prefix='.' + os.path.basename( path ) )
+    try:
+        tmp = os.fdopen( fd, 'wb' )
+        try:
+            tmp.write( data )
+        finally:
+            tmp.close()
+        os.rename( tmp_file, path )
+    except:
+        if os.path.exists( tmp_file ): os.remove( tmp_file )
+        raise
+    return True
+
+
+# where the setsid binary is, '' if there isn't one, see _new_session()
+_setsid = None
+
+def _new_session( cmd, shell=False ):
+    """PRIVATE - Return the ( cmd, shell ) to Popen so cmd leads a new session and process group,
+    by running it under the setsid binary. Where there is no setsid cmd is returned as it was.
+    
+    Notes
+    =====
+        Popen's preexec_fn=os.setsid would do the same, but preexec_fn runs between fork and exec,
+        where a threaded Python 2 child can deadlock on a lock another thread held.
+    
+    Test
+    ====
+        >>> cmd, shell = _new_session( 'echo $$ `ps -o pgid= $$`', shell=True )
+        >>> pid, pgid = Popen( cmd, shell=shell, stdout=PIPE ).communicate()[0].split()
+        >>> pid == pgid or not _setsid
+        True
+    """
+    global _setsid
+    if _setsid == None:
+        found = ''
+        for dir in os.environ.get( 'PATH', os.defpath ).split( os.pathsep ):
+            path = os.path.join( dir, 'setsid' )
+            if os.path.isfile( path ) and os.access( path, os.X_OK ):
+                found = path
+                break
+        _setsid = found
+    if not _setsid:
+        return cmd, shell
+    if isinstance( cmd, basestring ):
+        cmd = [ cmd ]
+    if shell:
+        cmd = [ '/bin/sh', '-c' ] + list( cmd )
+    return [ _setsid ] + list( cmd ), False
+
+
+class FactsCache(object):
+    """An on-disk cache of the host facts SSHRPC discovers, keyed by (host, login).
+    
+    Description
+    ===========
+        Home, platform, python platform and distro almost never change between runs, so
+        SSHRPC(facts_cache=FactsCache()) saves them here and skips the probing the next time
+        an SSHRPC is built for the same host and login, until ttl runs out.
+    
+    Notes
+    =====
+        1. Each host gets its own small JSON file under path, written to a temp file and
+        renamed into place, so any number of processes can read and write the cache at once
+        without ever seeing half a file. The last writer wins.
+        2. When a host is reimaged use SSHRPC.refresh_facts(), or FactsCache.invalidate().
+    
+    Test
+    ====
+        >>> import tempfile
+        >>> cache = FactsCache( path=tempfile.mkdtemp(), ttl=60 )
+        >>> cache.put( 'localhost', 'splunk', {'home': '/home/splunk', 'distro': {}} )
+        True
+        >>> cache.get( 'localhost', 'splunk' )
+        {'home': '/home/splunk', 'distro': {}}
+        >>> cache.invalidate( 'localhost', 'splunk' )
+        True
+        >>> cache.get( 'localhost', 'splunk' )
+    """
+    
+    def __init__( self, path='', ttl=86400 ):
+        if not path: path = os.path.join( os.path.expanduser( '~' ), '.sshrpc', 'facts' )
+        self.path = path
+        self.ttl  = ttl
+    
+    
+    def _file( self, host, login ):
+        """PRIVATE - Where the facts for login@host live."""
+        return os.path.join( self.path, ( '%s@%s.json' % (login, host) ).replace( os.sep, '_' ).replace( ':', '_' ) )
+    
+    
+    @staticmethod
+    def _str( value ):
+        """PRIVATE - json gives us back unicode, the rest of SSHRPC deals in str."""
+        if isinstance( value, unicode ):
+            return value.encode( 'utf-8' )
+        if isinstance( value, dict ):
+            return dict( [ ( FactsCache._str( k ), FactsCache._str( v ) ) for k, v in value.items() ] )
+        if isinstance( value, list ):
+            return [ FactsCache._str( v ) for v in value ]
+        return value
+    
+    
+    def get( self, host, login ):
+        """Return the cached facts for login@host, or None if there are none or they're older than ttl."""
+        try:
+            cache_file = open( self._file( host, login ) )
+            try:
+                cached = json.load( cache_file )
+            finally:
+                cache_file.close()
+        except ( IOError, ValueError ):
+            return None
+        if not isinstance( cached, dict ) or now() - cached.get( 'cached_at', 0 ) > self.ttl:
+            return None
+        return self._str( cached.get( 'facts' ) )
+    
+    
+    def put( self, host, login, facts ):
+        """Save facts (dict) for login@host."""
+        return _write_atomic( self._file( host, login ), json.dumps( { 'cached_at': now(), 'facts': facts } ) )
+    
+    
+    def invalidate( self, host, login ):
+        """Forget the facts for login@host."""
+        try:
+            os.remove( self._file( host, login ) )
+        except OSError:
+            pass
+        return True
+
+
+class ManifestCache(object):
+    """An on-disk record of what SSHRPC.manifest_sync() last sent to a remote directory: the
+    size, mtime and md5 of every file, keyed by (host, login, remote directory).
+    
+    Notes
+    =====
+        Manifests are kept as zlibed JSON, one file per remote directory, they get big.
+    
+    Test
+    ====
+        >>> import tempfile
+        >>> cache = ManifestCache( path=tempfile.mkdtemp() )
+        >>> cache.get( 'localhost', 'splunk', 'deploy' )
+        {}
+        >>> cache.put( 'localhost', 'splunk', 'deploy', {'app/a.conf': [5, 1262304000, '5d41402abc4b2a76b9719d911017c592']} )
+        True
+        >>> cache.get( 'localhost', 'splunk', 'deploy' )
+        {'app/a.conf': [5, 1262304000, '5d41402abc4b2a76b9719d911017c592']}
+        >>> cache.invalidate( 'localhost', 'splunk', 'deploy' )
+        True
+        >>> cache.get( 'localhost', 'splunk', 'deploy' )
+        {}
+    """
+    
+    def __init__( self, path='' ):
+        if not path: path = os.path.join( os.path.expanduser( '~' ), '.sshrpc', 'manifests' )
+        self.path = path
+    
+    
+    def _file( self, host, login, remote ):
+        """PRIVATE - Where the manifest of login@host:remote lives."""
+        name = ( '%s@%s' % (login, host) ).replace( os.sep, '_' ).replace( ':', '_' )
+        return os.path.join( self.path, '%s-%s.json.z' % (name, hashlib.sha1( remote or '.' ).hexdigest()[:16]) )
+    
+    
+    def get( self, host, login, remote ):
+        """Return the manifest of login@host:remote, {path: [size, mtime, md5]}, empty if there is none."""
+        try:
+            manifest_file = open( self._file( host, login, remote ), 'rb' )
+            try:
+                manifest = json.loads( zlib.decompress( manifest_file.read() ) )
+            finally:
+                manifest_file.close()
+        except ( IOError, ValueError, zlib.error ):
+            return {}
+        return FactsCache._str( manifest )
+    
+    
+    def put( self, host, login, remote, manifest ):
+        """Save manifest (dict) for login@host:remote."""
+        return _write_atomic( self._file( host, login, remote ), zlib.compress( json.dumps( manifest ) ) )
+    
+    
+    def invalidate( self, host, login, remote ):
+        """Forget the manifest of login@host:remote, so the next manifest_sync() sends everything."""
+        try:
+            os.remove( self._file( host, login, remote ) )
+        except OSError:
+            pass
+        return True
+
+
+class ArtifactCache(object):
+    """A local, content addressed cache of downloaded artifacts (build tarballs and the like).
+    
+    Description
+    ===========
+        Every file fetched is stored under path by its sha1, and every URL remembers the sha1
+        it gave last time with its ETag and Last-Modified. Fetching a URL again asks the server
+        (If-None-Match, If-Modified-Since) and only downloads it if it changed. The files used
+        least recently are removed once the cache grows past max_size bytes.
+    
+    Notes
+    =====
+        1. Any number of processes can share a cache: files and URL entries are written to a
+        temp file and renamed into place, and eviction is done under a lock file (fcntl.flock).
+        2. Files are named by their sha1, so the same artifact from two URLs is stored once.
+        3. See SSHRPC.file_retrieve() and SSHRPC.push_artifact().
+    
+    Test
+    ====
+        >>> import tempfile
+        >>> cache = ArtifactCache( path=tempfile.mkdtemp(), max_size=10 )
+        >>> src = tempfile.mktemp()
+        >>> open( src, 'w' ).write( 'hello' )
+        >>> path, sha1 = cache.fetch( 'file://' + src )
+        >>> sha1, open( path ).read()
+        ('aaf4c61ddcc5e8a2dabede0f3b482cd9aea9434d', 'hello')
+        >>> cache.get( sha1 ) == path
+        True
+        >>> open( src, 'w' ).write( 'hello world' )
+        >>> cache.fetch( 'file://' + src )[1]
+        '2aae6c35c94fcfb415dbe95f408b9ce91ee846ed'
+        >>> cache.get( sha1 )
+    """
+    logger  = logging.getLogger( 'SSHRPC' )
+    _shared = None
+    
+    def __init__( self, path='', max_size=10737418240 ):
+        if not path: path = os.path.join( os.path.expanduser( '~' ), '.sshrpc', 'artifacts' )
+        self.path     = path
+        self.max_size = max_size
+    
+    
+    @classmethod
+    def shared( cls ):
+        """The ArtifactCache SSHRPC.file_retrieve() uses unless it's given one."""
+        if not cls._shared:
+            cls._shared = cls()
+        return cls._shared
+    
+    
+    def _dir( self, name ):
+        """PRIVATE - The subdirectory name of the cache, created if it isn't there yet."""
+        path = os.path.join( self.path, name )
+        if not os.path.isdir( path ):
+            try:
+                os.makedirs( path )
+            except OSError:
+                # somebody else beat us to it
+                if not os.path.isdir( path ): raise
+        return path
+    
+    
+    def _entry_file( self, url ):
+        """PRIVATE - Where what we know about url lives."""
+        return os.path.join( self._dir( 'urls' ), '%s.json' % hashlib.sha1( url ).hexdigest() )
+    
+    
+    def _entry( self, url ):
+        """PRIVATE - What we know about url from the last time we fetched it, None if nothing."""
+        try:
+            entry_file = open( self._entry_file( url ) )
+            try:
+                return json.load( entry_file )
+            finally:
+                entry_file.close()
+        except ( IOError, ValueError ):
+            return None
+    
+    
+    def _request( self, url, entry=None ):
+        """PRIVATE - A request for url, only for a response if it changed since entry (if any)."""
+        import urllib2
+        request = urllib2.Request( url )
+        if entry:
+            if entry.get( 'etag' ): request.add_header( 'If-None-Match', str( entry['etag'] ) )
+            if entry.get( 'last_modified' ): request.add_header( 'If-Modified-Since', str( entry['last_modified'] ) )
+        return request
+    
+    
+    def known_sha1( self, url ):
+        """Return the sha1 url had when we last fetched it, if the server says it hasn't changed
+        since, None if it has or we can't tell. Nothing is downloaded either way.
+        """
+        import urllib2
+        entry = self._entry( url )
+        if not entry or not ( entry.get( 'etag' ) or entry.get( 'last_modified' ) ):
+            return None
+        try:
+            urllib2.urlopen( self._request( url, entry ) ).close()
+        except urllib2.HTTPError as e:
+            if e.code == 304: return str( entry['sha1'] )
+        return None
+    
+    
+    def get( self, sha1 ):
+        """Return the path of the cached file with sha1 (marking it used), or None if it isn't cached."""
+        path = os.path.join( self._dir( 'objects' ), sha1 )
+        try:
+            os.utime( path, None )
+        except OSError:
+            return None
+        return path
+    
+    
+    def put( self, fileobj ):
+        """Add what's read from fileobj to the cache.
+        
+        Returns: (tuple) ( path, sha1 ) of the cached file.
+        """
+        objects = self._dir( 'objects' )
+        fd, tmp_file = mkstemp( dir=objects, prefix='.artifact' )
+        sha1 = hashlib.sha1()
+        try:
+            for chunk in iter( lambda: fileobj.read( 1048576 ), '' ):
+                sha1.update( chunk )
+                os.write( fd, chunk )
+        except:
+            os.close( fd )
+            os.remove( tmp_file )
+            raise
+        os.close( fd )
+        path = os.path.join( objects, sha1.hexdigest() )
+        os.rename( tmp_file, path )
+        self.evict()
+        return ( path, sha1.hexdigest() )
+    
+    
+    def fetch( self, url ):
+        """Return url from the cache, downloading it if it isn't there or it changed.
+        
+        Returns: (tuple) ( path, sha1 ) of the cached file.
+        """
+        import urllib2
+        entry = self._entry( url )
+        try:
+            response = urllib2.urlopen( self._request( url, entry and self.get( str( entry['sha1'] ) ) and entry ) )
+        except urllib2.HTTPError as e:
+            path = entry and self.get( str( entry['sha1'] ) )
+            if e.code == 304 and path:
+                self.logger.debug( "url=%s not modified, sha1=%s", url, entry['sha1'] )
+                return ( path, str( entry['sha1'] ) )
+            raise
+        try:
+            path, sha1 = self.put( response )
+            headers = response.info()
+            entry = { 'url': url, 'sha1': sha1, 'etag': headers.get( 'ETag', '' ), 'last_modified': headers.get( 'Last-Modified', '' ) }
+        finally:
+            response.close()
+        _write_atomic( self._entry_file( url ), json.dumps( entry ) )
+        self.logger.debug( "url=%s downloaded, sha1=%s", url, sha1 )
+        return ( path, sha1 )
+    
+    
+    def evict( self ):
+        """Remove the least recently used files until the cache is no bigger than max_size.
+        The most recently used file is always kept.
+        
+        Returns: (int) Number of files removed.
+        """
+        objects = self._dir( 'objects' )
+        fd = os.open( os.path.join( self.path, 'lock' ), os.O_RDWR | os.O_CREAT, 0600 )
+        fcntl.flock( fd, fcntl.LOCK_EX )
+        try:
+            cached, total = [], 0
+            for name in os.listdir( objects ):
+                try:
+                    st = os.stat( os.path.join( objects, name ) )
+                except OSError:
+                    continue
+                if name.startswith( '.' ):
+                    # a download that died, give it an hour before counting it as dead
+                    if now() - st.st_mtime > 3600: os.remove( os.path.join( objects, name ) )
+                    continue
+                cached.append( ( st.st_mtime, st.st_size, name ) )
+                total += st.st_size
+            cached.sort()
+            removed = 0
+            for mtime, size, name in cached[:-1]:
+                if total <= self.max_size:
+                    break
+                os.remove( os.path.join( objects, name ) )
+                total -= size
+                removed += 1
+            return removed
+        finally:
+            fcntl.flock( fd, fcntl.LOCK_UN )
+            os.close( fd )
+
+
+class MasterPool(object):
+    """Reference counted ssh ControlMasters, shared by every SSHRPC (in any process) on this box.
+    
+    Description
+    ===========
+        SSHRPC(master=True) leases its master from a MasterPool instead of starting its own.
+        Masters are keyed by (host, login, identity), so every SSHRPC talking to the same host
+        as the same user shares one master, whichever process it's in. A master is only shut
+        down once nobody holds a lease on it and it has been idle for idle_timeout seconds,
+        and no more than max_masters are ever open at once. An SSHRPC that can't get a master
+        because of that falls back to master=False.
+    
+    Notes
+    =====
+        1. Everything lives under path: a directory per master holding its control socket, a
+        small JSON file naming its host, and one lease file per holder named after the
+        holder's pid. Leases of processes that died without releasing them are dropped.
+        2. Bookkeeping is serialized with a lock file (fcntl.flock) over the whole pool, starting
+        and checking a master with a lock file of its own, so one slow handshake doesn't hold
+        up the rest.
+        3. Idle masters are reaped whenever a lease is taken or given back, call reap() to do
+        it any other time (e.g. from cron), or reap( force=True ) to close every idle master.
+    
+    Test
+    ====
+        >>> import tempfile
+        >>> pool = MasterPool( path=tempfile.mkdtemp(), max_masters=1, idle_timeout=0 )
+        >>> box, other = SSHRPC( master=True, master_pool=pool ), SSHRPC( master=True, master_pool=pool )
+        >>> pool.count()
+        1
+        >>> box.disconnect()
+        True
+        >>> other.execute( 'true' ), pool.count()
+        (True, 1)
+        >>> SSHRPC( host='127.0.0.1', master=True, master_pool=pool ).master
+        False
+        >>> other.disconnect()
+        True
+        >>> pool.count()
+        0
+    """
+    logger  = logging.getLogger( 'SSHRPC' )
+    _shared = None
+    
+    def __init__( self, path='', max_masters=32, idle_timeout=300 ):
+        if not path: path = os.path.join( os.path.expanduser( '~' ), '.sshrpc', 'masters' )
+        self.path         = path
+        self.max_masters  = max_masters
+        self.idle_timeout = idle_timeout
+    
+    
+    @classmethod
+    def shared( cls ):
+        """The MasterPool SSHRPC(master=True) uses unless it's given one."""
+        if not cls._shared:
+            cls._shared = cls()
+        return cls._shared
+    
+    
+    def _dir( self, host, login, identity ):
+        """PRIVATE - Where the master for login@host with identity lives."""
+        return os.path.join( self.path, hashlib.sha1( '\0'.join( ( host, login, identity ) ) ).hexdigest()[:16] )
+    
+    
+    def _lock( self, path ):
+        """PRIVATE - Take the lock file at path, returns the fd to hand to _unlock()."""
+        if not os.path.isdir( os.path.dirname( path ) ):
+            try:
+                os.makedirs( os.path.dirname( path ) )
+            except OSError:
+                # somebody else beat us to it
+                if not os.path.isdir( os.path.dirname( path ) ): raise
+        fd = os.open( path, os.O_RDWR | os.O_CREAT, 0600 )
+        fcntl.flock( fd, fcntl.LOCK_EX )
+        return fd
+    
+    
+    def _unlock( self, fd ):
+        fcntl.flock( fd, fcntl.LOCK_UN )
+        os.close( fd )
+    
+    
+    def _masters( self ):
+        """PRIVATE - Every master directory in the pool."""
+        return [ d for d in glob( os.path.join( self.path, '*' ) ) if os.path.isdir( d ) ]
+    
+    
+    def _leases( self, master_dir ):
+        """PRIVATE - The live leases on a master, dropping the ones whose process is gone."""
+        leases = []
+        for lease in glob( os.path.join( master_dir, '*.lease' ) ):
+            pid = int( os.path.basename( lease ).split( '-' )[0] )
+            try:
+                os.kill( pid, 0 )
+            except OSError as e:
+                if e.errno == errno.ESRCH:
+                    self._remove( lease )
+                    continue
+            leases.append( lease )
+        return leases
+    
+    
+    def _remove( self, path ):
+        try:
+            os.remove( path )
+        except OSError:
+            pass
+    
+    
+    def _ssh( self, master_dir, ssh_args, args ):
+        """PRIVATE - Run ssh against the master in master_dir. Returns: (int) ssh's exit code."""
+        master_file = open( os.path.join( master_dir, 'master.json' ) )
+        try:
+            master = json.load( master_file )
+        finally:
+            master_file.close()
+        cmd = [ 'ssh' ]
+        cmd.extend( ssh_args or [ '-l', str( master['login'] ) ] )
+        cmd.extend( [ '-S', os.path.join( master_dir, 'sock' ) ] )
+        cmd.extend( args )
+        cmd.append( str( master['host'] ) )
+        devnull = open( os.devnull, 'r+' )
+        try:
+            # ssh -f leaves the master running with our stdio, don't give it pipes we'll wait on
+            return Popen( cmd, stdin=devnull, stdout=devnull, stderr=devnull ).wait()
+        finally:
+            devnull.close()
+    
+    
+    def count( self ):
+        """Returns: (int) Number of masters open (or being opened)."""
+        return len( [ d for d in self._masters() if os.path.exists( os.path.join( d, 'master.json' ) ) ] )
+    
+    
+    def acquire( self, host, login, identity, ssh_args ):
+        """Lease the master for login@host with identity, starting it if it isn't up.
+        
+        Usage
+        =====
+        Returns: (tuple) ( lease, control_path ), pass lease to ensure() and release() and use
+            'ssh -S control_path' to talk through the master. None if the pool is full or the
+            master wouldn't start, carry on without one.
+        Required: host, login, identity, ssh_args
+            ssh_args: (list) ssh arguments to start the master with, see SSHRPC.ssh_args.
+        """
+        master_dir = self._dir( host, login, identity )
+        fd = self._lock( os.path.join( self.path, 'lock' ) )
+        try:
+            if not os.path.exists( os.path.join( master_dir, 'master.json' ) ):
+                if self.count() >= self.max_masters:
+                    self.reap( force=True, locked=True )
+                if self.count() >= self.max_masters:
+                    self.logger.debug( "max_masters=%s reached, no master for %s@%s", self.max_masters, login, host )
+                    return None
+                if not os.path.isdir( master_dir ): os.makedirs( master_dir )
+                master_file = open( os.path.join( master_dir, 'master.json' ), 'w' )
+                try:
+                    json.dump( { 'host': host, 'login': login, 'identity': identity }, master_file )
+                finally:
+                    master_file.close()
+            lease = os.path.join( master_dir, '%d-%016x.lease' % (os.getpid(), getrandbits( 64 )) )
+            open( lease, 'w' ).close()
+            self._remove( os.path.join( master_dir, 'idle' ) )
+        finally:
+            self._unlock( fd )
+        if not self.ensure( lease, ssh_args ):
+            self.release( lease )
+            return None
+        return ( lease, os.path.join( master_dir, 'sock' ) )
+    
+    
+    def ensure( self, lease, ssh_args ):
+        """Make sure the master lease is on is up, starting it again if it isn't.
+        
+        Returns: (bool) True if the master is up.
+        """
+        master_dir = os.path.dirname( lease )
+        fd = self._lock( os.path.join( master_dir, 'lock' ) )
+        try:
+            if os.path.exists( os.path.join( master_dir, 'sock' ) ) and self._ssh( master_dir, ssh_args, [ '-O', 'check' ] ) == 0:
+                return True
+            self._remove( os.path.join( master_dir, 'sock' ) )
+            return self._ssh( master_dir, ssh_args, [ '-o', 'ControlMaster=yes', '-fnN' ] ) == 0
+        finally:
+            self._unlock( fd )
+    
+    
+    def release( self, lease ):
+        """Give back a lease from acquire(), the master stays up for idle_timeout if it was the last one."""
+        master_dir = os.path.dirname( lease )
+        fd = self._lock( os.path.join( self.path, 'lock' ) )
+        try:
+            self._remove( lease )
+            if not self._leases( master_dir ):
+                open( os.path.join( master_dir, 'idle' ), 'w' ).close()
+            self.reap( locked=True )
+        finally:
+            self._unlock( fd )
+        return True
+    
+    
+    def reap( self, force=False, locked=False ):
+        """Shut down every master nobody holds a lease on that's been idle for idle_timeout (or at all, with force).
+        
+        Returns: (int) Number of masters shut down.
+        """
+        if not locked:
+            fd = self._lock( os.path.join( self.path, 'lock' ) )
+        try:
+            reaped = 0
+            for master_dir in self._masters():
+                if self._leases( master_dir ):
+                    continue
+                idle_file = os.path.join( master_dir, 'idle' )
+                if not os.path.exists( idle_file ):
+                    # everybody holding it died, it's idle from now
+                    open( idle_file, 'w' ).close()
+                if not force and now() - os.path.getmtime( idle_file ) < self.idle_timeout:
+                    continue
+                try:
+                    if os.path.exists( os.path.join( master_dir, 'sock' ) ):
+                        self._ssh( master_dir, [], [ '-O', 'exit' ] )
+                except:
+                    self.logger.debug( "Non-fatal error shutting down master in %s: %s", master_dir, sys.exc_info() )
+                for name in os.listdir( master_dir ):
+                    self._remove( os.path.join( master_dir, name ) )
+                os.rmdir( master_dir )
+                reaped += 1
+            return reaped
+        finally:
+            if not locked:
+                self._unlock( fd )
+
+
+class TransferStats(object):
+    """What a transfer moved and how fast, see SSHRPC.rsync_parallel() and SSHRPC.manifest_sync().
+    
+    Attributes
+    ==========
+        ok: (bool) True if everything was transferred. A TransferStats is only True if ok is.
+        files: (int) Number of files in the transfer, whether they needed sending or not.
+        size: (int) Total size of those files.
+        bytes: (int) Total size of the files that were sent, what throughput() goes by.
+        split: (int) Number of files sent in byte ranges over several streams.
+        streams: (int) Number of concurrent streams used.
+        duration: (float) Seconds the transfer took.
+        sent, deleted, drifted: (int) Number of files sent, deleted, and found to differ from
+            what was last sent, see SSHRPC.manifest_sync().
+    """
+    
+    def __init__( self, ok=False, files=0, size=0, bytes=0, split=0, streams=1, duration=0.0, sent=0, deleted=0, drifted=0 ):
+        self.ok       = ok
+        self.files    = files
+        self.size     = size
+        self.bytes    = bytes
+        self.split    = split
+        self.streams  = streams
+        self.duration = duration
+        self.sent     = sent
+        self.deleted  = deleted
+        self.drifted  = drifted
+    
+    
+    def throughput( self ):
+        """Returns: (float) Bytes sent per second."""
+        return self.duration and self.bytes / self.duration or 0.0
+    
+    
+    def __repr__( self ):
+        return "<TransferStats ok=%s files=%d size=%d bytes=%d streams=%d duration=%.1f MB/s=%.1f>" % (
+            self.ok, self.files, self.size, self.bytes, self.streams, self.duration, self.throughput() / 1048576)
+    
+    
+    def __nonzero__( self ):
+        return self.ok
+
+
+class Histogram(object):
+    """Count, sum, min, max and bucketed counts of the values of one metric.
+    
+    Usage
+    =====
+    Optional: bounds
+        bounds: (tuple) Upper bounds of the buckets, the last bucket takes everything bigger.
+            (default = SECONDS, use BYTES for sizes)
+    
+    Test
+    ====
+        >>> h = Histogram()
+        >>> for value in ( 0.002, 0.02, 0.02, 3 ): h.add( value )
+        >>> h.count, h.percentile( 50 ), h.percentile( 99 )
+        (4, 0.025, 3)
+    """
+    SECONDS = ( 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800 )
+    BYTES   = tuple( [ 2 ** i for i in range( 0, 41, 2 ) ] )
+    
+    def __init__( self, bounds=SECONDS ):
+        self.bounds  = bounds
+        self.buckets = [ 0 ] * ( len( bounds ) + 1 )
+        self.count   = 0
+        self.sum     = 0
+        self.min     = None
+        self.max     = None
+    
+    
+    def add( self, value ):
+        i = 0
+        while i < len( self.bounds ) and value > self.bounds[ i ]:
+            i += 1
+        self.buckets[ i ] += 1
+        self.count += 1
+        self.sum += value
+        if self.min == None or value < self.min: self.min = value
+        if self.max == None or value > self.max: self.max = value
+    
+    
+    def percentile( self, p ):
+        """Return the upper bound of the bucket the p-th percentile falls in (max for the last bucket)."""
+        seen = 0
+        for i, count in enumerate( self.buckets ):
+            seen += count
+            if count and seen * 100.0 >= p * self.count:
+                return i < len( self.bounds ) and min( self.bounds[ i ], self.max ) or self.max
+        return None
+    
+    
+    def snapshot( self ):
+        """Returns: (dict) count, sum, min, max, p50, p90 and p99."""
+        return { 'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max,
+                 'p50': self.percentile( 50 ), 'p90': self.percentile( 90 ), 'p99': self.percentile( 99 ) }
+
+
+class Metrics(object):
+    """How long SSHRPC's remote operations take, how much they move, and how many ssh they spawn.
+    
+    Description
+    ===========
+        Every SSHRPC records into SSHRPC.metrics (one Metrics shared by all of them, set it to
+        None to record nothing, or give a box its own). Observations are kept in a Histogram per
+        (name, method, host), method being the outermost public SSHRPC method running in the
+        thread, so the 'command' time of the ssh that path_exists() spawns counts towards
+        path_exists, not execute. Names recorded:
+        
+            call: seconds each public SSHRPC method took, in all.
+            connect: seconds to connect (or check the connection).
+            command: seconds each remote command took (ssh included).
+            stdout_bytes, stderr_bytes: output of each remote command.
+            rsync_bytes, rsync_bytes_per_sec: size of what rsync() synced, and how fast.
+            spawns: (a counter) ssh, rsync and dd processes started.
+    
+    Exporting
+    =========
+        add_hook( func ) calls func( name, value, method, host ) for every observation, and
+        "with SSHRPC.metrics.scope() as m:" collects what happens inside the block in m.
+    
+    Test
+    ====
+        >>> metrics = Metrics()
+        >>> my_box = SSHRPC()
+        >>> my_box.metrics = metrics
+        >>> my_box.path_exists( '/' )
+        True
+        >>> metrics.counters[ ( 'spawns', 'path_exists', my_box.host ) ]
+        1
+        >>> metrics.histograms[ ( 'command', 'path_exists', my_box.host ) ].count
+        1
+        >>> with metrics.scope() as scoped:
+        ...     my_box.execute( 'echo -n hi' )
+        True
+        >>> sorted( [ name for name, method, host in scoped.histograms ] )
+        ['call', 'command', 'stderr_bytes', 'stdout_bytes']
+    """
+    COUNTERS = ( 'spawns', )
+    BOUNDS = { 'stdout_bytes': Histogram.BYTES, 'stderr_bytes': Histogram.BYTES, 'rsync_bytes': Histogram.BYTES,
+               'rsync_bytes_per_sec': Histogram.BYTES, 'transfer_bytes': Histogram.BYTES }
+    
+    def __init__( self ):
+        self.lock       = threading.Lock()
+        self.local      = threading.local()
+        self.histograms = {}
+        self.counters   = {}
+        self.hooks      = []
+    
+    
+    def current( self ):
+        """Return the outermost public SSHRPC method running in this thread, None if there isn't one."""
+        stack = getattr( self.local, 'stack', None )
+        return stack and stack[0] or None
+    
+    
+    def enter( self, method ):
+        """Note that method started in this thread, see SSHRPC._instrument()."""
+        if not hasattr( self.local, 'stack' ): self.local.stack = []
+        self.local.stack.append( method )
+    
+    
+    def leave( self ):
+        self.local.stack.pop()
+    
+    
+    def observe( self, name, value, host='', method=None ):
+        """Record value for the metric name."""
+        if method == None: method = self.current()
+        key = ( name, method, host )
+        self.lock.acquire()
+        try:
+            if not key in self.histograms:
+                self.histograms[ key ] = Histogram( self.BOUNDS.get( name, Histogram.SECONDS ) )
+            self.histograms[ key ].add( value )
+        finally:
+            self.lock.release()
+        self._hooks( name, value, method, host )
+    
+    
+    def count( self, name, host='', method=None, n=1 ):
+        """Add n to the counter name."""
+        if method == None: method = self.current()
+        key = ( name, method, host )
+        self.lock.acquire()
+        try:
+            self.counters[ key ] = self.counters.get( key, 0 ) + n
+        finally:
+            self.lock.release()
+        self._hooks( name, n, method, host )
+    
+    
+    def _hooks( self, name, value, method, host ):
+        """PRIVATE - Hand an observation to every hook, a broken hook never breaks SSHRPC."""
+        for hook in list( self.hooks ):
+            try:
+                hook( name, value, method, host )
+            except:
+                logging.getLogger( 'SSHRPC' ).debug( "Non-fatal error in metrics hook %s: %s", hook, sys.exc_info() )
+    
+    
+    def add_hook( self, func ):
+        """Call func( name, value, method, host ) for every observation from now on."""
+        self.hooks.append( func )
+        return func
+    
+    
+    def remove_hook( self, func ):
+        self.hooks.remove( func )
+    
+    
+    @contextmanager
+    def scope( self ):
+        """Context manager that collects every observation made while it's open (in any thread)
+        into a new Metrics, as well as into this one.
+        """
+        scoped = Metrics()
+        def hook( name, value, method, host ):
+            if name in self.COUNTERS:
+                scoped.count( name, host=host, method=method, n=value )
+            else:
+                scoped.observe( name, value, host=host, method=method )
+        self.add_hook( hook )
+        try:
+            yield scoped
+        finally:
+            self.remove_hook( hook )
+    
+    
+    def snapshot( self ):
+        """Returns: (dict) Every histogram's snapshot and every counter, keyed by 'name method host'."""
+        self.lock.acquire()
+        try:
+            result = dict( [ ( ' '.join( [ str( k ) for k in key ] ), h.snapshot() ) for key, h in self.histograms.items() ] )
+            result.update( dict( [ ( ' '.join( [ str( k ) for k in key ] ), n ) for key, n in self.counters.items() ] ) )
+        finally:
+            self.lock.release()
+        return result
+    
+    
+    def reset( self ):
+        """Forget everything recorded so far."""
+        self.lock.acquire()
+        try:
+            self.histograms, self.counters = {}, {}
+        finally:
+            self.lock.release()
+
 
 class SSHRPC(object):
     """Create and manage a SSH session to a (remote?) host.
@@ -55,6 +1742,9 @@ class SSHRPC(object):
     
         3. To test this module with doctest try: python SSHRPC.py -v
         4. To test this module with py.test try: py.test mambo/tests/test_SSHRPC.py
+        5. Nothing is logged until SSHRPC.setup_logging() is called, e.g.
+        SSHRPC.setup_logging( syslog=True, logfile=True ) for the old console, syslog and
+        SSHRPC.debug_log logging. Logged command output is capped at SSHRPC.log_payload_limit.
         
     Example & Test
     ==============
@@ -80,28 +1770,78 @@ class SSHRPC(object):
         Please try to keep SSHRPC as stable and static as possible.
     """
     logger = logging.getLogger( 'SSHRPC' )
-    logger.setLevel( logging.DEBUG )
-    # console logger
-    consoleLogger = logging.StreamHandler()
-    consoleLoggerFormat = logging.Formatter( '%(levelname)s %(message)s' )
-    consoleLogger.setFormatter( consoleLoggerFormat )
-    consoleLogger.setLevel( logging.INFO )
-    logger.addHandler( consoleLogger )
-    # syslog logging
-    sysLogger       = SysLogHandler( address=( 'esloghost.splunk.com', 514 ) )
-    sysLoggerFormat = logging.Formatter( 'lineno=%(lineno)d %(levelname)s %(module)s %(funcName)s %(message)s' )
-    sysLogger.setFormatter( sysLoggerFormat )
-    sysLogger.setLevel( logging.DEBUG )
-    logger.addHandler( sysLogger )
-    # DEBUG file logging
-    fileLogger       = logging.FileHandler( 'SSHRPC.debug_log', mode='wa' )
-    fileLoggerFormat = logging.Formatter( '%(asctime)s lineno=%(lineno)d %(levelname)s %(module)s %(funcName)s %(message)s' )
-    fileLogger.setFormatter( fileLoggerFormat )
-    fileLogger.setLevel( logging.DEBUG )
-    logger.addHandler( fileLogger )
-
-    
-    def __init__( self, host='localhost', login='', identity='', master=False ):
+    logger.addHandler( _NullHandler() )
+    # set up by setup_logging(), nothing is logged anywhere until it is called
+    queueLogger   = None
+    consoleLogger = None
+    sysLogger     = None
+    fileLogger    = None
+    # longest command output (per stream) that is logged, 0 for no limit
+    log_payload_limit = 1024
+    # see Metrics, None records nothing
+    metrics = Metrics()
+    SYSLOG_ADDRESS = ( 'esloghost.splunk.com', 514 )
+    DEBUG_LOG      = 'SSHRPC.debug_log'
+    # 'ssh -V' output keyed by ( ssh binary, its mtime ), and the logins sessreg has registered,
+    # the local ssh client doesn't change under a process, see _ssh_version()
+    _ssh_versions = {}
+    _sessreg_logins = set()
+    _ssh_lock = threading.Lock()
+    
+    
+    @classmethod
+    def setup_logging( cls, console=True, syslog=None, logfile=None, level=logging.DEBUG ):
+        """Start logging SSHRPC's messages, through a QueueLogHandler.
+        
+        Usage
+        =====
+        Returns: (QueueLogHandler) The handler attached to SSHRPC.logger.
+        Optional: console, syslog, logfile, level
+            console: (bool) Log INFO and up to stderr. (default = True)
+            syslog: True for SSHRPC.SYSLOG_ADDRESS, or any SysLogHandler address. (default = None)
+            logfile: True for SSHRPC.DEBUG_LOG, or a file name to log DEBUG and up to. (default = None)
+            level: Level of the SSHRPC logger, raised to the lowest level of the handlers. (default = logging.DEBUG)
+        
+        Notes
+        =====
+            Calling it again replaces the handlers set up by the last call.
+        """
+        handlers = []
+        cls.consoleLogger = cls.sysLogger = cls.fileLogger = None
+        # console logger
+        if console:
+            cls.consoleLogger = logging.StreamHandler()
+            cls.consoleLogger.setFormatter( logging.Formatter( '%(levelname)s %(message)s' ) )
+            cls.consoleLogger.setLevel( logging.INFO )
+            handlers.append( cls.consoleLogger )
+        # syslog logging
+        if syslog:
+            if syslog == True: syslog = cls.SYSLOG_ADDRESS
+            cls.sysLogger = SysLogHandler( address=syslog )
+            cls.sysLogger.setFormatter( logging.Formatter( 'lineno=%(lineno)d %(levelname)s %(module)s %(funcName)s %(message)s' ) )
+            cls.sysLogger.setLevel( logging.DEBUG )
+            handlers.append( cls.sysLogger )
+        # DEBUG file logging
+        if logfile:
+            if logfile == True: logfile = cls.DEBUG_LOG
+            cls.fileLogger = logging.FileHandler( logfile, mode='a' )
+            cls.fileLogger.setFormatter( logging.Formatter( '%(asctime)s lineno=%(lineno)d %(levelname)s %(module)s %(funcName)s %(message)s' ) )
+            cls.fileLogger.setLevel( logging.DEBUG )
+            handlers.append( cls.fileLogger )
+        if cls.queueLogger:
+            cls.logger.removeHandler( cls.queueLogger )
+            cls.queueLogger.close()
+        cls.queueLogger = QueueLogHandler( handlers )
+        # a record none of the handlers want isn't made, let alone rendered in the caller's thread
+        wanted = min( [ handler.level for handler in handlers ] or [ logging.CRITICAL + 1 ] )
+        cls.queueLogger.setLevel( wanted )
+        cls.logger.addHandler( cls.queueLogger )
+        cls.logger.setLevel( max( level, wanted ) )
+        return cls.queueLogger
+
+    
+    def __init__( self, host='localhost', login='', identity='', master=False, transport='popen', probe='each', lazy=False, facts_cache=None, agent=False,
+                  health_interval=60, keepalive=False, master_pool=None ):
         # here's the important stuff
         if not login:       login    = self._find_username()
         if not identity:    identity = os.path.join( os.path.expanduser( '~' ), '.ssh', 'id_dsa' )
@@ -109,29 +1849,164 @@ class SSHRPC(object):
         self.login                   = login
         self.identity                = identity
         self.master                  = master
+        # masters are leased from a MasterPool (MasterPool.shared() unless we're given one)
+        self.master_pool             = master_pool
+        self.master_lease            = None
+        # 'popen' forks a new ssh per command, 'channel' streams every command over one SSHChannel
+        self.transport               = transport
+        self.channel                 = None
+        # 'each' discovers host facts one command at a time, 'batch' in a single round trip (see func_probe)
+        self.probe                   = probe
+        # a FactsCache to save probing across processes, True for the default one
+        if facts_cache == True: facts_cache = FactsCache()
+        self.facts_cache             = facts_cache
+        # answer path_* helpers through one long-lived FSAgent instead of a 'python -c' each
+        self.use_agent               = agent
+        self.agent                   = None
+        # what the last command (or check) told us about the connection, and when, see is_alive()
+        self.health_interval         = health_interval
+        self.alive                   = None
+        self.checked                 = 0
+        self.keepalive_thread        = None
+        self.keepalive_stop          = None
         
         if not os.path.exists( self.identity ): raise Exception, "SSH identity %s does not exist." % self.identity
+        if not self.transport in ( 'popen', 'channel' ): raise Exception, "Unknown transport %s." % self.transport
+        if not self.probe in ( 'each', 'batch' ): raise Exception, "Unknown probe %s." % self.probe
         
-        self.logger.debug( "host=%s login=%s identity=%s master=%s" % (self.host,self.login,self.identity,self.master) )
+        self.logger.debug( "host=%s login=%s identity=%s master=%s transport=%s", self.host, self.login, self.identity, self.master, self.transport )
         
         # to make sure we actually work we'll need to test our SSH version and attempt to connect
         self.ssh_args = self._setup_ssh()
         self.connect()
+        if keepalive: self.start_keepalive()
         
-        # special sauce
-        self.home = ''
-        self.func_home()
+        # special sauce, None means we haven't looked yet (see _fact)
+        self._home = None
+        self._windows = None
+        self._platform = None
+        self._py_platform = None
+        self._py_system = None
+        self._py_machine = None
+        self._distro = None
+        # which of curl, wget and python the host has, if func_probe() has looked (see file_retrieve)
+        self._fetchers = None
+        # anything we knew last time doesn't need probing again
+        if self._load_facts(): return
+        # with lazy=True every fact is probed the first time it's read instead
+        if lazy: return
+        self._discover()
+    
+    
+    def _discover( self ):
+        """PRIVATE - Probe for every host fact we don't know yet, and save them to our facts_cache."""
+        if self.probe == 'batch':
+            self.func_probe()
+        else:
+            self.func_home()
         # if we can't determine our remote home we might as well give up
         if not self.home: raise Exception, "Cannot determine our home on %s" % self.host
-        self.windows = False
-        self.platform = {}
-        self.py_platform = ''
-        self.py_system = ''
-        self.py_machine = ''
-        self.func_platform()
-        # determine linux distro
-        self.distro = {}
-        self.func_distro()
+        if self.probe == 'each':
+            self.func_platform()
+            # determine linux distro
+            self.func_distro()
+        self._save_facts()
+    
+    
+    def _load_facts( self ):
+        """PRIVATE - Fill in host facts from our facts_cache.
+        
+        Returns: (bool) True if the cache knew every fact.
+        """
+        if not self.facts_cache: return False
+        facts = self.facts_cache.get( self.host, self.login ) or {}
+        for name in self.FACTS:
+            if name in facts and getattr( self, '_' + name ) == None:
+                setattr( self, '_' + name, facts[ name ] )
+        self.logger.debug( "facts=%s", facts )
+        return len( [ name for name in self.FACTS if getattr( self, '_' + name ) == None ] ) == 0
+    
+    
+    def _save_facts( self ):
+        """PRIVATE - Save the host facts we know to our facts_cache."""
+        if not self.facts_cache: return False
+        facts = dict( [ ( name, getattr( self, '_' + name ) ) for name in self.FACTS if getattr( self, '_' + name ) != None ] )
+        return self.facts_cache.put( self.host, self.login, facts )
+    
+    
+    def refresh_facts( self ):
+        """Forget every host fact, here and in our facts_cache, and probe for them again.
+        Use this when a host has been reimaged.
+        
+        Returns: (bool) True on success.
+        Required: n/a
+        Optional: n/a
+        """
+        if self.facts_cache:
+            self.facts_cache.invalidate( self.host, self.login )
+        for name in self.FACTS:
+            setattr( self, '_' + name, None )
+        self._discover()
+        return True
+    
+    
+    def _fact( name ):
+        """PRIVATE - Build a property for the host fact name, that is probed for the first time
+        it's read (see _probe_fact) and remembered in self._<name> after that.
+        """
+        def fget( self ):
+            if getattr( self, '_' + name, None ) == None:
+                self._probe_fact( name )
+            return getattr( self, '_' + name )
+        def fset( self, value ):
+            setattr( self, '_' + name, value )
+        return property( fget, fset, doc="Host fact, probed on first read." )
+    
+    FACTS = ( 'home', 'windows', 'platform', 'py_platform', 'py_system', 'py_machine', 'distro' )
+    home        = _fact( 'home' )
+    windows     = _fact( 'windows' )
+    platform    = _fact( 'platform' )
+    py_platform = _fact( 'py_platform' )
+    py_system   = _fact( 'py_system' )
+    py_machine  = _fact( 'py_machine' )
+    distro      = _fact( 'distro' )
+    del _fact
+    
+    
+    def _probe_fact( self, name ):
+        """PRIVATE - Run whichever probe discovers the host fact name."""
+        self.logger.debug( "name=%s probe=%s", name, self.probe )
+        if self.probe == 'batch':
+            self.func_probe()
+        elif name == 'home':
+            self.func_home()
+        elif name == 'distro':
+            self.func_distro()
+        else:
+            self.func_platform()
+        self._save_facts()
+    
+    
+    def prefetch( self ):
+        """Discover every host fact (home, platform, python platform, distro) in one round trip.
+        Mostly useful with SSHRPC(lazy=True), to pay for discovery up front when it suits you.
+        
+        Returns: (bool) True on success.
+        Required: n/a
+        Optional: n/a
+        
+        Example & Test
+        ==============
+        >>> my_box = SSHRPC(lazy=True)
+        >>> my_box.prefetch()
+        True
+        >>> my_box.platform == SSHRPC().platform
+        True
+        """
+        self.func_probe()
+        if not self.home: raise Exception, "Cannot determine our home on %s" % self.host
+        self._save_facts()
+        return True
     
     
     def __repr__( self ):
@@ -158,55 +2033,121 @@ class SSHRPC(object):
             Exception: 'Command did not return 0.'
             >>> my_box.execute( 'sleep 7;echo hello', timeout=9 )
             0
+            >>> my_pipes = {}
+            >>> my_box.execute( 'echo -n partial; sleep 11', timeout=2, pipes=my_pipes ) #doctest: +IGNORE_EXCEPTION_DETAIL
+            Traceback (most recent call last):
+            Exception: 'Command timed out.'
+            >>> my_pipes['stdout']
+            'partial'
             >>>
         
         Operation
         =========
-            @return: Output of Popen.wait(), and if pipes are passed, (dict) of stdout/stderr.
+            @return: Output of Popen.wait(), or a CommandTimeout if timeout was hit, and if pipes are passed, (dict) of stdout/stderr.
             @rtype: int + dict
             @param cmd: Command to run.
             @type cmd: string
-            @param pipes: Populated with the STDOUT and STDERR from cmd.
+            @param pipes: Populated with the STDOUT and STDERR from cmd, what was read so far if timeout was hit.
             @type pipes: dict
             @param shell: TK
             @type shell: TK
+            @param timeout: Seconds cmd may run before it, and every process it started, is killed.
+            @type timeout: int
         """
-        self.logger.debug( "cmd=%s pipes=%s shell=%s timeout=%s" % (repr(cmd),pipes,shell,timeout) )
-        start_time = datetime.datetime.now()
-        # You may be tempted to make this "if not pipes"... don't.
-        if pipes == None:
-            try:
+        self.logger.debug( "cmd=%r pipes=%s shell=%s timeout=%s", cmd, _Capped( pipes ), shell, timeout )
+        start_time = now()
+        if timeout > 0:
+            # give ssh its own process group, so a timeout can take down everything it started
+            cmd, shell = _new_session( cmd, shell )
+        try:
+            # You may be tempted to make this "if not pipes"... don't.
+            if pipes == None:
                 po = Popen( cmd, shell=shell )
-            except OSError as e:
-                raise Exception, "OSError running command '%s':%s" % (cmd,e)
-            except ValueError as e:
-                raise Exception, "ValueError running command '%s':%s" % (cmd,e)
-            except:
-                raise Exception, "Unexpected error running command '%s':%s" % (cmd,sys.exc_info())
-        else:
-            try:
+            else:
                 po = Popen( cmd, stdout=PIPE, stderr=PIPE, shell=shell )
+        except OSError as e:
+            raise Exception, "OSError running command '%s':%s" % (cmd,e)
+        except ValueError as e:
+            raise Exception, "ValueError running command '%s':%s" % (cmd,e)
+        except:
+            raise Exception, "Unexpected error running command '%s':%s" % (cmd,sys.exc_info())
+        self._spawned()
+        if timeout <= 0:
+            if pipes != None:
                 pipes['stdout'], pipes['stderr'] = po.communicate()
-                self.logger.debug( "pipes=%s" % (pipes) )
-            except OSError as e:
-                raise Exception, "OSError running command '%s':%s" % (cmd,e)
-            except ValueError as e:
-                raise Exception, "ValueError running command '%s':%s" % (cmd,e)
-            except:
-                raise Exception, "Unexpected error running command '%s':%s" % (cmd,sys.exc_info())
-        if timeout > 0:
-            return_code = po.poll()
-            while return_code == None:
-                return_code = po.poll()
-                sleep( 0.2 )
-                duration = ( datetime.datetime.now() - start_time ).seconds
-                if duration > timeout:
-                    self.logger.debug( "duration=%s > timeout=%s" % (duration,timeout) )
-                    po.terminate()
-                    return None
-            return return_code
+                self.logger.debug( "pipes=%s", _Capped( pipes ) )
+            return self._ran( start_time, pipes, po.wait() )
+        
+        deadline = start_time + timeout
+        if pipes == None:
+            # nothing to read, so just have a timer kill it at the deadline
+            timer = threading.Timer( timeout, self._kill, [ po ] )
+            timer.start()
+            try:
+                return_code = po.wait()
+            finally:
+                timer.cancel()
+            if now() < deadline:
+                return self._ran( start_time, pipes, return_code )
         else:
-            return po.wait()
+            chunks = { po.stdout.fileno(): [], po.stderr.fileno(): [] }
+            open_fds = chunks.keys()
+            while open_fds and now() < deadline:
+                for fd in select( open_fds, [], [], max( deadline - now(), 0 ) )[0]:
+                    chunk = os.read( fd, 65536 )
+                    if chunk:
+                        chunks[ fd ].append( chunk )
+                    else:
+                        open_fds.remove( fd )
+            pipes['stdout'] = ''.join( chunks[ po.stdout.fileno() ] )
+            pipes['stderr'] = ''.join( chunks[ po.stderr.fileno() ] )
+            self.logger.debug( "pipes=%s", _Capped( pipes ) )
+            # ssh can outlive its pipes (a child that closed them and kept going), it gets until the deadline too
+            while not open_fds and po.poll() == None and now() < deadline:
+                sleep( 0.01 )
+            if po.returncode != None:
+                return self._ran( start_time, pipes, po.returncode )
+            self._kill( po )
+        duration = now() - start_time
+        self.logger.debug( "duration=%s > timeout=%s", duration, timeout )
+        return self._ran( start_time, pipes, CommandTimeout( timeout, duration ) )
+    
+    
+    def _ran( self, start_time, pipes, return_code ):
+        """PRIVATE - Record a command that started at start_time with Metrics. Returns return_code."""
+        if self.metrics:
+            self.metrics.observe( 'command', now() - start_time, host=self.host )
+            if pipes:
+                self.metrics.observe( 'stdout_bytes', len( pipes.get( 'stdout' ) or '' ), host=self.host )
+                self.metrics.observe( 'stderr_bytes', len( pipes.get( 'stderr' ) or '' ), host=self.host )
+        return return_code
+    
+    
+    def _spawned( self, n=1 ):
+        """PRIVATE - Count n more processes started, with Metrics."""
+        if self.metrics: self.metrics.count( 'spawns', host=self.host, n=n )
+    
+    
+    def _kill( self, po ):
+        """PRIVATE - Kill po and everything in its process group (just po without setsid), and reap it."""
+        try:
+            group = os.getpgid( po.pid ) == po.pid
+        except OSError:
+            group = False
+        for sig in ( signal.SIGTERM, signal.SIGKILL ):
+            try:
+                if group:
+                    os.killpg( po.pid, sig )
+                else:
+                    os.kill( po.pid, sig )
+            except OSError:
+                pass
+            # give it a moment to go quietly before we insist
+            for i in range( 10 ):
+                if po.poll() != None:
+                    return True
+                sleep( 0.05 )
+        return po.wait()
     
     
     def execute( self, cmd, dir='', pipes={}, env={}, ssh_args='', expected_return=0, timeout=0 ):
@@ -219,8 +2160,10 @@ class SSHRPC(object):
         Optional: remote_dir,stdout,stderr,std,env,pipes, ssh_args,timeout
           remote_dir=(str) Directory to cd to before running cmd.
           timeout=(int) Number of seconds to wait for command to execute before terminating. (default = 0 (no timeout)
+                             With transport='channel' only the channel is closed, see SSHChannel.
           ssh_args=(str) Extra flags to pass to this particular ssh command, separate
                              from the flags contained in self.ssh_args.
+                             Passing ssh_args always forks a new ssh, even with transport='channel'.
           others TK
         
         Test
@@ -241,7 +2184,105 @@ class SSHRPC(object):
             {'stderr': 'bash: tacoburritosalsa: command not found\\n', 'stdout': ''}
         
         """
-        self.logger.debug( "dir=%s env=%s ssh_args=%s expected_return=%s" % (dir, repr( env ), ssh_args, expected_return) )
+        self.logger.debug( "dir=%s env=%r ssh_args=%s expected_return=%s", dir, env, ssh_args, expected_return )
+        result = self._execute( cmd, dir=dir, pipes=pipes, env=env, ssh_args=ssh_args, timeout=timeout )
+        self.logger.debug( "result=%s", result )
+        if result == expected_return:
+            return True
+        elif isinstance( result, CommandTimeout ):
+            raise Exception, "Command timed out. result=%s ssh_cmd='%s'" % (result,self._ssh_cmd( cmd, dir=dir, env=env, ssh_args=ssh_args )[0])
+        else:
+            raise Exception, "Command did not return %s. result=%s ssh_cmd='%s'" % (expected_return,result,self._ssh_cmd( cmd, dir=dir, env=env, ssh_args=ssh_args )[0])
+    
+    
+    def _execute( self, cmd, dir='', pipes={}, env={}, ssh_args='', timeout=0 ):
+        """PRIVATE - Run cmd on the remote host over our transport without checking the result.
+        README: Do not call this function directly, instead use SSHRPC.execute().
+        
+        Operation
+        =========
+            @return: Exit code of cmd, a CommandTimeout if timeout was hit.
+            @rtype: int
+        """
+        ssh_cmd, cmd = self._ssh_cmd( cmd, dir=dir, env=env, ssh_args=ssh_args )
+        if self.transport == 'channel' and not ssh_args:
+            return self._saw( self._channel_exec( cmd=cmd, pipes=pipes, timeout=timeout ) )
+        else:
+            return self._saw( self._exec( cmd=ssh_cmd, pipes=pipes, timeout=timeout ) )
+    
+    
+    def execute_stream( self, cmd, dir='', env={}, ssh_args='', callback=None, pipes=None, capture_limit=0,
+                        expected_return=0, lines=False, chunk_size=65536, stdin=None ):
+        """Execute a command on the remote host, handing out its output as it arrives.
+        Use this instead of SSHRPC.execute() for commands with a lot of output (tail -f, find /).
+        
+        Usage
+        =====
+        Returns: (ExecStream) if neither callback nor pipes are given, iterate over it for
+            ('stdout'|'stderr', data) tuples, its return_code is set once it's exhausted.
+            Otherwise (bool) True if cmd returned expected_return, raises Exception if it didn't.
+        Required: cmd
+            cmd: (str) The command to be run on the remote host.
+        Optional: dir, env, ssh_args, callback, pipes, capture_limit, expected_return, lines, chunk_size, stdin
+            dir, env, ssh_args: see SSHRPC.execute().
+            callback: (function) Called with (name, data) for every chunk (or line) of output.
+            pipes: (dict) Populated with stdout and stderr, like SSHRPC.execute().
+            capture_limit: (int) Bytes of each of stdout and stderr to keep in pipes, the rest is
+                dropped and pipes['truncated'] is set to True. (default = 0 (no limit))
+            lines: (bool) Hand out whole lines instead of chunks. (default = False)
+            chunk_size: (int) Largest chunk read at once. (default = 65536)
+            stdin: (str) Input for cmd, for input too big for its command line. (default = None)
+        
+        Test
+        ====
+            >>> my_box = SSHRPC()
+            >>> [ data for name, data in my_box.execute_stream( 'echo a; echo b', lines=True ) ]
+            ['a\\n', 'b\\n']
+            >>> my_pipes = {}
+            >>> my_box.execute_stream( 'seq 1 100000', pipes=my_pipes, capture_limit=10 )
+            True
+            >>> my_pipes['stdout'], my_pipes['truncated']
+            ('1\\n2\\n3\\n4\\n5\\n', True)
+            >>> my_box.execute_stream( 'wc -c', pipes=my_pipes, stdin='x' * 1000000 ) and my_pipes['stdout'].strip()
+            '1000000'
+        """
+        self.logger.debug( "dir=%s env=%r ssh_args=%s lines=%s capture_limit=%s", dir, env, ssh_args, lines, capture_limit )
+        ssh_cmd = self._ssh_cmd( cmd, dir=dir, env=env, ssh_args=ssh_args )[0]
+        stream = ExecStream( ssh_cmd, chunk_size=chunk_size, lines=lines, logger=self.logger, stdin=stdin )
+        self._spawned()
+        if callback == None and pipes == None:
+            return stream
+        captured = { 'stdout': [], 'stderr': [] }
+        sizes = { 'stdout': 0, 'stderr': 0 }
+        truncated = False
+        for name, data in stream:
+            if callback:
+                callback( name, data )
+            if pipes == None:
+                continue
+            if capture_limit and sizes[ name ] + len( data ) > capture_limit:
+                data = data[ :capture_limit - sizes[ name ] ]
+                truncated = True
+            captured[ name ].append( data )
+            sizes[ name ] += len( data )
+        if pipes != None:
+            pipes['stdout'], pipes['stderr'] = ''.join( captured['stdout'] ), ''.join( captured['stderr'] )
+            pipes['truncated'] = truncated
+        self.logger.debug( "result=%s", stream.return_code )
+        if stream.return_code == expected_return:
+            return True
+        else:
+            raise Exception, "Command did not return %s. result=%s ssh_cmd='%s'" % (expected_return,stream.return_code,ssh_cmd)
+    
+    
+    def _ssh_cmd( self, cmd, dir='', env={}, ssh_args='' ):
+        """PRIVATE - Build the ssh command line that SSHRPC.execute() would run for cmd.
+        
+        Operation
+        =========
+            @return: The full ssh command line, and the remote command it carries.
+            @rtype: tuple (list, string)
+        """
         vardeclarations = [ ( '%s=%s' % ( var, self.shesc( env[ var ] ) ) ) for var in env ]
         envdeclaration  = ' '.join( vardeclarations )
         if dir:
@@ -253,12 +2294,40 @@ class SSHRPC(object):
         ssh_cmd.extend( self.ssh_args )
         ssh_cmd.extend( ssh_args )
         ssh_cmd.extend( [ self.host, cmd ] )
-        result = self._exec( cmd=ssh_cmd, pipes=pipes, timeout=timeout )
-        self.logger.debug( "result=%s" % (result) )
-        if result == expected_return:
-            return True
-        else:
-            raise Exception, "Command did not return %s. result=%s ssh_cmd='%s'" % (expected_return,result,ssh_cmd)
+        return ( ssh_cmd, cmd )
+    
+    
+    def _channel_exec( self, cmd, pipes={}, timeout=0 ):
+        """PRIVATE - Execute a command over our long-lived SSHChannel, starting it if needed.
+        README: Do not call this function directly, instead use SSHRPC(transport='channel').execute().
+        
+        Test
+        ====
+            >>> my_box = SSHRPC(transport='channel')
+            >>> my_pipes = {}
+            >>> my_box.execute( "echo -n hi; echo -n ho >&2; exit 3", pipes=my_pipes, expected_return=3 )
+            True
+            >>> my_pipes
+            {'stderr': 'ho', 'stdout': 'hi'}
+            >>> my_box.execute( "cd /; echo 'it''s' $HOME", dir='/tmp', pipes=my_pipes )
+            True
+            >>> my_pipes['stdout'] == "its %s\\n" % my_box.home
+            True
+        
+        Operation
+        =========
+            @return: Exit code of cmd, 255 if the channel died, a CommandTimeout on timeout.
+            @rtype: int
+            @param cmd: Command to run, without the ssh command line.
+            @type cmd: string
+        """
+        if not self.channel:
+            channel_cmd = [ 'ssh' ]
+            channel_cmd.extend( self.ssh_args )
+            channel_cmd.extend( [ self.host, 'exec /bin/sh' ] )
+            self.channel = SSHChannel( channel_cmd, logger=self.logger )
+        if not self.channel.po: self._spawned()
+        return self._ran( now(), pipes, self.channel.run( cmd, pipes=pipes, timeout=timeout ) )
     
     
     def _setup_ssh( self ):
@@ -285,50 +2354,173 @@ class SSHRPC(object):
         
         """
         self.ssh_args = []
-        _std = {}
         # This is a workaround for the "You don't exist, go away!" error on Mac OS X (Darwin)
-        sessreg_cmd = ['/usr/X11/bin/sessreg','-w','/var/run/utmpx','-a',self.login + '\r']
-        try:
-            sessreg_exec = Popen( sessreg_cmd, stdout=PIPE, stderr=PIPE )
-            _std['stdout'], _std['stderr'] = sessreg_exec.communicate()
-            self.logger.debug( "%s returned %s" % (sessreg_cmd,_std) )
-        except:
-            self.logger.debug( "Not Fatal, don't worry... %s raised %s" % (sessreg_cmd,sys.exc_info()))
-            pass
+        if sys.platform == 'darwin':
+            self._sessreg()
         # Setup our ssh_args, used across the board.
         self.ssh_args.extend( [ '-q', '-l', self.login , '-i' , self.identity] )
         self.ssh_args.extend( [ '-o', 'StrictHostKeyChecking=no', '-o', 'PreferredAuthentications=publickey' ] )
         # We're going to try to detect our SSH version as we're using some SSH features that aren't
         # available in all versions and they have different parameters in different versions.
-        ssh_version_detect_cmd = [ 'ssh', '-V' ]
-        try:
-            ssh_version_detect_exec = Popen( ssh_version_detect_cmd, stdout=PIPE, stderr=PIPE )
-            _std['stdout'], _std['stderr'] = ssh_version_detect_exec.communicate()
-            self.logger.debug( "'%s' returned %s" % (ssh_version_detect_cmd,_std) )
-        except OSError as e:
-            raise Exception, "OSError running command '%s':%s" % (ssh_version_detect_cmd,e)
-        except ValueError as e:
-            raise Exception, "ValueError running command '%s':%s" % (ssh_version_detect_cmd,e)
-        except:
-            raise Exception, "Unexpected error running command '%s':%s" % (ssh_version_detect_cmd,sys.exc_info())
+        _std = { 'stderr': self._ssh_version() }
         if _std['stderr'].lower().find('openssh') > -1:
             if _std['stderr'].lower().find('debian') > -1:
                 self.ssh_args.extend( [ '-o', 'SetupTimeOut=30', '-o', 'ServerAliveInterval=30' ] )
             else:
                 # apparently only supported in openssh
                 self.ssh_args.extend( [ '-o', 'ConnectTimeout=30' ] )
-            # only openssh 4+ supports session caching
-            if self.master and not _std['stderr'].lower().find('openssh_3') > -1:
-                self.ssh_args.extend(['-S', os.path.join(os.path.expanduser('~'),'.ssh','master-%r@%h:%p')])
+            # only openssh 4+ supports session caching, the master itself is leased in connect()
+            if self.master and _std['stderr'].lower().find('openssh_3') > -1:
+                self.master = False
         else:
             self.master = False
         # this is here to print a runnable ssh command line to the debug log for testing
         _ssh_args = 'ssh'
         for _ssh_arg in self.ssh_args: _ssh_args = _ssh_args + " " + _ssh_arg
-        self.logger.debug('_ssh_args="%s"' % (_ssh_args))
+        self.logger.debug( '_ssh_args="%s"', _ssh_args )
         return self.ssh_args
     
     
+    def _sessreg( self ):
+        """PRIVATE - Register our login in utmpx with sessreg, once per login per process (Darwin only)."""
+        self._ssh_lock.acquire()
+        try:
+            if self.login in self._sessreg_logins: return
+            self._sessreg_logins.add( self.login )
+        finally:
+            self._ssh_lock.release()
+        _std = {}
+        sessreg_cmd = ['/usr/X11/bin/sessreg','-w','/var/run/utmpx','-a',self.login + '\r']
+        try:
+            sessreg_exec = Popen( sessreg_cmd, stdout=PIPE, stderr=PIPE )
+            self._spawned()
+            _std['stdout'], _std['stderr'] = sessreg_exec.communicate()
+            self.logger.debug( "%s returned %s", sessreg_cmd, _Capped( _std ) )
+        except:
+            self.logger.debug( "Not Fatal, don't worry... %s raised %s", sessreg_cmd, sys.exc_info() )
+    
+    
+    def _ssh_version( self ):
+        """PRIVATE - Return what 'ssh -V' prints (to stderr), running it only the first time this
+        process sees the ssh binary on our PATH, or after that binary changes.
+        
+        Test
+        ====
+            >>> SSHRPC()._ssh_version().lower().find( 'ssh' ) > -1
+            True
+        """
+        key = None
+        for dir in os.environ.get( 'PATH', os.defpath ).split( os.pathsep ):
+            path = os.path.join( dir, 'ssh' )
+            if os.path.isfile( path ) and os.access( path, os.X_OK ):
+                key = ( path, os.path.getmtime( path ) )
+                break
+        if key in self._ssh_versions:
+            return self._ssh_versions[ key ]
+        _std = {}
+        ssh_version_detect_cmd = [ 'ssh', '-V' ]
+        try:
+            ssh_version_detect_exec = Popen( ssh_version_detect_cmd, stdout=PIPE, stderr=PIPE )
+            self._spawned()
+            _std['stdout'], _std['stderr'] = ssh_version_detect_exec.communicate()
+            self.logger.debug( "'%s' returned %s", ssh_version_detect_cmd, _Capped( _std ) )
+        except OSError as e:
+            raise Exception, "OSError running command '%s':%s" % (ssh_version_detect_cmd,e)
+        except ValueError as e:
+            raise Exception, "ValueError running command '%s':%s" % (ssh_version_detect_cmd,e)
+        except:
+            raise Exception, "Unexpected error running command '%s':%s" % (ssh_version_detect_cmd,sys.exc_info())
+        self._ssh_lock.acquire()
+        try:
+            return self._ssh_versions.setdefault( key, _std['stderr'] )
+        finally:
+            self._ssh_lock.release()
+    
+    
+    def execute_background( self, cmd, dir='', env={} ):
+        """Start a command on the remote host, detached from ssh, and return right away.
+        
+        Usage
+        =====
+        Returns: (RemoteJob) A handle on the job, raises Exception if it couldn't be started.
+        Required: cmd
+            cmd: (str) The command to be run on the remote host.
+        Optional: dir, env, see SSHRPC.execute().
+        
+        Notes
+        =====
+            The job's stdout, stderr, pid and exit code are kept in ~/.sshrpc/jobs/<id> on the
+            host, see RemoteJob. Use SSHRPC.poll_jobs() (or sshrpc.pool.poll_jobs() across hosts)
+            to check on many jobs at once.
+        
+        Test
+        ====
+            >>> my_box = SSHRPC()
+            >>> my_job = my_box.execute_background( 'echo hi; sleep 1; exit 3' )
+            >>> my_job.state
+            'running'
+            >>> my_job.wait( interval=0.5 ), my_job.state, my_job.output()
+            (3, 'done', 'hi\\n')
+            >>> my_sleeper = my_box.execute_background( 'sleep 60' )
+            >>> my_sleeper.kill()
+            True
+            >>> my_sleeper.wait( interval=0.5 ), my_sleeper.state
+            (-15, 'killed')
+            >>> my_job.cleanup() and my_sleeper.cleanup()
+            True
+        """
+        job = RemoteJob( self, '%d-%08x' % (now(), getrandbits( 32 )), cmd )
+        run = '( %s ); echo $? > "$S/rc.tmp"; mv -f "$S/rc.tmp" "$S/rc"' % self._ssh_cmd( cmd, dir=dir, env=env )[1]
+        # setsid (where there is one) puts the job in its own process group, for RemoteJob.kill()
+        script = ( 'S="$HOME/%s"; mkdir -p "$S" || exit 1; export S; setsid=`command -v setsid`; '
+                   '$setsid nohup sh -c %s > "$S/out" 2> "$S/err" < /dev/null & echo $! > "$S/pid"; echo $!' ) % (job.spool, self._quote( run ))
+        _std = {}
+        return_code = self._execute( script, pipes=_std )
+        if return_code != 0 or not _std['stdout'].strip().isdigit():
+            raise Exception, "Couldn't start %s on %s, return_code=%s: %s" % (cmd,self.host,return_code,_std.get( 'stderr', '' ).strip())
+        job.pid = int( _std['stdout'] )
+        self.logger.debug( "%s", job )
+        return job
+    
+    
+    # for every spool (argv), print its state, and its exit code or killing signal if it has one
+    POLL_SCRIPT = '''
+        for s; do
+            if [ -f "$s/pid" ] && kill -0 `cat "$s/pid"` 2>/dev/null && [ ! -f "$s/rc" ]; then echo running
+            elif [ -f "$s/killed" ]; then echo killed `cat "$s/killed"`
+            elif [ -f "$s/rc" ]; then echo done `cat "$s/rc"`
+            else echo lost; fi
+        done
+    '''
+    
+    def poll_jobs( self, jobs ):
+        """Check on every one of jobs (RemoteJobs on this host) in one round trip, updating their
+        state and return_code.
+        
+        Returns: (list) jobs.
+        """
+        jobs = [ job for job in jobs if job.state == 'running' ]
+        if not jobs: return jobs
+        _std = {}
+        return_code = self._execute( "sh -c %s sh %s" % (self._quote( self.POLL_SCRIPT ), ' '.join( [ job.spool for job in jobs ] )), pipes=_std )
+        if return_code != 0:
+            raise Exception, "Couldn't poll jobs on %s, return_code=%s: %s" % (self.host,return_code,_std.get( 'stderr', '' ).strip())
+        for job, line in zip( jobs, _std['stdout'].splitlines() ):
+            status = line.split()
+            job.state = status[0]
+            if job.state == 'done':
+                job.return_code = int( status[1] )
+            elif job.state == 'killed':
+                job.return_code = -int( status[1] )
+        return jobs
+    
+    
+    @staticmethod
+    def _quote( value ):
+        """PRIVATE - Quote value for the remote shell, as a single word."""
+        return "'%s'" % value.replace( "'", "'\\''" )
+    
+    
     def connect( self ):
         """Connect to the host via SSH.
         
@@ -345,44 +2537,185 @@ class SSHRPC(object):
             >>> SSHRPC().connect()
             True
         """
-        test_ssh = [ 'ssh' ]
-        test_ssh.extend( self.ssh_args )
-        if self.master and self.ssh_args:
-            # setup master ssh connection args
-            test_ssh.extend( [ '-fnN', self.host ] )
-            # gba@20090824 we're using 'yes' instead of 'auto' because we want to force any previous connection to flush
-            if self.master: test_ssh.extend( [ '-o', 'ControlMaster=yes' ] )
-        elif self.ssh_args:
-            test_ssh.extend( [ self.host, 'true' ] )
-        # gba@20090802 you may be tempted to pass _std as pipes here. don't do it, it will break the ssh session.
-        if self._exec( cmd=test_ssh, pipes=None ) == 0: 
+        start_time = now()
+        if self.master and self.ssh_args:
+            alive = self._master_connect()
+        else:
+            test_ssh = [ 'ssh' ]
+            test_ssh.extend( self.ssh_args )
+            if self.ssh_args:
+                test_ssh.extend( [ self.host, 'true' ] )
+            # gba@20090802 you may be tempted to pass _std as pipes here. don't do it, it will break the ssh session.
+            alive = self._exec( cmd=test_ssh, pipes=None ) == 0
+        if self.metrics: self.metrics.observe( 'connect', now() - start_time, host=self.host )
+        return self._health( alive )
+    
+    
+    def disconnect( self ):
+        """Attempt to tear down (close) the ssh session to the (remote) host.
+        TODO gba@20090605 add doctest.
+        """
+        self.stop_keepalive()
+        self.alive, self.checked = None, 0
+        if self.channel:
+            self.channel.close()
+            self.channel = None
+        if self.agent:
+            self.agent.close()
+            self.agent = None
+        if self.master_lease:
+            # other SSHRPCs may still be using the master, the pool shuts it down when it's idle
+            i = self.ssh_args.index( '-S' )
+            del self.ssh_args[ i:i + 2 ]
+            self.master_pool.release( self.master_lease )
+            self.master_lease = None
+        return True
+    
+    
+    def _master_connect( self ):
+        """PRIVATE - Lease our master from master_pool, or make sure the one we have is up.
+        Falls back to master=False if the pool won't give us one.
+        
+        Operation
+        =========
+            @return: True if the host can be reached.
+            @rtype: bool
+        """
+        if self.master_lease:
+            return self.master_pool.ensure( self.master_lease, self.ssh_args )
+        if not self.master_pool: self.master_pool = MasterPool.shared()
+        leased = self.master_pool.acquire( self.host, self.login, self.identity, self.ssh_args )
+        if not leased:
+            self.logger.debug( "no master for %s, carrying on without one", self.host )
+            self.master = False
+            return SSHRPC.connect( self )
+        self.master_lease = leased[0]
+        self.ssh_args.extend( [ '-S', leased[1] ] )
+        return True
+    
+    
+    def _health( self, alive ):
+        """PRIVATE - Record whether the connection is up, as of now. Returns alive."""
+        self.alive   = alive
+        self.checked = now()
+        return alive
+    
+    
+    def _saw( self, return_code ):
+        """PRIVATE - Learn what we can about the connection from a command's exit code. Returns return_code.
+        
+        Any exit code but ssh's own 255 means we got through. 255 (which a remote command could
+        return too) marks the connection down, so the next is_alive() checks it for real.
+        A CommandTimeout tells us nothing either way.
+        """
+        if isinstance( return_code, CommandTimeout ):
+            return return_code
+        self._health( return_code != 255 )
+        return return_code
+    
+    
+    def check( self ):
+        """Check the connection now, whatever we knew about it.
+        
+        Usage
+        =====
+        Returns: (bool) True if the host can be reached, False if it can't.
+        
+        Notes
+        =====
+            With master=True this asks the master (ssh -O check) and only starts a new one if
+            it's gone, otherwise it runs 'true' on the host, see SSHRPC.connect().
+        """
+        if self.master and self.ssh_args:
+            check_ssh = [ 'ssh' ]
+            check_ssh.extend( self.ssh_args )
+            check_ssh.extend( [ '-O', 'check', self.host ] )
+            if self._exec( cmd=check_ssh, pipes={} ) == 0:
+                return self._health( True )
+        return SSHRPC.connect( self )
+    
+    
+    def is_alive( self ):
+        """Is the connection up? Only goes to the host if what we know is stale.
+        
+        Usage
+        =====
+        Returns: (bool) True if the host can be reached, False if it can't.
+        
+        Notes
+        =====
+            Every command run through SSHRPC counts as a check, so in the common case this costs
+            nothing. The host is checked again (see SSHRPC.check()) once health_interval seconds
+            have gone by without one, or right away after a command failed with ssh's exit
+            code 255. health_interval=0 checks every time, like connect() did.
+        
+        Test
+        ====
+            >>> my_box = SSHRPC()
+            >>> my_box.alive
+            True
+            >>> my_box.execute( 'exit 255', expected_return=255 )
+            True
+            >>> my_box.alive
+            False
+            >>> my_box.is_alive(), my_box.alive
+            (True, True)
+        """
+        if self.alive and now() - self.checked < self.health_interval:
             return True
-        else:
-            return False
+        return self.check()
     
     
-    def disconnect( self ):
-        """Attempt to tear down (close) the ssh session to the (remote) host.
-        TODO gba@20090605 add doctest.
+    def start_keepalive( self, interval=0 ):
+        """Keep the connection checked from a background thread, so is_alive() never has to wait.
+        
+        Usage
+        =====
+        Optional: interval
+            interval: (int) Seconds between looks at the connection. (default = health_interval)
+        
+        Notes
+        =====
+            The thread only goes to the host when is_alive() would, and stops at disconnect().
+            SSHRPC(keepalive=True) starts it for you.
         """
-        _std = {}
-        if self.master:
-            ssh_teardown = [ 'ssh' ]
-            ssh_teardown.extend( self.ssh_args )
-            ssh_teardown.extend( [ '-o', 'ControlMaster=auto' ] )
-            ssh_teardown.extend( [ '-fnN', '-O', 'exit', self.host ] )
+        if self.keepalive_thread:
+            return self.keepalive_thread
+        self.keepalive_stop   = threading.Event()
+        self.keepalive_thread = threading.Thread( target=SSHRPC._keepalive,
+                                                  args=( weakref.ref( self ), interval or self.health_interval or 60, self.keepalive_stop ) )
+        self.keepalive_thread.setDaemon( True )
+        self.keepalive_thread.start()
+        return self.keepalive_thread
+    
+    
+    def stop_keepalive( self ):
+        """Stop the thread start_keepalive() started."""
+        if self.keepalive_thread:
+            self.keepalive_stop.set()
+            if self.keepalive_thread != threading.currentThread():
+                self.keepalive_thread.join()
+            self.keepalive_thread = None
+    
+    
+    @staticmethod
+    def _keepalive( box_ref, interval, stopped ):
+        """PRIVATE - The keepalive thread. Holds only a weak reference, so the SSHRPC can still be collected."""
+        while True:
+            stopped.wait( interval )
+            box = box_ref()
+            if stopped.isSet() or box == None:
+                return
             try:
-                self._exec( cmd=ssh_teardown, pipes=_std )
+                box.is_alive()
             except:
-                self.logger.debug( "Non-fatal unexpected error running command '%s': %s" % ( ssh_teardown, sys.exc_info() ) )
-                raise
-        self.logger.removeHandler( self.sysLogger )
-        return True
+                box.logger.debug( "Non-fatal error in keepalive for %s: %s", box.host, sys.exc_info() )
+            del box
     
     
     def __nonzero__( self ):
-        """Wrapper for SSHRPC.connect()"""
-        return self.connect()
+        """Wrapper for SSHRPC.is_alive()"""
+        return self.is_alive()
     
     
     def __del__( self ):
@@ -448,15 +2781,96 @@ class SSHRPC(object):
         True
         
         """
-        self.logger.debug( "options=%s" % (options) )
+        self.logger.debug( "options=%s", options )
         _return = ''
         _std = {}
         if self.execute( cmd='uname %s' % (options), pipes=_std):
             _return = _std['stdout'].rstrip()
-        self.logger.debug( "_return=%s" % (_return) )
+        self.logger.debug( "_return=%s", _return )
         return _return
     
     
+    def func_probe( self ):
+        """Discover our home, platform, python platform and distro on the remote system in one
+        round trip, instead of the ten or so commands func_home(), func_platform() and func_distro()
+        run between them.
+        
+        Returns: (dict) Everything the probe script printed, e.g. {'home':'', 'uname_s':'', ...}
+            Also sets self.home, self.platform, self.windows, self.py_platform, self.py_system,
+            self.py_machine and self.distro, the same way the func_* methods would.
+        Required: n/a
+        Optional: n/a
+        
+        Example & Test
+        ==============
+        >>> my_box = SSHRPC(probe='batch')
+        >>> my_box.func_probe()['uname_s'] == my_box.uname('-s')
+        True
+        >>> my_box.platform['hostOS'] == SSHRPC().func_platform()['hostOS']
+        True
+        >>> my_box.py_system == SSHRPC().py_system
+        True
+        
+        """
+        _std = {}
+        self.execute( cmd=self.PROBE_CMD, pipes=_std )
+        return self._apply_probe( _std['stdout'] )
+    
+    
+    # every line is key=value, anything that fails just prints an empty value
+    PROBE_SCRIPT = '''
+        echo "home=`[ -d "$HOME" ] && echo $HOME`"
+        echo "uname_s=`uname -s 2>/dev/null`"
+        echo "uname_p=`uname -p 2>/dev/null`"
+        echo "uname_m=`uname -m 2>/dev/null`"
+        [ -x /usr/bin/isainfo ] && echo "isainfo=`/usr/bin/isainfo -k 2>/dev/null`"
+        python -c 'import platform;print("py_platform="+platform.platform(aliased=True));print("py_system="+platform.system());print("py_machine="+platform.machine())' 2>/dev/null
+        lsb_release -d 2>/dev/null | sed -e 's/^Description:\t/lsb_description=/'
+        lsb_release -r 2>/dev/null | sed -e 's/^Release:\t/lsb_release=/'
+        if [ -f /etc/debian_version ]; then echo "linux=debian"; elif [ -f /etc/redhat-release ]; then echo "linux=redhat"; fi
+        printf "fetchers="; for t in curl wget python; do command -v $t >/dev/null 2>&1 && printf "%s " $t; done; echo
+        true
+    '''
+    PROBE_CMD = "sh -c '%s'" % PROBE_SCRIPT.replace( "'", "'\\''" )
+    
+    
+    def _apply_probe( self, output ):
+        """PRIVATE - Parse the output of PROBE_SCRIPT into our host facts, see func_probe()."""
+        facts = {}
+        for line in output.splitlines():
+            if line.find( '=' ) > -1:
+                key, value = line.split( '=', 1 )
+                facts[ key ] = value.rstrip()
+        self.logger.debug( "facts=%s", facts )
+        
+        if not self._home:
+            self.home = facts.get( 'home', '' )
+        if self._windows == None:
+            self.windows = False
+        if not 'hostOS' in ( self._platform or {} ) and not 'hostArch' in ( self._platform or {} ):
+            self.platform = {'hostOS': facts.get( 'uname_s', '' ),'hostArch': facts.get( 'uname_p', '' )}
+            # same rules as func_platform()
+            if self.platform['hostArch'] == "unknown" or not self.platform['hostArch'] or self.platform['hostArch'].find('Intel(R)') > -1:
+                self.platform['hostArch'] = facts.get( 'uname_m', '' )
+            if self.platform['hostOS'] == "SunOS" and self.platform['hostArch'] == "i386" and facts.get( 'isainfo' ):
+                self.platform['hostArch'] = facts['isainfo']
+            if self.platform['hostOS'].lower().find('cygwin') > -1:
+                self.windows = True
+        self.py_platform = facts.get( 'py_platform', '' )
+        self.py_system = facts.get( 'py_system', '' )
+        self.py_machine = facts.get( 'py_machine', '' )
+        if 'fetchers' in facts:
+            self._fetchers = facts['fetchers'].split()
+        if self._distro == None:
+            self.distro = {}
+        if not 'linux' in self.distro and self.platform['hostOS'].lower().find("linux") > -1:
+            if 'lsb_description' in facts: self.distro['description'] = facts['lsb_description']
+            if 'lsb_release' in facts: self.distro['release'] = facts['lsb_release']
+            if 'linux' in facts: self.distro['linux'] = facts['linux']
+        self.logger.debug( "self.home=%s self.windows=%s self.platform=%s self.distro=%s", self.home, self.windows, self.platform, self.distro )
+        return facts
+    
+    
     def func_distro( self ):
         """Get the lsb_release distro name.
         This method is only useful for discovering Linux distribution types, otherwise
@@ -468,7 +2882,14 @@ class SSHRPC(object):
         Required: n/a
         Optional: n/a
         """
-        if not 'linux' in self.distro and 'hostOS' in self.platform and self.platform['hostOS'].lower().find("linux") > -1:
+        if self.probe == 'batch' and self._distro == None:
+            # the probe finds the distro along with everything else, in one round trip
+            self.func_probe()
+        # with lazy=True reading the platform may probe for it, do that before looking at the distro
+        platform = self.platform
+        if self._distro == None:
+            self.distro = {}
+        if not 'linux' in self.distro and 'hostOS' in platform and platform['hostOS'].lower().find("linux") > -1:
             _std = {}
             if self.execute(cmd="lsb_release -d",pipes=_std): 
                 self.distro['description'] = _std['stdout'].rstrip().split('Description:\t')[-1]
@@ -478,7 +2899,7 @@ class SSHRPC(object):
                 self.distro['linux'] = 'debian'
             elif self.execute(cmd="[ -f /etc/redhat-release ]"):
                 self.distro['linux'] = 'redhat'
-        self.logger.debug("self.distro=%s" % (self.distro))
+        self.logger.debug( "self.distro=%s", self.distro )
         return self.distro
     
     
@@ -511,7 +2932,9 @@ class SSHRPC(object):
         True
         
         """
-        if not 'hostOS' in self.platform and not 'hostArch' in self.platform:
+        if self._windows == None:
+            self.windows = False
+        if not 'hostOS' in ( self._platform or {} ) and not 'hostArch' in ( self._platform or {} ):
             _std = {}
             self.platform = {'hostOS': self.uname('-s'),'hostArch': self.uname('-p')}
             # some systems differentiate between 'architecture' and 'machine'
@@ -527,15 +2950,16 @@ class SSHRPC(object):
                 self.windows = True
         
         # new school stuff follows
-        _std = {}
-        self.execute( cmd="python -m platform", pipes=_std)
-        self.py_platform = _std['stdout'].rstrip()
-        (ret, _std) = self.python( program="import platform;print platform.system()" )
-        self.py_system = _std['stdout'].rstrip()
-        (ret, _std) = self.python( program="import platform;print platform.machine()" )
-        self.py_machine = _std['stdout'].rstrip()
-        
-        self.logger.debug("self.windows=%s self.platform=%s" % (self.windows,self.platform,))
+        if self._py_platform == None or self._py_system == None or self._py_machine == None:
+            _std = {}
+            self.execute( cmd="python -m platform", pipes=_std)
+            self.py_platform = _std['stdout'].rstrip()
+            (ret, _std) = self.python( program="import platform;print platform.system()" )
+            self.py_system = _std['stdout'].rstrip()
+            (ret, _std) = self.python( program="import platform;print platform.machine()" )
+            self.py_machine = _std['stdout'].rstrip()
+        
+        self.logger.debug( "self.windows=%s self.platform=%s", self.windows, self.platform )
         return self.platform
     
     
@@ -579,9 +3003,439 @@ class SSHRPC(object):
             >>> os.path.exists( os.path.join( random_dir_name, 'resolv.conf' ) )
             True
         """
-        self.logger.debug( "local=%s remote=%s reverse=%s" % (local,remote,reverse) )
+        self.logger.debug( "local=%s remote=%s reverse=%s", local, remote, reverse )
         _return = False
-        rsync_cmd = [ 'rsync', '-qar',  '--rsync-path=rsync' ]
+        if not reverse:
+            self.execute( cmd='mkdir -p %s' % self.shesc( remote ), pipes={} )
+        rsync_cmd = self._rsync_cmd( local, remote=remote, reverse=reverse )
+        self.logger.debug( "rsync_cmd=%s", rsync_cmd )
+        start_time = now()
+        if self._exec( rsync_cmd ) == 0: _return = True
+        self.logger.debug( "_return=%s", _return )
+        if self.metrics and _return:
+            self._rsync_metrics( local, remote, reverse, now() - start_time )
+        return _return
+    
+    
+    def _rsync_metrics( self, local, remote, reverse, duration ):
+        """PRIVATE - Record the size (measured on our side) and speed of an rsync() with Metrics."""
+        local = os.path.expanduser( local )
+        if reverse and not remote.endswith( '/' ):
+            local = os.path.join( local, os.path.basename( remote ) )
+        try:
+            synced = sum( [ f[1] for f in self._walk_tree( local )['files'] ] )
+        except OSError:
+            return
+        self.metrics.observe( 'rsync_bytes', synced, host=self.host )
+        self.metrics.observe( 'rsync_bytes_per_sec', duration and synced / duration or 0, host=self.host )
+    
+    
+    def rsync_parallel( self, local, remote='', reverse=False, streams=4, split_size=1073741824, partial=True ):
+        """Like SSHRPC.rsync(), but split across streams concurrent rsyncs, for big trees and big files.
+        
+        Usage
+        =====
+        Returns: (TransferStats) True if everything was transferred, with how much and how fast.
+        Required: local
+            local: (str) see SSHRPC.rsync().
+        Optional: remote, reverse, streams, split_size, partial
+            remote, reverse: see SSHRPC.rsync().
+            streams: (int) Number of rsyncs (each with its own ssh) to run at once. (default = 4)
+            split_size: (int) Files this big are sent in streams byte ranges at once. (default = 1GB)
+            partial: (bool) Keep interrupted files in .rsync-partial so the next run picks up
+                where this one left off, like rsync --partial. (default = True)
+        
+        Description
+        ===========
+            1. The tree is listed up front (locally, or with one remote python for reverse=True) and
+            its files are packed by size into streams lists, each sent by its own
+            'rsync --files-from'. Directories go with the first list.
+            2. Files of split_size and up that are out of date (by size and mtime) are first
+            copied in byte ranges, streams dd's at once, into the destination's .rsync-partial,
+            where rsync then uses them as the basis for its delta transfer. This only checks
+            the copy and sets the file's attributes, and nothing is ever seen half written.
+            Split files need partial=True, and are sent again in full if interrupted.
+            3. There's no separate 'mkdir -p' round trip, it rides along with the rsyncs.
+        
+        Test
+        ====
+            >>> import tempfile
+            >>> my_box = SSHRPC()
+            >>> my_dir = tempfile.mkdtemp()
+            >>> open( os.path.join( my_dir, 'big' ), 'w' ).write( 'x' * 3000000 )
+            >>> my_stats = my_box.rsync_parallel( my_dir, remote=my_dir + '.copy', streams=3, split_size=2000000 )
+            >>> my_stats.ok, my_stats.files, my_stats.split
+            (True, 1, 1)
+            >>> os.path.getsize( os.path.join( my_dir + '.copy', os.path.basename( my_dir ), 'big' ) )
+            3000000
+        """
+        self.logger.debug( "local=%s remote=%s reverse=%s streams=%s", local, remote, reverse, streams )
+        start_time = now()
+        if reverse:
+            _std = {}
+            self.execute( "python -c '%s' walk %s" % (self.TREE_SCRIPT, self.shesc( remote or '.' )), pipes=_std )
+            tree = FactsCache._str( json.loads( _std['stdout'] ) )
+        else:
+            tree = self._walk_tree( os.path.expanduser( local ) )
+        # every file goes to rsync, whether it needs sending or not
+        size = sum( [ f[1] for f in tree['files'] ] )
+        stats = TransferStats( files=len( tree['files'] ), size=size, bytes=size, streams=streams )
+        big = [ f for f in tree['files'] if f[1] >= split_size ]
+        if streams > 1 and partial and big:
+            stats.split = self._rsync_split( local, remote, reverse, tree['root'], big, streams )
+        
+        options = [ '-qa', '--from0' ]
+        if partial: options.append( '--partial-dir=.rsync-partial' )
+        rsync_path = 'rsync'
+        if not reverse:
+            rsync_path = 'mkdir -p %s && rsync' % self.shesc( remote or '.' )
+        running = []
+        for i, files in enumerate( self._pack( tree['files'], streams ) ):
+            paths = [ f[0] for f in files ]
+            if i == 0: paths = tree['dirs'] + paths
+            if not paths: continue
+            fd, files_from = mkstemp( prefix='sshrpc-files' )
+            os.write( fd, '\0'.join( paths ) )
+            os.close( fd )
+            if reverse:
+                rsync_cmd = self._rsync_cmd( local, remote=tree['root'], reverse=True, options=options + [ '--files-from=%s' % files_from ] )
+            else:
+                rsync_cmd = self._rsync_cmd( tree['root'], remote=remote, rsync_path=rsync_path, options=options + [ '--files-from=%s' % files_from ] )
+            self.logger.debug( "rsync_cmd=%s", rsync_cmd )
+            try:
+                running.append( ( Popen( rsync_cmd ), files_from ) )
+                self._spawned()
+            except OSError as e:
+                os.remove( files_from )
+                raise Exception, "OSError running command '%s':%s" % (rsync_cmd,e)
+        stats.ok = True
+        for po, files_from in running:
+            if po.wait() != 0: stats.ok = False
+            os.remove( files_from )
+        stats.duration = now() - start_time
+        self.logger.debug( "stats=%s", stats )
+        if self.metrics and stats.ok:
+            self.metrics.observe( 'rsync_bytes', stats.bytes, host=self.host )
+            self.metrics.observe( 'rsync_bytes_per_sec', stats.throughput(), host=self.host )
+        return stats
+    
+    
+    def _rsync_split( self, local, remote, reverse, root, big, streams, block=1048576 ):
+        """PRIVATE - Copy each out of date file in big, in streams byte ranges at once, into its
+        destination's .rsync-partial. See SSHRPC.rsync_parallel().
+        
+        Operation
+        =========
+            @return: Number of files copied.
+            @rtype: int
+        """
+        dest = os.path.expanduser( local )
+        if reverse:
+            stale = []
+            for path, size, mtime in big:
+                try:
+                    st = os.lstat( os.path.join( dest, path ) )
+                    if st.st_size == size and int( st.st_mtime ) == mtime: continue
+                except OSError:
+                    pass
+                stale.append( ( path, size ) )
+        else:
+            _std = {}
+            self.execute( "python -c '%s' stat %s %s" % (self.TREE_SCRIPT, self.shesc( remote or '.' ),
+                          ' '.join( [ self.shesc( f[0] ) for f in big ] )), pipes=_std )
+            dest_stats = json.loads( _std['stdout'] )
+            stale = [ ( f[0], f[1] ) for f, st in zip( big, dest_stats ) if st != [ f[1], f[2] ] ]
+        devnull = open( os.devnull, 'r+' )
+        copied = 0
+        try:
+            for path, size in stale:
+                blocks = ( size + block - 1 ) / block
+                per = ( blocks + streams - 1 ) / streams
+                src = os.path.join( root, path )
+                part_dir = os.path.join( dest if reverse else remote or '.', os.path.dirname( path ), '.rsync-partial' )
+                part = os.path.join( part_dir, os.path.basename( path ) )
+                if reverse and not os.path.isdir( part_dir ): os.makedirs( part_dir )
+                running = []
+                for skip in range( 0, blocks, per ):
+                    read  = 'dd if=%s bs=%d skip=%d count=%d 2>/dev/null' % (self.shesc( src ), block, skip, per)
+                    write = 'dd of=%s bs=%d seek=%d conv=notrunc 2>/dev/null' % (self.shesc( part ), block, skip)
+                    if reverse:
+                        reader = Popen( self._ssh_cmd( read )[0], stdin=devnull, stdout=PIPE, stderr=devnull )
+                        writer = Popen( write, shell=True, stdin=reader.stdout, stdout=devnull, stderr=devnull )
+                    else:
+                        reader = Popen( read, shell=True, stdin=devnull, stdout=PIPE, stderr=devnull )
+                        writer = Popen( self._ssh_cmd( 'mkdir -p %s && %s' % (self.shesc( part_dir ), write) )[0],
+                                        stdin=reader.stdout, stdout=devnull, stderr=devnull )
+                    reader.stdout.close()
+                    running.extend( [ reader, writer ] )
+                    self._spawned( 2 )
+                # a range that failed is no harm, rsync sends what's missing from the basis
+                if not [ po for po in running if po.wait() != 0 ]:
+                    copied += 1
+        finally:
+            devnull.close()
+        return copied
+    
+    
+    def manifest_sync( self, local, remote='', delete=True, sample=16, cache=None ):
+        """Push local to remote like SSHRPC.rsync(), but from a manifest of what was sent last time
+        instead of having rsync walk (and compare) the whole remote tree.
+        
+        Usage
+        =====
+        Returns: (TransferStats) True if everything that needed sending was sent.
+        Required: local
+            local: (str) The file or directory to push, a trailing slash pushes what's in it.
+        Optional: remote, delete, sample, cache
+            remote: (str) Destination directory on the remote host. (default = '', home)
+            delete: (bool) Remove remote files that were sent before and are gone here. (default = True)
+            sample: (int) Files the remote host checks the md5 of, picked at random from those we
+                think it already has, to catch the manifest drifting from what's really there. (default = 16)
+            cache: (ManifestCache) Where manifests are kept. (default = ManifestCache())
+        
+        Description
+        ===========
+            Local files whose size and mtime match the manifest aren't read, the rest are hashed.
+            Then one remote python removes what's to be deleted (and directories left empty),
+            stats the files the manifest says are there, md5s the sample, and sends back only what
+            doesn't match. rsync then gets just the new, changed and mismatched files (--files-from),
+            and the manifest is saved once it's done. A mismatch in the sample is logged, counted
+            in drifted, and the file is sent again.
+        
+        Notes
+        =====
+            1. Only files (and symlinks) are tracked, empty directories aren't sent.
+            2. Remote files we never sent aren't looked at, whatever else is in remote stays there.
+            3. After changing remote behind our back, use ManifestCache().invalidate() or sample.
+        
+        Test
+        ====
+            >>> import tempfile
+            >>> my_box, my_dir, my_remote = SSHRPC(), tempfile.mkdtemp(), tempfile.mktemp()
+            >>> my_cache = ManifestCache( path=tempfile.mkdtemp() )
+            >>> for name in ( 'a', 'b', 'c' ): open( os.path.join( my_dir, name ), 'w' ).write( name )
+            >>> stats = my_box.manifest_sync( my_dir + '/', my_remote, cache=my_cache )
+            >>> bool( stats ), stats.files, stats.sent
+            (True, 3, 3)
+            >>> os.remove( os.path.join( my_dir, 'a' ) )
+            >>> open( os.path.join( my_remote, 'c' ), 'w' ).write( 'drifted' )
+            >>> stats = my_box.manifest_sync( my_dir + '/', my_remote, cache=my_cache )
+            >>> stats.sent, stats.deleted, sorted( os.listdir( my_remote ) ), open( os.path.join( my_remote, 'c' ) ).read()
+            (1, 1, ['b', 'c'], 'c')
+            >>> stats.size, stats.bytes
+            (2, 1)
+        """
+        cache = cache or ManifestCache()
+        start_time = now()
+        tree = self._walk_tree( os.path.expanduser( local ) )
+        manifest = cache.get( self.host, self.login, remote )
+        stats = TransferStats( files=len( tree['files'] ), size=sum( [ f[1] for f in tree['files'] ] ) )
+        current, send, expect = {}, [], {}
+        for path, size, mtime in tree['files']:
+            known = manifest.get( path )
+            if known and known[0] == size and known[1] == mtime:
+                current[ path ] = known
+                expect[ path ] = known[:2]
+            else:
+                current[ path ] = [ size, mtime, self._md5( os.path.join( tree['root'], path ) ) ]
+                send.append( path )
+        deletes = delete and [ path for path in manifest if not path in current ] or []
+        check = expect.keys()
+        samples = random.sample( check, min( sample, len( check ) ) )
+        request = { 'root': remote or '.', 'expect': expect, 'hash': samples, 'delete': deletes }
+        self.logger.debug( "local=%s remote=%s known=%d changed=%d delete=%d sample=%d", local, remote, len( manifest ), len( send ), len( deletes ), len( samples ) )
+        if expect or deletes:
+            return_code, _std = self._pipe( "python -c '%s'" % self.MANIFEST_SCRIPT, zlib.compress( json.dumps( request ) ) )
+            if return_code != 0:
+                raise Exception, "Couldn't compare %s with its manifest on %s, return_code=%s: %s" % (remote,self.host,return_code,_std['stderr'].strip())
+            report = FactsCache._str( json.loads( _std['stdout'] ) )
+            send.extend( report['changed'] )
+            drifted = [ path for path in samples if report['hashes'].get( path ) != current[ path ][2] and not path in report['changed'] ]
+            if drifted:
+                self.logger.warn( "%d of %d sampled files in %s on %s don't match what was sent, e.g. %s", len( drifted ), len( samples ), remote, self.host, drifted[0] )
+            send.extend( drifted )
+            stats.deleted, stats.drifted = len( deletes ), len( drifted )
+        stats.ok, stats.sent = True, len( send )
+        stats.bytes = sum( [ current[ path ][0] for path in send ] )
+        if send:
+            fd, files_from = mkstemp( prefix='sshrpc-files' )
+            os.write( fd, '\0'.join( send ) )
+            os.close( fd )
+            options = [ '-qa', '--from0', '--files-from=%s' % files_from ]
+            rsync_cmd = self._rsync_cmd( tree['root'], remote=remote, rsync_path='mkdir -p %s && rsync' % self.shesc( remote or '.' ), options=options )
+            self.logger.debug( "rsync_cmd=%s", rsync_cmd )
+            try:
+                stats.ok = self._exec( rsync_cmd ) == 0
+            finally:
+                os.remove( files_from )
+        stats.duration = now() - start_time
+        if stats.ok:
+            cache.put( self.host, self.login, remote, current )
+        self.logger.debug( "stats=%s", stats )
+        return stats
+    
+    
+    @staticmethod
+    def _md5( path ):
+        """PRIVATE - md5 of a local file, or of where it points for a symlink (like MANIFEST_SCRIPT)."""
+        md5 = hashlib.md5()
+        if os.path.islink( path ):
+            md5.update( os.readlink( path ) )
+            return md5.hexdigest()
+        f = open( path, 'rb' )
+        try:
+            for chunk in iter( lambda: f.read( 1048576 ), '' ):
+                md5.update( chunk )
+        finally:
+            f.close()
+        return md5.hexdigest()
+    
+    
+    # reads a zlib json request from stdin: in root, remove delete (and directories that leaves
+    # empty), report which of expect ({path: [size, mtime]}) differ and the md5 of hash
+    MANIFEST_SCRIPT = """
+import os, sys, json, zlib, hashlib
+request = json.loads(zlib.decompress(getattr(sys.stdin, "buffer", sys.stdin).read()).decode())
+root = os.path.expanduser(request["root"])
+for path in request["delete"]:
+    full_path = os.path.join(root, path)
+    try:
+        os.remove(full_path)
+        parent = os.path.dirname(path)
+        while parent:
+            os.rmdir(os.path.join(root, parent))
+            parent = os.path.dirname(parent)
+    except OSError:
+        pass
+changed = []
+for path, expected in request["expect"].items():
+    try:
+        s = os.lstat(os.path.join(root, path))
+        if [s.st_size, int(s.st_mtime)] != expected:
+            changed.append(path)
+    except OSError:
+        changed.append(path)
+hashes = {}
+for path in request["hash"]:
+    full_path = os.path.join(root, path)
+    md5 = hashlib.md5()
+    try:
+        if os.path.islink(full_path):
+            md5.update(os.readlink(full_path).encode())
+        else:
+            f = open(full_path, "rb")
+            for chunk in iter(lambda: f.read(1048576), b""):
+                md5.update(chunk)
+            f.close()
+        hashes[path] = md5.hexdigest()
+    except (IOError, OSError):
+        pass
+print(json.dumps({"changed": changed, "hashes": hashes}))
+"""
+    
+    
+    @staticmethod
+    def _walk_tree( path ):
+        """PRIVATE - List a local tree the way TREE_SCRIPT lists a remote one.
+        
+        Operation
+        =========
+            @return: {'root': the directory paths are relative to, 'dirs': [path], 'files': [[path, size, mtime]]}
+                A trailing slash on path lists what's in it, like rsync.
+            @rtype: dict
+        """
+        if path.endswith( os.sep ):
+            root, top = path, ''
+        else:
+            root, top = os.path.dirname( path ) or '.', os.path.basename( path )
+        tree = { 'root': root, 'dirs': [], 'files': [] }
+        start = os.path.join( root, top )
+        def add( rel ):
+            st = os.lstat( os.path.join( root, rel ) )
+            tree['files'].append( [ rel, st.st_size, int( st.st_mtime ) ] )
+        if not os.path.isdir( start ) or os.path.islink( start ):
+            add( top )
+            return tree
+        if top: tree['dirs'].append( top )
+        for walk_dir, dir_names, file_names in os.walk( start ):
+            rel_dir = walk_dir[ len( root ): ].lstrip( os.sep )
+            for name in dir_names:
+                if os.path.islink( os.path.join( walk_dir, name ) ): add( os.path.join( rel_dir, name ) )
+                else: tree['dirs'].append( os.path.join( rel_dir, name ) )
+            for name in file_names:
+                add( os.path.join( rel_dir, name ) )
+        return tree
+    
+    
+    @staticmethod
+    def _pack( files, bins ):
+        """PRIVATE - Split files ([path, size, ...]) into bins lists of about the same total size, biggest first.
+        
+        Test
+        ====
+            >>> [ [ f[0] for f in b ] for b in SSHRPC._pack( [ ['a', 5], ['b', 1], ['c', 4], ['d', 2] ], 2 ) ]
+            [['a', 'b'], ['c', 'd']]
+        """
+        packed = [ [ 0, [] ] for i in range( bins ) ]
+        for f in sorted( files, key=lambda f: -f[1] ):
+            lightest = min( packed, key=lambda b: b[0] )
+            lightest[0] += f[1]
+            lightest[1].append( f )
+        return [ b[1] for b in packed ]
+    
+    
+    # walk: list a tree like SSHRPC._walk_tree(), stat: [size, mtime] (or null) of paths relative to a directory
+    TREE_SCRIPT = """
+import os, sys, json
+def stat(path):
+    try:
+        s = os.lstat(path)
+        return [s.st_size, int(s.st_mtime)]
+    except OSError:
+        return None
+if sys.argv[1] == "stat":
+    print(json.dumps([stat(os.path.join(sys.argv[2], p)) for p in sys.argv[3:]]))
+    sys.exit(0)
+path = sys.argv[2]
+if path.endswith("/"):
+    root, top = path, ""
+else:
+    root, top = os.path.dirname(path) or ".", os.path.basename(path)
+tree = {"root": root, "dirs": [], "files": []}
+start = os.path.join(root, top)
+def add(rel):
+    tree["files"].append([rel] + stat(os.path.join(root, rel)))
+if not os.path.isdir(start) or os.path.islink(start):
+    add(top)
+else:
+    if top: tree["dirs"].append(top)
+    for walk_dir, dir_names, file_names in os.walk(start):
+        rel_dir = walk_dir[len(root):].lstrip("/")
+        for name in dir_names:
+            if os.path.islink(os.path.join(walk_dir, name)): add(os.path.join(rel_dir, name))
+            else: tree["dirs"].append(os.path.join(rel_dir, name))
+        for name in file_names:
+            add(os.path.join(rel_dir, name))
+print(json.dumps(tree))
+"""
+    
+    
+    def _rsync_cmd( self, local, remote='', reverse=False, rsync_path='rsync', options=None ):
+        """PRIVATE - Build the rsync command line for SSHRPC.rsync().
+        If reverse=True, local will be created as a directory, if it does not already exist.
+        
+        Operation
+        =========
+            @return: The rsync command line.
+            @rtype: list
+            @param rsync_path: Command to run rsync on the remote side, see rsync --rsync-path.
+            @type rsync_path: string
+            @param options: rsync options to use instead of -qar.
+            @type options: list
+        """
+        rsync_cmd = [ 'rsync' ]
+        rsync_cmd.extend( options or [ '-qar' ] )
+        rsync_cmd.append( '--rsync-path=%s' % rsync_path )
         rsync_cmd.extend( [ '-e', 'ssh %s' % " ".join( self.ssh_args ) ] )
         local_path = self.shesc( os.path.expanduser( local ) )
         if remote:
@@ -592,13 +3446,9 @@ class SSHRPC(object):
             rsync_cmd.extend( [ ':'.join( ( self.host, remote ) ) ] )
             rsync_cmd.extend( [ local_path ] )
         else:
-            self.execute( cmd='mkdir -p %s' % remote, pipes={} )
             rsync_cmd.extend( [ local_path ] )
             rsync_cmd.extend( [ ':'.join( ( self.host, remote ) ) ] )
-        self.logger.debug( "rsync_cmd=%s" % (rsync_cmd) )
-        if self._exec( rsync_cmd ) == 0: _return = True
-        self.logger.debug( "_return=%s" % (_return) )
-        return _return
+        return rsync_cmd
     
     
     def func_home( self ):
@@ -617,13 +3467,14 @@ class SSHRPC(object):
             @return: Home directory on success, empty string on failure.
             @rtype: string
         """
-        if self.home:
-            return self.home
+        if self._home:
+            return self._home
         else:
+            self.home = ''
             _std = {}
             if self.execute( '[ -d $HOME ] && echo $HOME', pipes=_std ) and _std['stdout']:
                 self.home = _std['stdout'].rstrip()
-        self.logger.debug( "self.home=%s" % (self.home,) )
+        self.logger.debug( "self.home=%s", self.home )
         return self.home
     
         
@@ -633,19 +3484,322 @@ class SSHRPC(object):
         return ( return_code, _std )
     
     
+    def _agent( self ):
+        """PRIVATE - Return our FSAgent, starting it if needed, or None if it won't start.
+        
+        Test
+        ====
+            >>> my_box = SSHRPC(agent=True)
+            >>> my_box.path_exists( '/' )
+            True
+            >>> my_box.path_stat( '/' )['isdir']
+            True
+            >>> my_box.fs_batch( [ ('exists', ['/']), ('listdir', ['/tacoburritosalsa']) ] )[1][0]
+            False
+        """
+        if self.agent and self.agent.start():
+            return self.agent
+        agent_cmd = [ 'ssh' ]
+        agent_cmd.extend( self.ssh_args )
+        agent_cmd.extend( [ self.host, "python -u -c 'import sys,base64;exec(base64.b64decode(sys.stdin.readline()))'" ] )
+        self.agent = FSAgent( agent_cmd, logger=self.logger )
+        self._spawned()
+        if self.agent.start():
+            return self.agent
+        self.logger.warn( "FSAgent would not start on %s, falling back to python -c", self.host )
+        self.agent = None
+        self.use_agent = False
+        return None
+    
+    
+    def fs_batch( self, requests ):
+        """Run a batch of filesystem operations on the remote host in one round trip, see FSAgent.
+        
+        Returns: (list) A (ok, value) tuple per request.
+        Required: requests
+            requests: (list) (op, args) tuples, e.g. [ ('exists', ['/tmp']), ('makedirs', ['foo/bar']) ]
+        """
+        agent = self._agent()
+        if not agent: raise Exception, "No FSAgent on %s" % self.host
+        return agent.batch( requests )
+    
+    
+    def _fs_call( self, op, *args ):
+        """PRIVATE - Run one FSAgent operation."""
+        agent = self._agent()
+        if not agent: raise Exception, "No FSAgent on %s" % self.host
+        return agent.call( op, *args )
+    
+    
     def path_exists( self, path ):
-        return eval(self.python( "print os.path.exists( '%s' )" % path )[1]['stdout'].rstrip())
+        if self.use_agent and self._agent():
+            return self._fs_call( 'exists', path )
+        return self.python( "print os.path.exists( '%s' )" % path )[1]['stdout'].rstrip() == 'True'
     
     
     def path_join( self, *args ):
+        # once we know what the remote python is, we don't have to ask it
+        if self._py_system != None:
+            return ( self._py_system == 'Windows' and ntpath or posixpath ).join( *args )
+        if self.use_agent and self._agent():
+            return self._fs_call( 'join', *args )
         # this was a lot harder to figure out than it looks...
         return self.python( "print os.path.join( '%s' )" % "','".join( args ) )[1]['stdout'].rstrip()
     
     
     def path_abspath( self, path ):
+        if self.use_agent and self._agent():
+            return self._fs_call( 'abspath', path )
         return self.python( "print os.path.abspath( '%s' )" % path )[1]['stdout'].rstrip()
     
+    
+    def path_stat( self, path ):
+        """Return a dict of size, mtime, mode and isdir for path, always uses our FSAgent."""
+        return self._fs_call( 'stat', path )
+    
+    
+    def path_listdir( self, path ):
+        """Return the sorted contents of the directory path, always uses our FSAgent."""
+        return self._fs_call( 'listdir', path )
+    
+    
+    def path_remove( self, path ):
+        """Remove the file, or the whole directory tree, at path, always uses our FSAgent."""
+        return self._fs_call( 'remove', path )
+    
+    
+    def path_rename( self, src, dest ):
+        """Rename src to dest, always uses our FSAgent."""
+        return self._fs_call( 'rename', src, dest )
+    
+    
+    def file_read( self, path, limit=-1 ):
+        """Return the contents (up to limit bytes) of the small file path, always uses our FSAgent."""
+        return base64.b64decode( self._fs_call( 'read', path, limit ) )
+    
+    
+    def file_write( self, path, data ):
+        """Replace the contents of the small file path with data, always uses our FSAgent."""
+        return self._fs_call( 'write', path, base64.b64encode( data ) )
+    
 
+    def put_bytes( self, data, dest, mode=None, compress=False, chunk_size=65536 ):
+        """Replace the file dest on the remote host with data, piped straight through ssh's stdin.
+        
+        Usage
+        =====
+        Returns: (int) Bytes written, raises Exception if dest couldn't be written.
+        Required: data, dest
+            data: (str) What to write, or anything else with the buffer interface (bytearray,
+                mmap, array, memoryview), which is sent chunk by chunk. Where memoryview takes
+                data (str, bytearray and memoryview on Python 2.7) the chunks aren't copied,
+                otherwise each is.
+            dest: (str) The file on the remote host.
+        Optional: mode, compress, chunk_size
+            mode: (int) Permissions to give dest, e.g. 0644. (default = None, the remote umask)
+            compress: (bool) gzip data on the way, for big compressible data on slow links. (default = False)
+            chunk_size: (int) Bytes written to ssh at once. (default = 65536)
+        
+        Notes
+        =====
+            dest is written to a temporary file next to it, checked (against the size of data,
+            or by gzip) and renamed into place, so it's never seen half written.
+        
+        Test
+        ====
+            >>> import tempfile
+            >>> my_box, my_file = SSHRPC(), tempfile.mktemp()
+            >>> my_box.put_bytes( 'hello', my_file, mode=0600 )
+            5
+            >>> open( my_file ).read(), oct( os.stat( my_file ).st_mode & 0777 )
+            ('hello', '0600')
+            >>> my_box.put_bytes( bytearray( 'x' * 100000 ), my_file, compress=True, chunk_size=4096 )
+            100000
+            >>> my_box.get_bytes( my_file, compress=True ) == 'x' * 100000
+            True
+            >>> my_box.put_bytes( memoryview( 'y' * 100000 ), my_file, compress=True, chunk_size=4096 )
+            100000
+            >>> my_box.get_bytes( my_file ) == 'y' * 100000
+            True
+        """
+        try:
+            # slicing a memoryview doesn't copy, slicing a buffer does
+            view = memoryview( data )
+        except (NameError, TypeError):
+            # Python 2.6, or only the old buffer interface (mmap, array)
+            view = buffer( data )
+        chunks = ( view[ i:i + chunk_size ] for i in xrange( 0, len( view ), chunk_size ) )
+        return self._put( chunks, dest, mode=mode, compress=compress, size=len( view ) )
+    
+    
+    def put_stream( self, source, dest, mode=None, compress=False, chunk_size=65536 ):
+        """Replace the file dest on the remote host with everything read from source, piped straight
+        through ssh's stdin chunk_size bytes at a time, see SSHRPC.put_bytes().
+        
+        Returns: (int) Bytes written, raises Exception if dest couldn't be written.
+        Required: source, dest
+            source: (file) Anything with a read( size ) method.
+        
+        Notes
+        =====
+            Without compress, dest is only checked against how much was read once all of it has been
+            sent, which takes a second round trip. With compress, gzip checks it on the way.
+        """
+        chunks = iter( lambda: source.read( chunk_size ), '' )
+        return self._put( chunks, dest, mode=mode, compress=compress )
+    
+    
+    def _put( self, chunks, dest, mode=None, compress=False, size=None ):
+        """PRIVATE - Pipe chunks into a temporary file next to dest, and rename it into place once it
+        checks out. See SSHRPC.put_bytes().
+        
+        Operation
+        =========
+            @return: Bytes written.
+            @rtype: int
+            @param size: How many bytes chunks add up to, None if we won't know until they're sent.
+            @type size: int
+        """
+        dest_dir, name = posixpath.split( dest )
+        tmp = self.shesc( posixpath.join( dest_dir, '.%s.sshrpc%08x' % (name, getrandbits( 32 )) ) )
+        finish = ''
+        if size != None and not compress:
+            finish += "[ `wc -c < %s` -eq %d ] && " % (tmp, size)
+        if mode != None:
+            finish += "chmod %o %s && " % (mode, tmp)
+        finish += "mv -f %s %s" % (tmp, self.shesc( dest ))
+        write = "mkdir -p %s && %s > %s" % (self.shesc( dest_dir or '.' ), compress and 'gzip -dc' or 'cat', tmp)
+        # with nothing checking what arrives, it's only renamed once we know how much we sent
+        checked = compress or size != None
+        if checked:
+            write += " && %s" % finish
+        cmd = "%s || { rm -f %s; exit 1; }" % (write, tmp)
+        self.logger.debug( "dest=%s mode=%s compress=%s size=%s", dest, mode, compress, size )
+        start_time, sent = now(), 0
+        try:
+            po = Popen( self._ssh_cmd( cmd )[0], stdin=PIPE, stdout=PIPE, stderr=PIPE )
+        except OSError as e:
+            raise Exception, "OSError running command '%s':%s" % (cmd,e)
+        self._spawned()
+        gzip = compress and zlib.compressobj( 6, zlib.DEFLATED, 16 + zlib.MAX_WBITS )
+        try:
+            for chunk in chunks:
+                sent += len( chunk )
+                # zlib takes neither memoryviews nor their slices
+                if gzip: chunk = gzip.compress( hasattr( chunk, 'tobytes' ) and chunk.tobytes() or chunk )
+                po.stdin.write( chunk )
+            if gzip:
+                po.stdin.write( gzip.flush() )
+        except IOError:
+            # the remote end went away, its exit code and stderr say why
+            self.logger.debug( "Non-fatal error writing to %s: %s", self.host, sys.exc_info() )
+        except:
+            # no telling what source had for us, make sure it's not renamed into place
+            po.kill()
+            po.wait()
+            self._execute( "rm -f %s" % tmp, pipes={} )
+            raise
+        _std = {}
+        _std['stdout'], _std['stderr'] = po.communicate()
+        return_code = self._saw( self._ran( start_time, None, po.returncode ) )
+        if return_code == 0 and not checked:
+            return_code = self._execute( "[ `wc -c < %s` -eq %d ] && %s || { rm -f %s; exit 1; }" % (tmp, sent, finish, tmp), pipes=_std )
+        if return_code != 0:
+            raise Exception, "Couldn't write %s on %s, return_code=%s: %s" % (dest,self.host,return_code,_std['stderr'].strip())
+        if self.metrics:
+            self.metrics.observe( 'transfer_bytes', sent, host=self.host )
+        return sent
+    
+    
+    def _pipe( self, cmd, data ):
+        """PRIVATE - Run cmd on the remote host with data on its stdin, for input too big for its
+        command line.
+        
+        Operation
+        =========
+            @return: Exit code of cmd, and (dict) of stdout/stderr.
+            @rtype: tuple (int, dict)
+        """
+        start_time = now()
+        try:
+            po = Popen( self._ssh_cmd( cmd )[0], stdin=PIPE, stdout=PIPE, stderr=PIPE )
+        except OSError as e:
+            raise Exception, "OSError running command '%s':%s" % (cmd,e)
+        self._spawned()
+        _std = {}
+        _std['stdout'], _std['stderr'] = po.communicate( data )
+        return self._saw( self._ran( start_time, _std, po.returncode ) ), _std
+    
+    
+    def get_bytes( self, path, compress=False, chunk_size=65536 ):
+        """Return the contents of the file path on the remote host, piped straight through ssh's stdout.
+        
+        Returns: (str) The contents, raises Exception if path couldn't be read.
+        Required: path
+        Optional: compress, chunk_size, see SSHRPC.get_stream().
+        
+        Test
+        ====
+            >>> import tempfile
+            >>> my_box, my_file = SSHRPC(), tempfile.mktemp()
+            >>> open( my_file, 'w' ).write( 'hello' )
+            >>> my_box.get_bytes( my_file )
+            'hello'
+            >>> my_box.get_bytes( '/tacoburritosalsa' ) # doctest: +ELLIPSIS
+            Traceback (most recent call last):
+            Exception: Couldn't read /tacoburritosalsa on localhost, return_code=1: ...
+        """
+        out = StringIO()
+        self.get_stream( path, out, compress=compress, chunk_size=chunk_size )
+        return out.getvalue()
+    
+    
+    def get_stream( self, path, dest, compress=False, chunk_size=65536 ):
+        """Write the contents of the file path on the remote host to dest as they arrive, piped
+        straight through ssh's stdout chunk_size bytes at a time.
+        
+        Usage
+        =====
+        Returns: (int) Bytes written to dest, raises Exception if path couldn't be read.
+        Required: path, dest
+            path: (str) The file on the remote host.
+            dest: (file) Anything with a write( data ) method.
+        Optional: compress, chunk_size
+            compress: (bool) gzip the contents on the way. (default = False)
+            chunk_size: (int) Most bytes read from ssh at once. (default = 65536)
+        """
+        cmd = "%s %s" % (compress and 'gzip -c' or 'cat', self.shesc( path ))
+        self.logger.debug( "path=%s compress=%s", path, compress )
+        start_time, received = now(), 0
+        try:
+            po = Popen( self._ssh_cmd( cmd )[0], stdout=PIPE, stderr=PIPE )
+        except OSError as e:
+            raise Exception, "OSError running command '%s':%s" % (cmd,e)
+        self._spawned()
+        gunzip = compress and zlib.decompressobj( 16 + zlib.MAX_WBITS )
+        # read stderr as it comes too, a remote that fills its pipe would never finish stdout
+        out_fd, err_fd = po.stdout.fileno(), po.stderr.fileno()
+        open_fds, errors = [ out_fd, err_fd ], []
+        while open_fds:
+            for fd in select( open_fds, [], [] )[0]:
+                chunk = os.read( fd, chunk_size )
+                if not chunk:
+                    open_fds.remove( fd )
+                elif fd == err_fd:
+                    errors.append( chunk )
+                else:
+                    if gunzip: chunk = gunzip.decompress( chunk )
+                    received += len( chunk )
+                    dest.write( chunk )
+        stderr = ''.join( errors )
+        return_code = self._saw( self._ran( start_time, None, po.wait() ) )
+        if return_code != 0:
+            raise Exception, "Couldn't read %s on %s, return_code=%s: %s" % (path,self.host,return_code,stderr.strip())
+        if self.metrics:
+            self.metrics.observe( 'transfer_bytes', received, host=self.host )
+        return received
+    
+    
     def file_copy( self, src, dest ):
         return self.execute( cmd="cp %s %s" % (src,dest) )    
     
@@ -654,36 +3808,242 @@ class SSHRPC(object):
         return self.execute( cmd="mv %s %s" % (src,dest) )
     
     
-    def file_retrieve( self, source, dest ):
-        import tempfile
-        import urllib
-        fileName    = source.split('/')[-1]
-        tmpDir      = tempfile.mkdtemp()
-        tmpFile     = os.path.join( tmpDir, fileName )
-        urllib.urlretrieve( source, tmpFile )
-        self.rsync( local=tmpFile, remote=dest )
-        remoteFile = self.path_join( dest, fileName )
-        if not self.path_exists( remoteFile ):
-            raise Exception, "Destination file %s doesn't exist on %s" % (finalDest,self.host)
-        return remoteFile
+    def file_retrieve( self, source, dest, cache=None, remote_cache='', direct=False, sha1='' ):
+        """Download source (a URL) through our ArtifactCache and put it in dest on the remote host,
+        or with direct=True have the remote host download it itself.
+        
+        Usage
+        =====
+        Returns: (str) Path of the file on the remote host, raises Exception if it isn't there.
+        Required: source, dest
+            source: (str) URL of the file.
+            dest: (str) Directory on the remote host to put it in.
+        Optional: cache, remote_cache, direct, sha1
+            cache: (ArtifactCache) Where downloads are kept. (default = ArtifactCache.shared())
+            remote_cache: (str) see SSHRPC.push_artifact().
+            direct: (bool) Try having the remote host fetch source (with curl, wget or python,
+                whichever it has) so it never goes through us. (default = False)
+            sha1: (str) What source's sha1 must be, raises Exception if it isn't.
+        
+        Notes
+        =====
+            A direct fetch is checked against sha1, or if that isn't given, against the sha1 our
+            cache has for source as long as the server says it hasn't changed since. If there's
+            nothing to check against, or the direct fetch fails, source is downloaded here and
+            pushed instead (after which the cache has a sha1 for next time).
+        
+        Test
+        ====
+            >>> import tempfile, threading, SimpleHTTPServer, SocketServer
+            >>> my_dir, my_dest = tempfile.mkdtemp(), tempfile.mktemp()
+            >>> open( os.path.join( my_dir, 'pkg.tgz' ), 'w' ).write( 'hello' )
+            >>> class Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+            ...     def translate_path( self, path ): return os.path.join( my_dir, path.lstrip( '/' ) )
+            ...     def log_message( self, *args ): pass
+            >>> server = SocketServer.TCPServer( ( '127.0.0.1', 0 ), Handler )
+            >>> server_thread = threading.Thread( target=server.serve_forever )
+            >>> server_thread.setDaemon( True )
+            >>> server_thread.start()
+            >>> url = 'http://127.0.0.1:%d/pkg.tgz' % server.server_address[1]
+            >>> my_box = SSHRPC()
+            >>> my_box.file_retrieve( url, my_dest, direct=True, sha1='aaf4c61ddcc5e8a2dabede0f3b482cd9aea9434d' )[ len( my_dest ): ]
+            '/pkg.tgz'
+            >>> open( os.path.join( my_dest, 'pkg.tgz' ) ).read()
+            'hello'
+            >>> my_box.file_retrieve( url, my_dest, direct=True, sha1='0' * 40 ) # doctest: +ELLIPSIS
+            Traceback (most recent call last):
+            Exception: sha1 of http://127.0.0.1:.../pkg.tgz is aaf4c61ddcc5e8a2dabede0f3b482cd9aea9434d, expected 0000000000000000000000000000000000000000
+            >>> server.shutdown()
+        """
+        cache = cache or ArtifactCache.shared()
+        name = source.split('/')[-1]
+        if direct:
+            expected = sha1 or cache.known_sha1( source )
+            if expected:
+                remote_file = self._fetch_direct( source, dest, name, expected, remote_cache )
+                if remote_file: return remote_file
+            self.logger.debug( "direct fetch of %s on %s didn't work out, relaying it", source, self.host )
+        path, fetched = cache.fetch( source )
+        if sha1 and fetched != sha1:
+            raise Exception, "sha1 of %s is %s, expected %s" % (source,fetched,sha1)
+        return self.push_artifact( path, dest, name=name, sha1=fetched, remote_cache=remote_cache )
+    
+    
+    def _fetch_direct( self, source, dest, name, sha1, remote_cache='' ):
+        """PRIVATE - Have the remote host download source into dest/name, checking it against sha1,
+        all in one round trip. See SSHRPC.file_retrieve().
+        
+        Operation
+        =========
+            @return: Path of the file on the remote host, empty string if it couldn't be done.
+            @rtype: string
+        """
+        quote = self._quote
+        tools = self._fetchers
+        if tools == None: tools = [ 'curl', 'wget', 'python' ]
+        script = "url=%s; dest=%s; name=%s; sum=%s; cache=%s; tools='%s'\n%s" % (quote( source ), quote( dest ), quote( name ),
+            quote( sha1 ), quote( remote_cache ), ' '.join( tools ), self.FETCH_SCRIPT)
+        _std = {}
+        return_code = self._execute( "sh -c %s" % quote( script ), pipes=_std )
+        self.logger.debug( "return_code=%s stdout=%s", return_code, _Capped( _std.get( 'stdout', '' ) ) )
+        if return_code != 0:
+            return ''
+        return self.path_join( dest, name )
+    
+    
+    # fetch $url into $dest/$name with the first of $tools that works, if its sha1 is $sum,
+    # using (and filling) $cache if it's set. exits 2: no dest, 3: sha1 mismatch, 4: no tool worked
+    FETCH_SCRIPT = '''
+        tmp="$dest/.$name.$$"
+        mkdir -p "$dest" || exit 2
+        if [ -n "$cache" ] && [ -f "$cache/$sum" ]; then
+            cp "$cache/$sum" "$tmp" && mv -f "$tmp" "$dest/$name" && echo "cached" && exit 0
+        fi
+        got=
+        for tool in $tools; do
+            case $tool in
+                curl) curl -fsSL -o "$tmp" "$url" ;;
+                wget) wget -q -O "$tmp" "$url" ;;
+                python) python -c "import sys,shutil;m=__import__(sys.version_info[0]>2 and \\"urllib.request\\" or \\"urllib2\\",fromlist=[\\"urlopen\\"]);shutil.copyfileobj(m.urlopen(sys.argv[1]),open(sys.argv[2],\\"wb\\"),1048576)" "$url" "$tmp" ;;
+                *) false ;;
+            esac 2>/dev/null && got=$tool && break
+            rm -f "$tmp"
+        done
+        [ -n "$got" ] || exit 4
+        actual=`( sha1sum "$tmp" || shasum "$tmp" || openssl sha1 -r "$tmp" ) 2>/dev/null | awk '{print $1}'`
+        if [ "$actual" != "$sum" ]; then rm -f "$tmp"; echo "sha1 $actual"; exit 3; fi
+        mv -f "$tmp" "$dest/$name" || exit 2
+        if [ -n "$cache" ]; then
+            mkdir -p "$cache" && cp "$dest/$name" "$cache/.$sum.$$" && mv -f "$cache/.$sum.$$" "$cache/$sum"
+        fi
+        echo "fetched $got"
+    '''
+    
+    
+    def push_artifact( self, local, dest, name='', sha1='', remote_cache='' ):
+        """Put the local file in dest on the remote host, skipping the transfer if the host's
+        remote_cache already has a file with the same sha1.
+        
+        Usage
+        =====
+        Returns: (str) Path of the file on the remote host, raises Exception if it isn't there.
+        Required: local, dest
+            local: (str) The file to push.
+            dest: (str) Directory on the remote host to put it in.
+        Optional: name, sha1, remote_cache
+            name: (str) Name to give the file in dest. (default = local's name)
+            sha1: (str) sha1 of local, if we already know it.
+            remote_cache: (str) Directory on the remote host keeping a copy of everything pushed,
+                named by sha1. (default = '', no remote cache)
+        
+        Test
+        ====
+            >>> import tempfile
+            >>> my_box = SSHRPC()
+            >>> my_file, my_dest, my_cache = tempfile.mktemp(), tempfile.mktemp(), tempfile.mktemp()
+            >>> open( my_file, 'w' ).write( 'hello' )
+            >>> my_box.push_artifact( my_file, my_dest, name='hello.txt', remote_cache=my_cache ) == os.path.join( my_dest, 'hello.txt' )
+            True
+            >>> os.listdir( my_cache )
+            ['aaf4c61ddcc5e8a2dabede0f3b482cd9aea9434d']
+            >>> open( os.path.join( my_cache, 'aaf4c61ddcc5e8a2dabede0f3b482cd9aea9434d' ), 'w' ).write( 'corrupt' )
+            >>> my_box.push_artifact( my_file, my_dest, name='hello.txt', remote_cache=my_cache ) and open( os.path.join( my_dest, 'hello.txt' ) ).read()
+            'hello'
+        """
+        name = name or os.path.basename( local )
+        remote_file = self.path_join( dest, name )
+        _std = {}
+        if remote_cache:
+            if not sha1:
+                digest, f = hashlib.sha1(), open( local, 'rb' )
+                try:
+                    for chunk in iter( lambda: f.read( 1048576 ), '' ):
+                        digest.update( chunk )
+                finally:
+                    f.close()
+                sha1 = digest.hexdigest()
+            cached = self.shesc( self.path_join( remote_cache, sha1 ) )
+            # one round trip: if the host has it, and its sha1 checks out, copy it into place (atomically) and say so
+            have = "`( sha1sum %s || shasum %s || openssl sha1 -r %s ) 2>/dev/null | awk '{print $1}'`" % (cached, cached, cached)
+            self.execute( "if [ -f %s ] && [ \"%s\" = %s ]; then mkdir -p %s && cp %s %s.$$ && mv -f %s.$$ %s && echo hit; fi" % (
+                cached, have, sha1, self.shesc( dest ), cached, self.shesc( remote_file ), self.shesc( remote_file ), self.shesc( remote_file )), pipes=_std )
+            if _std['stdout'].strip() == 'hit':
+                self.logger.debug( "sha1=%s found in remote_cache=%s", sha1, remote_cache )
+                return remote_file
+        rsync_cmd = self._rsync_cmd( local, remote=remote_file, rsync_path='mkdir -p %s && rsync' % self.shesc( dest ) )
+        self.logger.debug( "rsync_cmd=%s", rsync_cmd )
+        self._exec( rsync_cmd )
+        check = "[ -f %s ]" % self.shesc( remote_file )
+        if remote_cache:
+            check += " && mkdir -p %s && cp %s %s.$$ && mv -f %s.$$ %s" % (self.shesc( remote_cache ), self.shesc( remote_file ), cached, cached, cached)
+        if self._execute( check, pipes=_std ) != 0:
+            raise Exception, "Destination file %s doesn't exist on %s" % (remote_file,self.host)
+        return remote_file
+    
+    
+    def batch( self ):
+        """Return a new Batch, to queue operations and run them all in one round trip.
+        
+        Example
+        =======
+            with my_box.batch() as b:
+                there = b.path_exists( '/tmp/foo' )
+                b.file_move( '/tmp/foo', '/tmp/bar', requires=there )
+        """
+        return Batch( self )
     
     
     def safe_remove( self, path ):
+        """Move path out of the way, remove it, and make sure it's gone, all in one round trip.
+        
+        Returns: (bool) True if neither path nor path_RM exist afterwards.
+        """
         rm_path = "_".join( ( path,'RM' ) )
-        if self.path_exists( path ):
-            self.file_move( src=path, dest=rm_path )
-        if self.path_exists( rm_path ):
-            self.execute( "rm -rf %s" % rm_path, pipes={} )
-        if not self.path_exists( path ) and not self.path_exists( rm_path ):
+        b = self.batch()
+        exists = b.path_exists( path )
+        b.file_move( src=path, dest=rm_path, requires=exists )
+        rm_exists = b.path_exists( rm_path )
+        b.execute( "rm -rf %s" % rm_path, requires=rm_exists )
+        gone = b.path_exists( path )
+        rm_gone = b.path_exists( rm_path )
+        b.flush()
+        if not gone.value and not rm_gone.value:
             return True
         else:
             return False
     
     
     def os_makedirs( self, path ):
+        if self.use_agent and self._agent():
+            self._fs_call( 'makedirs', path )
+            return ( True, {'stdout': '', 'stderr': ''} )
         return self.python( program="os.makedirs( '%s' )" % path )
     
 
+def _instrument( cls ):
+    """PRIVATE - Wrap every public method of cls so Metrics knows which one is running, and how long it took."""
+    def instrumented( name, func ):
+        @wraps( func )
+        def method( self, *args, **kwargs ):
+            metrics = self.metrics
+            if not metrics:
+                return func( self, *args, **kwargs )
+            metrics.enter( name )
+            start_time = now()
+            try:
+                return func( self, *args, **kwargs )
+            finally:
+                metrics.leave()
+                metrics.observe( 'call', now() - start_time, host=self.host, method=name )
+        return method
+    for name, value in cls.__dict__.items():
+        if not name.startswith( '_' ) and isinstance( value, types.FunctionType ):
+            setattr( cls, name, instrumented( name, value ) )
+    return cls
+
+_instrument( SSHRPC )
+
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
@@ -0,0 +1,513 @@
+#!/usr/bin/env python2.6
+# encoding: utf-8
+"""asyncrpc - Non-blocking SSHRPC, every remote operation returns a Future right away.
+
+Usage
+=====
+    from sshrpc.asyncrpc import AsyncSSHRPC
+    boxes = [ AsyncSSHRPC( host=host ) for host in hosts ]
+    futures = [ box.execute( 'uptime', pipes={} ) for box in boxes ]
+    print [ future.result() for future in futures ]
+
+    See help(AsyncSSHRPC).
+
+Notes
+=====
+    SSHRPC targets python 2.6, which has no asyncio, so AsyncSSHRPC is built on its own
+    Future and a single Reactor thread that select()s over every ssh process in flight. An
+    event loop can wait on a Future from a thread pool, or be woken by add_done_callback().
+"""
+
+import os
+import sys
+import types
+import signal
+import logging
+import threading
+
+from select import select
+from subprocess import Popen, PIPE
+from time import time as now
+
+from sshrpc import SSHRPC, Batch, CommandTimeout, _new_session
+
+
+class CancelledError(Exception):
+    """Raised by Future.result() when the Future was cancelled."""
+    pass
+
+
+class Future(object):
+    """The result of an operation that hasn't finished yet.
+
+    Description
+    ===========
+        result() waits for the operation and returns its value (or raises its exception),
+        add_done_callback() calls a function with the Future once it's done, then() chains a
+        function onto the value and returns a new Future for its result.
+    """
+
+    def __init__( self, canceller=None ):
+        self.canceller = canceller
+        self.condition = threading.Condition()
+        self.callbacks = []
+        self.finished  = False
+        self.cancelled = False
+        self.value     = None
+        self.error     = None
+
+
+    def done( self ):
+        return self.finished
+
+
+    def _finish( self, value=None, error=None ):
+        """PRIVATE - Settle the Future, the first caller wins."""
+        self.condition.acquire()
+        try:
+            if self.finished:
+                return False
+            self.value, self.error, self.finished = value, error, True
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+        for callback in self.callbacks:
+            callback( self )
+        return True
+
+
+    def set_result( self, value ):
+        return self._finish( value=value )
+
+
+    def set_exception( self, error ):
+        return self._finish( error=error )
+
+
+    def cancel( self ):
+        """Cancel the operation (killing whatever is running it).
+
+        Returns: (bool) True if it was cancelled, False if it had already finished.
+        """
+        if self.finished:
+            return False
+        self.cancelled = True
+        if self.canceller:
+            self.canceller()
+        # the canceller may already have settled us through a then() chain
+        self._finish( error=CancelledError() )
+        return True
+
+
+    def result( self, timeout=None ):
+        """Wait up to timeout seconds (forever by default) for the operation, and return its value."""
+        self.condition.acquire()
+        try:
+            if not self.finished:
+                self.condition.wait( timeout )
+            if not self.finished:
+                raise Exception, "Future did not finish within %s seconds." % timeout
+        finally:
+            self.condition.release()
+        if self.error:
+            raise self.error
+        return self.value
+
+
+    def exception( self, timeout=None ):
+        try:
+            self.result( timeout )
+        except:
+            return sys.exc_info()[1]
+        return None
+
+
+    def add_done_callback( self, callback ):
+        self.condition.acquire()
+        try:
+            if not self.finished:
+                self.callbacks.append( callback )
+                return
+        finally:
+            self.condition.release()
+        callback( self )
+
+
+    def then( self, func ):
+        """Return a new Future for func(value), once this one has a value.
+        Exceptions (and cancellation) flow through to the new Future, cancelling it cancels this one.
+        """
+        chained = Future( canceller=self.cancel )
+        def done( future ):
+            if future.error:
+                chained.set_exception( future.error )
+                return
+            try:
+                chained.set_result( func( future.value ) )
+            except:
+                chained.set_exception( sys.exc_info()[1] )
+        self.add_done_callback( done )
+        return chained
+
+
+class Reactor(object):
+    """A single thread that runs any number of local processes at once with a select() loop.
+
+    Description
+    ===========
+        spawn() starts a process and returns a Future for its (return_code, stdout, stderr).
+        Processes get their own process group, so cancelling the Future (or hitting timeout)
+        kills everything the process started. One Reactor is shared by every AsyncSSHRPC
+        unless you hand them your own.
+    """
+    logger = logging.getLogger( 'SSHRPC' )
+    default = None
+
+    def __init__( self ):
+        self.lock    = threading.Lock()
+        self.running = {}  # fd -> state, both of a process's fds map to the same state
+        self.wake_r, self.wake_w = os.pipe()
+        self.thread  = None
+
+
+    @classmethod
+    def shared( cls ):
+        """Return the process-wide Reactor, creating it on first use."""
+        if cls.default == None:
+            cls.default = cls()
+        return cls.default
+
+
+    def start( self ):
+        self.lock.acquire()
+        try:
+            if self.thread and self.thread.isAlive():
+                return True
+            self.thread = threading.Thread( target=self.loop, name='SSHRPC-Reactor' )
+            self.thread.setDaemon( True )
+            self.thread.start()
+        finally:
+            self.lock.release()
+        return True
+
+
+    def spawn( self, cmd, timeout=0 ):
+        """Start cmd (list) and return a Future for (return_code, stdout, stderr).
+        return_code is a CommandTimeout if cmd ran longer than timeout seconds.
+        """
+        self.start()
+        self.logger.debug( "cmd=%s timeout=%s", cmd, timeout )
+        start_time = now()
+        # its own process group (where there's setsid), so kill() takes down everything it started
+        po = Popen( _new_session( cmd )[0], stdout=PIPE, stderr=PIPE )
+        future = Future( canceller=lambda: self.kill( po ) )
+        # AsyncSSHRPC peeks at what has been read so far when cancelling
+        future.po, future.chunks = po, { po.stdout.fileno(): [], po.stderr.fileno(): [] }
+        state = { 'po': po, 'future': future, 'start_time': start_time, 'timeout': timeout,
+                  'deadline': timeout > 0 and start_time + timeout or None, 'timed_out': False,
+                  'chunks': future.chunks }
+        self.lock.acquire()
+        try:
+            for fd in state['chunks']:
+                self.running[ fd ] = state
+        finally:
+            self.lock.release()
+        os.write( self.wake_w, '.' )
+        return future
+
+
+    def kill( self, po ):
+        """Kill po and its process group (just po without setsid), the Reactor reaps it."""
+        try:
+            if os.getpgid( po.pid ) == po.pid:
+                os.killpg( po.pid, signal.SIGKILL )
+            else:
+                os.kill( po.pid, signal.SIGKILL )
+        except OSError:
+            pass
+
+
+    def loop( self ):
+        """PRIVATE - The select() loop, runs in our thread."""
+        while True:
+            self.lock.acquire()
+            try:
+                fds = self.running.keys()
+                deadlines = [ state['deadline'] for state in self.running.values() if state['deadline'] and not state['timed_out'] ]
+            finally:
+                self.lock.release()
+            wait = deadlines and max( min( deadlines ) - now(), 0 ) or None
+            ready = select( fds + [ self.wake_r ], [], [], wait )[0]
+            for fd in ready:
+                if fd == self.wake_r:
+                    os.read( self.wake_r, 4096 )
+                    continue
+                state = self.running[ fd ]
+                chunk = os.read( fd, 65536 )
+                if chunk:
+                    state['chunks'][ fd ].append( chunk )
+                    continue
+                self.lock.acquire()
+                try:
+                    del self.running[ fd ]
+                    if [ f for f in state['chunks'] if f in self.running ]:
+                        continue
+                finally:
+                    self.lock.release()
+                self.finish( state )
+            for state in self.running.values():
+                if state['deadline'] and not state['timed_out'] and now() >= state['deadline']:
+                    self.logger.debug( "timeout=%s hit for %s", state['timeout'], state['po'].pid )
+                    state['timed_out'] = True
+                    self.kill( state['po'] )
+
+
+    def finish( self, state ):
+        """PRIVATE - Reap a process whose pipes are both closed, and settle its Future."""
+        po, chunks = state['po'], state['chunks']
+        return_code = po.wait()
+        if state['timed_out']:
+            return_code = CommandTimeout( state['timeout'], now() - state['start_time'] )
+        try:
+            state['future'].set_result( ( return_code, ''.join( chunks[ po.stdout.fileno() ] ),
+                                          ''.join( chunks[ po.stderr.fileno() ] ) ) )
+        except:
+            self.logger.debug( "Non-fatal error in a done callback: %s", sys.exc_info() )
+
+
+class AsyncSSHRPC(SSHRPC):
+    """SSHRPC whose remote operations return a Future instead of blocking.
+
+    Description
+    ===========
+        execute(), python(), rsync(), uname(), func_platform(), func_probe(), path_exists(),
+        safe_remove() and connect() all return a Future right away, and their ssh processes are
+        run by a shared Reactor, so one controller can have thousands of them in flight.
+        Every other SSHRPC method (path_join(), batch(), file_retrieve() and so on) blocks and
+        returns what it does on SSHRPC, it runs on a plain SSHRPC sharing our connection and
+        host facts. Host facts are lazy (see SSHRPC(lazy=True)) and reading one blocks too,
+        use func_probe() to discover them without blocking.
+        Truth testing blocks, but only when the connection's health is stale, see
+        SSHRPC.is_alive().
+
+    Cancellation
+    ============
+        Cancelling a Future from execute() kills the local ssh and then kills the remote command
+        (and its children) too, by the pid the command reported when it started.
+
+    Test
+    ====
+        >>> my_box = AsyncSSHRPC()
+        >>> my_pipes = {}
+        >>> future = my_box.execute( 'echo -n hi', pipes=my_pipes )
+        >>> future.result(), my_pipes['stdout']
+        (True, 'hi')
+        >>> my_box.path_exists( '/' ).result()
+        True
+        >>> future = my_box.execute( 'sleep 60' )
+        >>> future.cancel()
+        True
+        >>> my_box.home == SSHRPC().home, my_box.distro == SSHRPC().distro
+        (True, True)
+        >>> my_box.platform == SSHRPC().platform
+        True
+        >>> AsyncSSHRPC().path_join( 'a', 'b' )
+        'a/b'
+        >>> b = my_box.batch()
+        >>> hi = b.execute( 'echo hi' )
+        >>> b.flush()[0].stdout
+        'hi\\n'
+    """
+    PID_MARKER = 'SSHRPC_PID'
+
+    def __init__( self, host='localhost', login='', identity='', reactor=None, **kwargs ):
+        self.reactor = reactor or Reactor.shared()
+        kwargs['lazy'] = True
+        SSHRPC.__init__( self, host=host, login=login, identity=identity, **kwargs )
+
+
+    def connect( self ):
+        """Connect to the host via SSH, see SSHRPC.connect().
+
+        Returns: (Future) for True if the connection can be established, False if it can't.
+        """
+        if self.master:
+            # starting a master forks into the background, there's nothing to wait for
+            return self._done( SSHRPC.connect( self ) )
+        test_ssh = [ 'ssh' ]
+        test_ssh.extend( self.ssh_args )
+        test_ssh.extend( [ self.host, 'true' ] )
+        return self.reactor.spawn( test_ssh ).then( lambda result: self._health( result[0] == 0 ) )
+
+
+    def _done( self, value ):
+        """PRIVATE - A Future that already has its value."""
+        future = Future()
+        future.set_result( value )
+        return future
+
+
+    def _spawn( self, cmd, dir='', env={}, ssh_args='', timeout=0 ):
+        """PRIVATE - Start cmd on the remote host.
+
+        Returns: (Future) for (return_code, stdout, stderr), cancelling it kills the remote command.
+        """
+        # have the remote side tell us who it is first, so cancelling can find it
+        cmd = "echo %s $$ >&2; exec ${SHELL:-/bin/sh} -c '%s'" % (self.PID_MARKER, self._ssh_cmd( cmd, dir=dir, env=env )[1].replace( "'", "'\\''" ))
+        ssh_cmd = [ 'ssh' ]
+        ssh_cmd.extend( self.ssh_args )
+        ssh_cmd.extend( ssh_args )
+        ssh_cmd.extend( [ self.host, cmd ] )
+        spawned = self.reactor.spawn( ssh_cmd, timeout=timeout )
+
+        def strip_pid( result ):
+            return_code, stdout, stderr = result
+            first, rest = ( stderr.split( '\n', 1 ) + [ '' ] )[:2]
+            if first.startswith( self.PID_MARKER + ' ' ):
+                stderr = rest
+            return ( return_code, stdout, stderr )
+
+        future = spawned.then( strip_pid )
+        future.canceller = lambda: self._cancel( spawned )
+        return future
+
+
+    def _cancel( self, spawned ):
+        """PRIVATE - Kill the remote command spawned is running, and then the local ssh."""
+        stderr = ''.join( spawned.chunks[ spawned.po.stderr.fileno() ] )
+        if stderr.startswith( self.PID_MARKER + ' ' ):
+            pid = int( stderr.split( '\n' )[0].split()[1] )
+            kill_cmd = [ 'ssh' ]
+            kill_cmd.extend( self.ssh_args )
+            kill_cmd.extend( [ self.host, 'pkill -TERM -P %d; kill -TERM %d' % (pid,pid) ] )
+            self.logger.debug( "kill_cmd=%s", kill_cmd )
+            self.reactor.spawn( kill_cmd )
+        return spawned.cancel()
+
+
+    def _execute( self, cmd, dir='', pipes={}, env={}, ssh_args='', timeout=0 ):
+        """PRIVATE - Run cmd on the remote host without checking the result.
+
+        Returns: (Future) for the exit code of cmd, pipes is populated once it's done.
+        """
+        def done( result ):
+            if pipes != None:
+                pipes['stdout'], pipes['stderr'] = result[1], result[2]
+            return self._saw( result[0] )
+        return self._spawn( cmd, dir=dir, env=env, ssh_args=ssh_args, timeout=timeout ).then( done )
+
+
+    def execute( self, cmd, dir='', pipes={}, env={}, ssh_args='', expected_return=0, timeout=0 ):
+        """Execute a command on the remote host, see SSHRPC.execute().
+
+        Returns: (Future) for True, or raising Exception if cmd didn't return expected_return.
+            pipes is populated once the Future is done.
+        """
+        self.logger.debug( "cmd=%r dir=%s env=%r expected_return=%s", cmd, dir, env, expected_return )
+        def check( result ):
+            if result == expected_return:
+                return True
+            elif isinstance( result, CommandTimeout ):
+                raise Exception, "Command timed out. result=%s cmd='%s'" % (result,cmd)
+            else:
+                raise Exception, "Command did not return %s. result=%s cmd='%s'" % (expected_return,result,cmd)
+        return self._execute( cmd, dir=dir, pipes=pipes, env=env, ssh_args=ssh_args, timeout=timeout ).then( check )
+
+
+    def python( self, program ):
+        """Returns: (Future) for (return_code, pipes), see SSHRPC.python()."""
+        _std = {}
+        return self.execute( cmd='python -c "import os,sys;%s"' % program, pipes=_std ).then( lambda return_code: ( return_code, _std ) )
+
+
+    def uname( self, options='-a' ):
+        """Returns: (Future) for the uname output, see SSHRPC.uname()."""
+        _std = {}
+        return self.execute( cmd='uname %s' % (options), pipes=_std ).then( lambda return_code: _std['stdout'].rstrip() )
+
+
+    def func_probe( self ):
+        """Returns: (Future) for the facts dict, see SSHRPC.func_probe()."""
+        _std = {}
+        return self.execute( cmd=self.PROBE_CMD, pipes=_std ).then( lambda return_code: self._apply_probe( _std['stdout'] ) )
+
+
+    def func_platform( self ):
+        """Returns: (Future) for the platform dict, see SSHRPC.func_platform().
+        Discovers every host fact in the same round trip, via func_probe().
+        """
+        if self._platform != None and self._py_platform != None:
+            return self._done( self._platform )
+        return self.func_probe().then( lambda facts: self.platform )
+
+
+    def path_exists( self, path ):
+        """Returns: (Future) for True if path exists on the remote host."""
+        _std = {}
+        return self._execute( cmd='[ -e %s ]' % path, pipes=_std ).then( lambda return_code: return_code == 0 )
+
+
+    def rsync( self, local, remote='', reverse=False ):
+        """Returns: (Future) for True on success, see SSHRPC.rsync().
+        Creates remote as part of the rsync itself, rather than with a separate round trip.
+        """
+        if reverse:
+            rsync_cmd = self._rsync_cmd( local, remote=remote, reverse=True )
+        else:
+            rsync_cmd = self._rsync_cmd( local, remote=remote, rsync_path='mkdir -p %s && rsync' % self.shesc( remote or '.' ) )
+        self.logger.debug( "rsync_cmd=%s", rsync_cmd )
+        return self.reactor.spawn( rsync_cmd ).then( lambda result: result[0] == 0 )
+
+
+    def safe_remove( self, path ):
+        """Returns: (Future) for True if path is gone, see SSHRPC.safe_remove()."""
+        rm_path = "_".join( ( path,'RM' ) )
+        b = Batch( self )
+        exists = b.path_exists( path )
+        b.file_move( src=path, dest=rm_path, requires=exists )
+        rm_exists = b.path_exists( rm_path )
+        b.execute( "rm -rf %s" % rm_path, requires=rm_exists )
+        gone = b.path_exists( path )
+        rm_gone = b.path_exists( rm_path )
+        cmd, marker = b.command()
+        _std = {}
+        def done( result ):
+            b.parse( marker, result, _std )
+            return not gone.value and not rm_gone.value
+        return self._execute( cmd, pipes=_std ).then( done )
+
+
+class _Blocking(SSHRPC):
+    """PRIVATE - A plain SSHRPC that shares an AsyncSSHRPC's connection and host facts, so
+    SSHRPC's own methods block and return what they always have.
+    """
+
+    def __init__( self, box ):
+        self.__dict__ = box.__dict__
+
+
+    def __del__( self ):
+        # the AsyncSSHRPC owns the connection
+        pass
+
+
+def _blocking( name ):
+    """PRIVATE - Build an AsyncSSHRPC method that runs SSHRPC's name() on a _Blocking."""
+    def method( self, *args, **kwargs ):
+        return getattr( _Blocking( self ), name )( *args, **kwargs )
+    method.__name__ = name
+    method.__doc__  = "Blocks, see SSHRPC.%s()." % name
+    return method
+
+# the keepalive thread holds on to the box it was started for, shesc() doesn't go to the host
+for name, value in SSHRPC.__dict__.items():
+    if isinstance( value, types.FunctionType ) and not name in AsyncSSHRPC.__dict__ and \
+       ( not name.startswith( '_' ) or name == '_probe_fact' ) and \
+       not name in ( 'shesc', 'start_keepalive', 'stop_keepalive' ):
+        setattr( AsyncSSHRPC, name, _blocking( name ) )
+del name, value
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,565 @@
+#!/usr/bin/env python2.6
+# encoding: utf-8
+"""bench - Timings of SSHRPC operations against a host, a throwaway local sshd or a fake one.
+
+Usage
+=====
+    With sshrpc on your PYTHONPATH:
+
+    python -m sshrpc.bench [--iterations 100] [--json results.json] [host]
+
+    Without a host the benchmarks run against a throwaway sshd on 127.0.0.1 (see LocalSSHD),
+    or against FakeSSHRPC if there's no sshd to run (or with --fake). --json writes the results,
+    with the transport, python and platform they came from, for comparing runs by machine.
+
+Notes
+=====
+    These are wall-clock numbers from a single run, compare them on the same box only.
+"""
+
+import os
+import sys
+import json
+import math
+import shutil
+import signal
+import socket
+import logging
+import threading
+import subprocess
+
+from optparse import OptionParser
+from subprocess import Popen
+from tempfile import mkdtemp
+from time import sleep, time as now
+
+from sshrpc import SSHRPC, SSHChannel, __version__
+from sshrpc.pool import SSHRPCPool, EventPool
+from sshrpc.scheduler import HostScheduler
+
+
+class FakeSSHRPC(SSHRPC):
+    """Stand-in for SSHRPC that runs every command locally through sh, in our home directory,
+    after sleeping for latency seconds to play the part of the network and the SSH handshake.
+    Host facts are probed (lazily) like on a real host, against this box.
+    """
+    latency = 0.05
+
+    def __init__( self, host='localhost', **kwargs ):
+        kwargs.setdefault( 'identity', os.devnull )
+        kwargs.setdefault( 'lazy', True )
+        SSHRPC.__init__( self, host=host, **kwargs )
+
+
+    def _setup_ssh( self ):
+        return []
+
+
+    def connect( self ):
+        return self._health( True )
+
+
+    def _ssh_cmd( self, cmd, dir='', env={}, ssh_args='' ):
+        cmd = SSHRPC._ssh_cmd( self, cmd, dir=dir, env=env, ssh_args=ssh_args )[1]
+        return ( [ 'sh', '-c', 'cd && sleep %s; %s' % (self.latency, cmd) ], cmd )
+
+
+    def _channel_exec( self, cmd, pipes={}, timeout=0 ):
+        if not self.channel:
+            self.channel = SSHChannel( [ 'sh', '-c', 'cd && sleep %s; exec /bin/sh' % self.latency ], logger=self.logger )
+        return SSHRPC._channel_exec( self, cmd, pipes=pipes, timeout=timeout )
+
+
+    def _rsync_cmd( self, local, remote='', reverse=False, rsync_path='rsync', options=None ):
+        # a local rsync, with the remote side in our home directory
+        rsync_cmd = SSHRPC._rsync_cmd( self, local, remote=remote, reverse=reverse, rsync_path=rsync_path, options=options )
+        i = rsync_cmd.index( '-e' )
+        del rsync_cmd[ i:i + 2 ]
+        host = self.host + ':'
+        return [ arg.startswith( host ) and os.path.join( os.path.expanduser( '~' ), arg[ len( host ): ] ) or arg for arg in rsync_cmd ]
+
+
+class PortSSHRPC(SSHRPC):
+    """SSHRPC to an sshd on a port other than 22, that doesn't remember host keys (see LocalSSHD).
+    With an address, host is only a name and every one of them connects to address.
+    """
+
+    def __init__( self, host='localhost', port=22, address='', **kwargs ):
+        self.port    = port
+        self.address = address
+        SSHRPC.__init__( self, host=host, **kwargs )
+
+
+    def _setup_ssh( self ):
+        ssh_args = SSHRPC._setup_ssh( self )
+        ssh_args.extend( [ '-p', str( self.port ), '-o', 'UserKnownHostsFile=/dev/null' ] )
+        if self.address:
+            ssh_args.extend( [ '-o', 'HostName=%s' % self.address ] )
+        return ssh_args
+
+
+class CrowdedSSHRPC(FakeSSHRPC):
+    """FakeSSHRPC behind an sshd with MaxStartups max_startups: while that many handshakes
+    (latency seconds each) are under way, any more fail with ssh's 255 straight away.
+    """
+    max_startups = 4
+    startups = []
+    lock = threading.Lock()
+
+    def connect( self ):
+        # building an SSHRPC makes a connection too
+        return self._health( self._exec( self._ssh_cmd( 'true' )[0] ) == 0 )
+
+
+    def _exec( self, cmd, pipes=None, shell=False, timeout=0 ):
+        self.lock.acquire()
+        try:
+            crowded = len( self.startups ) >= self.max_startups
+            if not crowded: self.startups.append( self )
+        finally:
+            self.lock.release()
+        if crowded:
+            if pipes != None:
+                pipes['stdout'], pipes['stderr'] = '', 'ssh_exchange_identification: Connection closed by remote host\n'
+            return self._saw( 255 )
+        try:
+            return FakeSSHRPC._exec( self, cmd, pipes=pipes, shell=shell, timeout=timeout )
+        finally:
+            self.lock.acquire()
+            self.startups.remove( self )
+            self.lock.release()
+
+
+def which( name, extra=() ):
+    """Returns: (str) Full path of the executable name on PATH (or in extra), empty if there isn't one."""
+    for dir in os.environ.get( 'PATH', '' ).split( os.pathsep ) + list( extra ):
+        path = os.path.join( dir, name )
+        if os.path.isfile( path ) and os.access( path, os.X_OK ):
+            return path
+    return ''
+
+
+class LocalSSHD(object):
+    """A throwaway sshd listening on 127.0.0.1, with its own host key, client key, authorized_keys
+    and config in a temporary directory, so benchmarks run against real ssh without touching ~/.ssh.
+
+    Usage
+    =====
+        sshd = LocalSSHD()
+        if sshd.start():
+            box = sshd.factory()( transport='channel' )
+            ...
+            sshd.stop()
+    """
+    CONFIG = """Port %(port)d
+ListenAddress 127.0.0.1
+HostKey %(dir)s/host_key
+AuthorizedKeysFile %(dir)s/authorized_keys
+PidFile %(dir)s/sshd.pid
+PubkeyAuthentication yes
+PasswordAuthentication no
+ChallengeResponseAuthentication no
+UsePAM no
+StrictModes no
+MaxStartups %(max_startups)s
+MaxSessions 200
+"""
+
+    def __init__( self, max_startups=200 ):
+        self.max_startups = max_startups
+        self.sshd     = which( 'sshd', ( '/usr/sbin', '/usr/local/sbin', '/sbin' ) )
+        self.keygen   = which( 'ssh-keygen' )
+        self.dir      = ''
+        self.port     = 0
+        self.identity = ''
+        self.po       = None
+
+
+    def _keygen( self, name ):
+        """PRIVATE - Generate a passphrase-less key pair in our directory, returns: (str) Its private key file."""
+        path = os.path.join( self.dir, name )
+        if subprocess.call( [ self.keygen, '-q', '-t', 'rsa', '-b', '2048', '-N', '', '-f', path ] ) != 0:
+            raise Exception, "ssh-keygen failed for %s" % path
+        return path
+
+
+    def start( self, timeout=10 ):
+        """Start sshd and wait until it accepts connections.
+
+        Returns: (bool) True if it's up, False if there is no sshd (or ssh-keygen) to run.
+        """
+        if not self.sshd or not self.keygen:
+            return False
+        self.dir = mkdtemp( prefix='sshrpc_sshd' )
+        self._keygen( 'host_key' )
+        self.identity = self._keygen( 'id_rsa' )
+        shutil.copy( self.identity + '.pub', os.path.join( self.dir, 'authorized_keys' ) )
+        s = socket.socket()
+        s.bind( ( '127.0.0.1', 0 ) )
+        self.port = s.getsockname()[1]
+        s.close()
+        config = os.path.join( self.dir, 'sshd_config' )
+        open( config, 'w' ).write( self.CONFIG % { 'port': self.port, 'dir': self.dir, 'max_startups': self.max_startups } )
+        log = open( os.path.join( self.dir, 'sshd.log' ), 'w' )
+        self.po = Popen( [ self.sshd, '-D', '-e', '-f', config ], stdout=log, stderr=log )
+        deadline = now() + timeout
+        while now() < deadline and self.po.poll() == None:
+            s = socket.socket()
+            try:
+                s.connect( ( '127.0.0.1', self.port ) )
+                return True
+            except socket.error:
+                sleep( 0.05 )
+            finally:
+                s.close()
+        self.stop()
+        raise Exception, "sshd did not start, see %s" % log.name
+
+
+    def factory( self ):
+        """Returns: (function) Builds a PortSSHRPC to this sshd, taking the other SSHRPC keyword
+        arguments. Any host name given is kept as a name, they all connect here."""
+        def build( **kwargs ):
+            kwargs.setdefault( 'host', '127.0.0.1' )
+            return PortSSHRPC( port=self.port, address='127.0.0.1', identity=self.identity, **kwargs )
+        return build
+
+
+    def stop( self ):
+        if self.po and self.po.poll() == None:
+            os.kill( self.po.pid, signal.SIGTERM )
+            self.po.wait()
+        self.po = None
+        if self.dir:
+            shutil.rmtree( self.dir, True )
+            self.dir = ''
+
+
+def timed( func, iterations ):
+    """Call func() iterations times.
+
+    Returns: (float) Total seconds taken.
+    """
+    start = now()
+    for i in range( iterations ):
+        func()
+    return now() - start
+
+
+def latencies( func, iterations ):
+    """Call func() iterations times.
+
+    Returns: (list) Seconds each call took.
+    """
+    samples = []
+    for i in range( iterations ):
+        start = now()
+        func()
+        samples.append( now() - start )
+    return samples
+
+
+def percentiles( samples ):
+    """Summarize samples exactly (see sshrpc.Histogram for the bucketed version SSHRPC.metrics keeps).
+
+    Returns: (dict) count, mean, min, p50, p99 and max.
+
+    Test
+    ====
+        >>> p = percentiles( [ i / 100.0 for i in range( 1, 101 ) ] )
+        >>> p['count'], p['min'], p['p50'], p['p99'], p['max']
+        (100, 0.01, 0.5, 0.99, 1.0)
+    """
+    samples = sorted( samples )
+    def rank( p ):
+        return samples[ max( 0, int( math.ceil( p / 100.0 * len( samples ) ) ) - 1 ) ]
+    return { 'count': len( samples ), 'mean': sum( samples ) / len( samples ), 'min': samples[0],
+             'p50': rank( 50 ), 'p99': rank( 99 ), 'max': samples[-1] }
+
+
+def bench_construction( factory=SSHRPC, iterations=20 ):
+    """Time building (connecting and probing) and disconnecting an SSHRPC, with each probe.
+
+    Returns: (dict) percentiles() of seconds per construction for each probe.
+    """
+    results = {}
+    for probe in ( 'each', 'batch' ):
+        results[ probe ] = percentiles( latencies( lambda: factory( probe=probe, lazy=False ).disconnect(), iterations ) )
+    return results
+
+
+def bench_execute( factory=SSHRPC, iterations=100 ):
+    """Compare SSHRPC.execute() latency over transport='popen' (one ssh per command) and
+    transport='channel' (one long-lived ssh for every command).
+
+    Returns: (dict) percentiles() of seconds per command for each transport.
+    """
+    results = {}
+    for transport in ( 'popen', 'channel' ):
+        box = factory( transport=transport, lazy=True )
+        _std = {}
+        # the first command over a channel pays for the handshake, don't count it
+        box.execute( cmd='true', pipes=_std )
+        results[ transport ] = percentiles( latencies( lambda: box.execute( cmd='echo hi', pipes=_std ), iterations ) )
+        box.disconnect()
+    return results
+
+
+def bench_concurrency( factory=SSHRPC, iterations=100, levels=( 1, 4, 16 ) ):
+    """Run iterations commands per thread with levels threads at once, each with its own SSHRPC,
+    over each transport.
+
+    Returns: (dict) Commands per second, keyed by transport then by number of threads.
+    """
+    results = {}
+    for transport in ( 'popen', 'channel' ):
+        results[ transport ] = {}
+        for level in levels:
+            boxes = [ factory( transport=transport, lazy=True ) for i in range( level ) ]
+            for box in boxes:
+                box.execute( cmd='true', pipes={} )
+            def run( box ):
+                _std = {}
+                for i in range( iterations ):
+                    box.execute( cmd='echo hi', pipes=_std )
+            threads = [ threading.Thread( target=run, args=( box, ) ) for box in boxes ]
+            start = now()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            results[ transport ][ str( level ) ] = level * iterations / ( now() - start )
+            for box in boxes:
+                box.disconnect()
+    return results
+
+
+def bench_scheduler( factory=CrowdedSSHRPC, hosts=64, rounds=10, connect_rate=60, burst=4 ):
+    """Run one command on hosts hosts at once behind a low MaxStartups: with SSHRPCPool, running
+    again on the hosts that failed straight away (up to rounds times), and with HostScheduler.
+
+    Returns: (dict) percentiles() of seconds until each host's command succeeded, plus how many
+        hosts never made it and how many attempts there were, for each.
+    """
+    names = [ 'crowded%d' % i for i in range( hosts ) ]
+    results = {}
+
+    def summary( finished, attempts ):
+        summary = finished and percentiles( finished.values() ) or {}
+        summary['failed'], summary['attempts'] = hosts - len( finished ), attempts
+        return summary
+
+    start, finished, attempts, pending = now(), {}, 0, names
+    for i in range( rounds ):
+        failed = []
+        for result in SSHRPCPool( pending, concurrency=hosts, factory=factory, lazy=True ).imap_execute( 'true' ):
+            attempts += 1
+            if result:
+                finished[ result.host ] = now() - start
+            else:
+                failed.append( result.host )
+        pending = failed
+        if not pending: break
+    results['pool'] = summary( finished, attempts )
+
+    scheduler = HostScheduler( names, concurrency=hosts, factory=factory, connect_rate=connect_rate, burst=burst,
+                               retries=rounds - 1, backoff=0.05 )
+    start, finished, attempts = now(), {}, 0
+    for result in scheduler.imap_execute( 'true' ):
+        attempts += result.attempts
+        if result:
+            finished[ result.host ] = now() - start
+    results['scheduler'] = summary( finished, attempts )
+    return results
+
+
+def bench_pool( hosts=100, concurrency=32 ):
+    """Run one command on hosts FakeSSHRPC hosts one after another, with SSHRPCPool and with EventPool.
+
+    Returns: (dict) Total seconds for each way of doing it.
+    """
+    names = [ 'fake%d' % i for i in range( hosts ) ]
+    results = {}
+    boxes = [ FakeSSHRPC( host ) for host in names ]
+    results['sequential'] = timed( lambda: [ box.execute( 'true' ) for box in boxes ], 1 )
+    pool = SSHRPCPool( names, concurrency=concurrency, factory=FakeSSHRPC )
+    results['threads'] = timed( lambda: pool.execute( 'true' ), 1 )
+    pool = EventPool( names, concurrency=concurrency, factory=FakeSSHRPC )
+    pool.connect()
+    results['events'] = timed( lambda: pool.execute( 'true' ), 1 )
+    return results
+
+
+def count_round_trips( box, func ):
+    """Call func() and count the remote commands box runs while doing it.
+
+    Returns: (int) Number of round trips.
+    """
+    calls = []
+    execute = box._execute
+    def counted( *args, **kwargs ):
+        calls.append( args )
+        return execute( *args, **kwargs )
+    box._execute = counted
+    try:
+        func()
+    finally:
+        del box._execute
+    return len( calls )
+
+
+def unbatched_safe_remove( box, path ):
+    """SSHRPC.safe_remove() the way it was before Batch, one round trip per step."""
+    rm_path = "_".join( ( path,'RM' ) )
+    if box.path_exists( path ):
+        box.file_move( src=path, dest=rm_path )
+    if box.path_exists( rm_path ):
+        box.execute( "rm -rf %s" % rm_path, pipes={} )
+    return not box.path_exists( path ) and not box.path_exists( rm_path )
+
+
+def bench_round_trips( factory=SSHRPC ):
+    """Count the round trips safe_remove() takes with and without Batch, and the ones
+    func_distro() takes on a fresh SSHRPC (including the probing it needs) with each probe.
+
+    Returns: (dict) Round trips for each.
+    """
+    box = factory()
+    results = {}
+    box.execute( 'mkdir -p sshrpc_bench_rm' )
+    results['safe_remove unbatched'] = count_round_trips( box, lambda: unbatched_safe_remove( box, 'sshrpc_bench_rm' ) )
+    box.execute( 'mkdir -p sshrpc_bench_rm' )
+    results['safe_remove'] = count_round_trips( box, lambda: box.safe_remove( 'sshrpc_bench_rm' ) )
+    box.disconnect()
+    for probe in ( 'each', 'batch' ):
+        box = factory( probe=probe, lazy=True )
+        results[ 'func_distro probe=%s' % probe ] = count_round_trips( box, box.func_distro )
+        box.disconnect()
+    return results
+
+
+class QuietSSHRPC(FakeSSHRPC):
+    """FakeSSHRPC that doesn't run anything, every command returns 0 and payload bytes of stdout,
+    so execute() is all SSHRPC's own overhead.
+    """
+    payload = 65536
+
+    def _exec( self, cmd, pipes=None, shell=False, timeout=0 ):
+        if pipes != None:
+            pipes['stdout'], pipes['stderr'] = 'x' * self.payload, ''
+        return 0
+
+
+def bench_logging( iterations=10000, logfile='sshrpc_bench.log' ):
+    """Time execute() with logging off, and with SSHRPC.setup_logging() logging DEBUG to logfile.
+
+    Returns: (dict) Seconds per execute() for each.
+    """
+    box, _std = QuietSSHRPC(), {}
+    results = {}
+    results['off'] = timed( lambda: box.execute( cmd='true', pipes=_std ), iterations ) / iterations
+    handler = SSHRPC.setup_logging( console=False, logfile=logfile )
+    try:
+        results['on'] = timed( lambda: box.execute( cmd='true', pipes=_std ), iterations ) / iterations
+        # the caller only pays for queueing, count what's still being written out too
+        start = now()
+        handler.flush()
+        results['on, drained'] = results['on'] + ( now() - start ) / iterations
+    finally:
+        SSHRPC.logger.removeHandler( handler )
+        SSHRPC.logger.setLevel( logging.NOTSET )
+        SSHRPC.queueLogger = None
+        handler.close()
+        os.remove( logfile )
+    return results
+
+
+def bench_rsync( factory=SSHRPC, size=268435456, files=1024, streams=4 ):
+    """Push files small files adding up to size/2 with rsync(), then a single size/2 file with
+    rsync() and with rsync_parallel( streams=streams ), each to an empty remote directory.
+
+    Returns: (dict) Throughput of each, in MB/s.
+    """
+    box = factory( lazy=True )
+    local = mkdtemp( prefix='sshrpc_bench' )
+    small, big = os.path.join( local, 'small' ), os.path.join( local, 'big' )
+    os.mkdir( small )
+    for i in range( files ):
+        open( os.path.join( small, '%d' % i ), 'wb' ).write( os.urandom( size / 2 / files ) )
+    f = open( big, 'wb' )
+    for i in range( size / 2 / 1048576 ):
+        f.write( os.urandom( 1048576 ) )
+    f.close()
+    results = {}
+    try:
+        results['rsync small files'] = size / 2 / timed( lambda: box.rsync( small, remote='sshrpc_bench_small' ), 1 ) / 1048576
+        results['rsync large file'] = size / 2 / timed( lambda: box.rsync( big, remote='sshrpc_bench_big' ), 1 ) / 1048576
+        stats = box.rsync_parallel( big, remote='sshrpc_bench_parallel', streams=streams, split_size=size / 2 / streams )
+        results['rsync_parallel large file'] = stats.throughput() / 1048576
+    finally:
+        box.execute( 'rm -rf sshrpc_bench_small sshrpc_bench_big sshrpc_bench_parallel', pipes={} )
+        box.disconnect()
+        shutil.rmtree( local, True )
+    return results
+
+
+def report( name, results ):
+    for key in sorted( results ):
+        value = results[ key ]
+        if isinstance( value, dict ):
+            report( '%s %s' % (name, key), value )
+        else:
+            print "%-36s %-24s %.6f" % (name, key, value)
+
+
+def run( factory, iterations=100, rsync_size=268435456, crowded=CrowdedSSHRPC ):
+    """Run every benchmark against the SSHRPCs factory builds, skipping rsync if there's no rsync,
+    and bench_scheduler() against the ones crowded builds.
+
+    Returns: (dict) Every benchmark's results, keyed by benchmark name.
+    """
+    results = {}
+    results['construction s'] = bench_construction( factory, max( 1, iterations / 5 ) )
+    results['execute s'] = bench_execute( factory, iterations )
+    results['commands/s'] = bench_concurrency( factory, max( 1, iterations / 4 ) )
+    results['round trips'] = bench_round_trips( factory )
+    results['fan-out s/100 hosts'] = bench_pool( 100 )
+    results['MaxStartups s/64 hosts'] = bench_scheduler( crowded )
+    results['execute s logging'] = bench_logging( iterations * 100 )
+    if which( 'rsync' ):
+        results['rsync MB/s'] = bench_rsync( factory, size=rsync_size )
+    return results
+
+
+if __name__ == "__main__":
+    parser = OptionParser( usage="python -m sshrpc.bench [options] [host]",
+                           description="Without a host, benchmark against a throwaway sshd on 127.0.0.1, "
+                                       "or against FakeSSHRPC if there's no sshd to run." )
+    parser.add_option( '-n', '--iterations', type='int', default=100, help="commands per measurement (default 100)" )
+    parser.add_option( '-s', '--rsync-size', type='int', default=268435456, help="bytes pushed per rsync measurement (default 256MB)" )
+    parser.add_option( '-o', '--json', default='', help="also write the results, and what they were run on, to this file" )
+    parser.add_option( '--fake', action='store_true', default=False, help="benchmark against FakeSSHRPC" )
+    options, args = parser.parse_args()
+    sshds, crowded = [], CrowdedSSHRPC
+    if args:
+        transport, factory = 'host %s' % args[0], lambda **kwargs: SSHRPC( host=args[0], **kwargs )
+    elif not options.fake and LocalSSHD().sshd:
+        sshds = [ LocalSSHD(), LocalSSHD( max_startups=CrowdedSSHRPC.max_startups ) ]
+        for sshd in sshds:
+            sshd.start()
+        transport, factory, crowded = 'local sshd', sshds[0].factory(), sshds[1].factory()
+    else:
+        transport, factory = 'fake, latency=%s' % FakeSSHRPC.latency, FakeSSHRPC
+    try:
+        results = run( factory, options.iterations, options.rsync_size, crowded )
+    finally:
+        for sshd in sshds:
+            sshd.stop()
+    for name in sorted( results ):
+        report( name, results[ name ] )
+    if options.json:
+        f = open( options.json, 'w' )
+        json.dump( { 'sshrpc': __version__, 'transport': transport, 'iterations': options.iterations,
+                     'python': sys.version.split()[0], 'platform': sys.platform, 'time': now(),
+                     'results': results }, f, indent=2, sort_keys=True )
+        f.close()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python2.6
+# encoding: utf-8
+"""distribute - Copy files to many hosts, with the hosts that have them relaying to the rest.
+
+Usage
+=====
+    from sshrpc.distribute import TreeDistributor
+    tree = TreeDistributor( [ 'web%02d' % i for i in range( 300 ) ], login='splunk' )
+    def progress( result ):
+        print result.host, result.source, result.depth, bool( result )
+    results = tree.distribute( 'splunk-4.1.tgz', remote='pkgs', progress=progress )
+
+    See help(TreeDistributor).
+"""
+
+import os
+import sys
+import json
+import zlib
+import hashlib
+import threading
+
+from Queue import Queue
+from time import time as now
+
+from sshrpc import SSHRPC
+from sshrpc.pool import HostGroup, HostResult
+
+
+class HopResult(HostResult):
+    """The outcome of copying to one host, see TreeDistributor.distribute().
+
+    Attributes
+    ==========
+        source: (str) The host that sent the copy, None for the controller (us).
+        depth: (int) Number of hops the copy is from the controller, 1 for a seed.
+        others: see HostResult.
+    """
+
+    def __init__( self, host, source=None, depth=0, **kwargs ):
+        HostResult.__init__( self, host, **kwargs )
+        self.source = source
+        self.depth  = depth
+
+
+    def __repr__( self ):
+        return "<HopResult host=%s source=%s depth=%d return_code=%s duration=%.3f>" % (
+            self.host, self.source, self.depth, self.return_code, self.duration)
+
+
+def checksums( root, paths ):
+    """Return the md5 of every regular file in paths (relative to root), keyed by path."""
+    sums = {}
+    for path in paths:
+        full_path = os.path.join( root, path )
+        if os.path.islink( full_path ) or not os.path.isfile( full_path ):
+            continue
+        md5 = hashlib.md5()
+        f = open( full_path, 'rb' )
+        try:
+            for chunk in iter( lambda: f.read( 1048576 ), '' ):
+                md5.update( chunk )
+        finally:
+            f.close()
+        sums[ path ] = md5.hexdigest()
+    return sums
+
+
+class TreeDistributor(HostGroup):
+    """Copy a file or tree to many hosts in a tree: we send to a few seed hosts, and every host
+    that has a good copy then relays it to others, host to host over ssh.
+
+    Description
+    ===========
+        Each host with a copy can send to fanout hosts at once, so the number of hosts with a
+        copy grows geometrically and the time to reach every host grows with the log of the
+        number of hosts, while we (the controller) only ever send seeds copies.
+        Each copy is checked against our md5 of every file before its host relays to anyone.
+        A host whose relayed copy fails is sent a copy by us directly, once.
+
+    Notes
+    =====
+        1. Relays ssh to the next host with our credentials by agent forwarding (ssh -A), so our
+        identity must be loaded in a running ssh-agent (ssh-add), and every host needs rsync.
+        2. Hosts are told apart only by name and login, all of them must accept the same key.
+
+    Usage
+    =====
+        Same arguments as SSHRPCPool, see help(HostGroup).
+    """
+    RELAY_SSH = 'ssh -q -A -l %s -o StrictHostKeyChecking=no -o PreferredAuthentications=publickey -o BatchMode=yes'
+
+    # print the md5 of the regular files in paths (zlib json on stdin, there can be lots) relative to argv[1]
+    CHECKSUM_SCRIPT = """
+import os, sys, json, zlib, hashlib
+sums = {}
+for path in json.loads(zlib.decompress(getattr(sys.stdin, "buffer", sys.stdin).read()).decode()):
+    full_path = os.path.join(sys.argv[1], path)
+    if os.path.islink(full_path) or not os.path.isfile(full_path):
+        continue
+    md5 = hashlib.md5()
+    f = open(full_path, "rb")
+    for chunk in iter(lambda: f.read(1048576), b""):
+        md5.update(chunk)
+    f.close()
+    sums[path] = md5.hexdigest()
+print(json.dumps(sums))
+"""
+
+    def _relay_cmd( self, source, target, tree, remote ):
+        """PRIVATE - The command source runs to rsync the copy it has to target."""
+        tops = []
+        for path in tree['dirs'] + [ f[0] for f in tree['files'] ]:
+            top = path.split( os.sep )[0]
+            if not top in tops: tops.append( top )
+        remote = remote or '.'
+        rsync_cmd = "rsync -qaR -e '%s' --rsync-path='mkdir -p %s && rsync' " % (self.RELAY_SSH % target.login, source.shesc( remote ))
+        rsync_cmd += ' '.join( [ source.shesc( os.path.join( remote, '.', top ) ) for top in tops ] )
+        return "%s %s:%s" % (rsync_cmd, target.host, source.shesc( remote ))
+
+
+    def _verify( self, box, remote, sums ):
+        """PRIVATE - Compare the copy on box with sums, returns: (str) What's wrong with it, empty if nothing."""
+        return_code, _std = box._pipe( "python -c '%s' %s" % (self.CHECKSUM_SCRIPT, box.shesc( remote or '.' )), zlib.compress( json.dumps( sums.keys() ) ) )
+        if return_code != 0:
+            return "checksums failed, return_code=%s" % return_code
+        remote_sums = json.loads( _std['stdout'] )
+        bad = [ path for path in sums if remote_sums.get( path ) != sums[ path ] ]
+        if bad:
+            return "checksum mismatch on %d files, e.g. %s" % (len( bad ), bad[0])
+        return ''
+
+
+    def _send( self, source, host, local, remote, tree, sums, verify ):
+        """PRIVATE - Copy to host, from us if source is None, otherwise from source. Returns: (HopResult)"""
+        result = HopResult( host, source=source )
+        start_time = now()
+        try:
+            box, _std = self.box( host ), {}
+            if source == None:
+                result.return_code = box.rsync( local, remote=remote ) and 0 or 1
+            else:
+                relay = self.box( source )
+                result.return_code = relay._execute( self._relay_cmd( relay, box, tree, remote ), pipes=_std, ssh_args=[ '-A' ] )
+                result.stdout, result.stderr = _std.get( 'stdout', '' ), _std.get( 'stderr', '' )
+            if result.return_code == 0 and verify:
+                result.error = self._verify( box, remote, sums )
+        except:
+            result.error = str( sys.exc_info()[1] )
+        result.duration = now() - start_time
+        return result
+
+
+    def distribute( self, local, remote='', fanout=2, seeds=2, progress=None, verify=True ):
+        """Copy local to remote on every host, like SSHRPC.rsync( local, remote ) on each of them.
+
+        Usage
+        =====
+        Returns: (dict) HopResults keyed by host, True for hosts with a good copy.
+        Required: local
+            local: (str) The file or directory to copy, a trailing slash copies what's in it.
+        Optional: remote, fanout, seeds, progress, verify
+            remote: (str) Destination directory on every host. (default = '', home)
+            fanout: (int) Number of hosts each host with a copy relays to at once. (default = 2)
+            seeds: (int) Number of hosts we send to ourselves. (default = 2)
+            progress: (function) Called with the HopResult of every copy as it finishes,
+                including ones that failed and will be retried.
+            verify: (bool) Check every copy's md5s before its host relays it. (default = True)
+
+        Test
+        ====
+            >>> TreeDistributor( [ 'localhost' ] ).distribute( '.', fanout=0 )
+            Traceback (most recent call last):
+            Exception: fanout and seeds must be at least 1, not 0 and 2.
+        """
+        if fanout < 1 or seeds < 1: raise Exception, "fanout and seeds must be at least 1, not %s and %s." % (fanout,seeds)
+        tree = SSHRPC._walk_tree( os.path.expanduser( local ) )
+        sums = verify and checksums( tree['root'], [ f[0] for f in tree['files'] ] ) or {}
+        pending, retry = list( self.hosts ), []
+        results, depth = {}, { None: 0 }
+        finished = Queue()
+        holders, relays = [], []  # relays has an entry per free relay slot
+        direct = 0  # copies we're sending ourselves
+
+        def start( source, host ):
+            def send():
+                finished.put( self._send( source, host, local, remote, tree, sums, verify ) )
+            thread = threading.Thread( target=send )
+            thread.setDaemon( True )
+            thread.start()
+
+        in_flight = 0
+        while True:
+            # a relay that fails is retried by us, we also seed until there are seeds hosts to relay
+            while retry and direct < seeds:
+                start( None, retry.pop( 0 ) )
+                direct, in_flight = direct + 1, in_flight + 1
+            while pending and relays:
+                start( relays.pop( 0 ), pending.pop( 0 ) )
+                in_flight += 1
+            while pending and direct < seeds and len( holders ) + direct < seeds:
+                start( None, pending.pop( 0 ) )
+                direct, in_flight = direct + 1, in_flight + 1
+            if not in_flight:
+                break
+            result = finished.get()
+            in_flight -= 1
+            result.depth = depth[ result.source ] + 1
+            if result.source == None:
+                direct -= 1
+            else:
+                relays.append( result.source )
+            if result:
+                results[ result.host ] = result
+                depth[ result.host ] = result.depth
+                holders.append( result.host )
+                relays.extend( [ result.host ] * fanout )
+            elif result.source != None:
+                retry.append( result.host )
+            else:
+                results[ result.host ] = result
+            self.logger.debug( "%s", result )
+            if progress: progress( result )
+        return results
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
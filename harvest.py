@@ -0,0 +1,335 @@
+#!/usr/bin/env python2.6
+# encoding: utf-8
+"""harvest - Pull what's been appended to log files on many hosts, and nothing else.
+
+Usage
+=====
+    from sshrpc.harvest import LogHarvester
+    harvester = LogHarvester( [ 'idx01', 'idx02' ], [ 'splunk/var/log/splunk/*.log' ], dest='logs', login='splunk' )
+    def progress( result ):
+        print result.host, result.bytes, bool( result )
+    harvester.run( interval=10, progress=progress )
+
+    See help(LogHarvester).
+"""
+
+import os
+import sys
+import json
+import zlib
+
+from time import sleep, time as now
+
+from sshrpc import _write_atomic
+from sshrpc.pool import HostGroup, HostResult
+
+
+class HarvestResult(HostResult):
+    """The outcome of one harvest of one host, see LogHarvester.harvest().
+
+    Attributes
+    ==========
+        files: (dict) Bytes pulled per remote file, for the files that have any.
+        bytes: (int) Bytes pulled in total.
+        rotated: (list) Remote files that were rotated or truncated since the last harvest.
+        others: see HostResult.
+    """
+
+    def __init__( self, host, **kwargs ):
+        HostResult.__init__( self, host, **kwargs )
+        self.files   = {}
+        self.bytes   = 0
+        self.rotated = []
+
+
+    def __repr__( self ):
+        return "<HarvestResult host=%s return_code=%s files=%d bytes=%d duration=%.3f>" % (
+            self.host, self.return_code, len( self.files ), self.bytes, self.duration)
+
+
+class Checkpoints(object):
+    """Where LogHarvester remembers how far it has read each remote file, keyed by (host, login).
+
+    Notes
+    =====
+        A controller killed while saving leaves the last checkpoints it saved, never half a file.
+
+    Test
+    ====
+        >>> import tempfile
+        >>> checkpoints = Checkpoints( path=tempfile.mkdtemp() )
+        >>> checkpoints.get( 'localhost', 'splunk' )
+        {}
+        >>> checkpoints.put( 'localhost', 'splunk', {'a.log': {'inode': 12, 'offset': 34, 'local': 34}} )
+        True
+        >>> checkpoints.get( 'localhost', 'splunk' ) == {'a.log': {'inode': 12, 'offset': 34, 'local': 34}}
+        True
+    """
+
+    def __init__( self, path='' ):
+        if not path: path = os.path.join( os.path.expanduser( '~' ), '.sshrpc', 'harvest' )
+        self.path = path
+
+
+    def _file( self, host, login ):
+        """PRIVATE - Where the checkpoints for login@host live."""
+        return os.path.join( self.path, ( '%s@%s.json' % (login, host) ).replace( os.sep, '_' ).replace( ':', '_' ) )
+
+
+    def get( self, host, login ):
+        """Return the checkpoints for login@host, keyed by remote path, empty if there are none."""
+        try:
+            checkpoint_file = open( self._file( host, login ) )
+            try:
+                checkpoints = json.load( checkpoint_file )
+            finally:
+                checkpoint_file.close()
+        except ( IOError, ValueError ):
+            return {}
+        return dict( [ ( path.encode( 'utf-8' ), dict( [ ( str( k ), v ) for k, v in checkpoint.items() ] ) )
+                       for path, checkpoint in checkpoints.items() ] )
+
+
+    def put( self, host, login, checkpoints ):
+        """Save checkpoints (dict) for login@host."""
+        return _write_atomic( self._file( host, login ), json.dumps( checkpoints ) )
+
+
+class LogHarvester(HostGroup):
+    """Copy what's been appended to a set of remote files since the last look, from many hosts,
+    appending it to local copies under dest/<host>/.
+
+    Description
+    ===========
+        Every harvest() runs one remote python per host, which reads each matching file from
+        where we stopped last time (by inode and offset) and sends back only the new bytes,
+        compressed. The checkpoints are saved under checkpoints after every harvest, so a
+        restarted controller carries on where the last one stopped.
+        A file whose inode changed was rotated: the rest of the old file is read first if it
+        is still in the same directory (e.g. renamed to splunkd.log.1), then the new file from
+        the start. A file that got shorter was truncated and is read from the start.
+
+    Notes
+    =====
+        1. Each local copy is the remote file's contents across rotations, one after the other.
+        2. At most max_bytes are pulled per file per harvest, a big backlog takes a few harvests.
+        3. A local copy is cut back to its checkpointed size before it's appended to, so bytes
+        written by a controller that died before saving its checkpoints aren't written twice.
+
+    Usage
+    =====
+        Required: hosts, paths
+            hosts: see HostGroup.
+            paths: (list) Remote files or glob patterns, relative to the remote home.
+        Optional: dest, checkpoints, max_bytes, compress, others
+            dest: (str) Local directory the copies go in. (default = '.')
+            checkpoints: (Checkpoints) Where our offsets are saved. (default = Checkpoints())
+            max_bytes: (int) Most bytes pulled per file per harvest. (default = 64MB)
+            compress: (bool) zlib the remote output. (default = True)
+            others: see HostGroup.
+
+    Test
+    ====
+        >>> import tempfile
+        >>> remote, local = tempfile.mkdtemp(), tempfile.mkdtemp()
+        >>> log = open( os.path.join( remote, 'a.log' ), 'w' ); log.write( 'one\\n' ); log.close()
+        >>> harvester = LogHarvester( [ 'localhost' ], [ os.path.join( remote, '*.log' ) ], dest=local, checkpoints=Checkpoints( local ) )
+        >>> harvester.harvest()['localhost'].bytes
+        4
+        >>> log = open( os.path.join( remote, 'a.log' ), 'a' ); log.write( 'two\\n' ); log.close()
+        >>> harvester.harvest()['localhost'].bytes
+        4
+        >>> os.rename( os.path.join( remote, 'a.log' ), os.path.join( remote, 'a.log.1' ) )
+        >>> log = open( os.path.join( remote, 'a.log.1' ), 'a' ); log.write( 'three\\n' ); log.close()
+        >>> log = open( os.path.join( remote, 'a.log' ), 'w' ); log.write( 'four\\n' ); log.close()
+        >>> result = LogHarvester( [ 'localhost' ], [ os.path.join( remote, '*.log' ) ], dest=local, checkpoints=Checkpoints( local ) ).harvest()['localhost']
+        >>> result.bytes, len( result.rotated )
+        (11, 1)
+        >>> open( os.path.join( local, 'localhost', remote.lstrip( '/' ), 'a.log' ) ).read()
+        'one\\ntwo\\nthree\\nfour\\n'
+    """
+    # reads stdin (zlib json of paths, checkpoints, max and compress), and writes a json header
+    # line then that many bytes for every file, all zlibed if compress
+    HARVEST_SCRIPT = """
+import os, sys, glob, json, zlib
+args = json.loads(zlib.decompress(getattr(sys.stdin, "buffer", sys.stdin).read()).decode())
+out = getattr(sys.stdout, "buffer", sys.stdout)
+z = args["compress"] and zlib.compressobj(6) or None
+def emit(data):
+    if z:
+        data = z.compress(data)
+    out.write(data)
+def send(path, f, offset, limit, head):
+    f.seek(offset)
+    data = f.read(max(limit, 0))
+    head.update(path=path, offset=offset, length=len(data))
+    emit((json.dumps(head) + "\\n").encode())
+    emit(data)
+    return len(data)
+seen = set()
+for pattern in args["paths"]:
+    for path in sorted(glob.glob(os.path.expanduser(pattern))):
+        if path in seen:
+            continue
+        seen.add(path)
+        try:
+            f = open(path, "rb")
+        except (IOError, OSError):
+            continue
+        st = os.fstat(f.fileno())
+        inode, offset = args["checkpoints"].get(path, [None, 0])
+        limit = args["max"]
+        if inode is not None and inode != st.st_ino:
+            d, unfinished = os.path.dirname(path) or ".", False
+            for name in os.listdir(d):
+                try:
+                    old = open(os.path.join(d, name), "rb")
+                except (IOError, OSError):
+                    continue
+                old_st = os.fstat(old.fileno())
+                if old_st.st_ino == inode and old_st.st_dev == st.st_dev:
+                    sent = send(path, old, offset, limit, {"inode": inode, "rotated": name})
+                    limit -= sent
+                    unfinished = offset + sent < old_st.st_size
+                old.close()
+                if old_st.st_ino == inode:
+                    break
+            if unfinished:
+                f.close()
+                continue
+            send(path, f, 0, limit, {"inode": st.st_ino, "rotated": True})
+        elif offset > st.st_size:
+            send(path, f, 0, limit, {"inode": st.st_ino, "rotated": True})
+        else:
+            send(path, f, offset, limit, {"inode": st.st_ino})
+        f.close()
+if z:
+    out.write(z.flush())
+"""
+
+    def __init__( self, hosts, paths, dest='.', checkpoints=None, max_bytes=67108864, compress=True, **kwargs ):
+        HostGroup.__init__( self, hosts, **kwargs )
+        self.paths       = paths
+        self.dest        = dest
+        self.checkpoints = checkpoints or Checkpoints()
+        self.max_bytes   = max_bytes
+        self.compress    = compress
+
+
+    def _local( self, host, path ):
+        """PRIVATE - The local copy of host's path."""
+        return os.path.join( self.dest, host, os.path.normpath( path ).lstrip( os.sep ).replace( '..', '__' ) )
+
+
+    def _open( self, local_path, size ):
+        """PRIVATE - Open local_path (creating it if needed) to append to, cut back to size bytes."""
+        if not os.path.isdir( os.path.dirname( local_path ) ):
+            os.makedirs( os.path.dirname( local_path ) )
+        f = open( local_path, os.path.exists( local_path ) and 'r+b' or 'wb' )
+        f.truncate( size )
+        f.seek( size )
+        return f
+
+
+    def _harvest( self, host ):
+        """PRIVATE - Pull host's new bytes and save its checkpoints. Returns: (HarvestResult)
+
+        Each file's bytes are written out as they arrive, nothing more than a chunk is held here.
+        """
+        box = self.box( host )
+        checkpoints = self.checkpoints.get( host, box.login )
+        args = { 'paths': self.paths, 'max': self.max_bytes, 'compress': self.compress,
+                 'checkpoints': dict( [ ( path, [ c['inode'], c['offset'] ] ) for path, c in checkpoints.items() ] ) }
+        result = HarvestResult( host )
+        # the file being written: its header, local file, and how many of its bytes are still to come
+        state = { 'buffered': '', 'head': None, 'file': None, 'left': 0 }
+
+        def feed( data ):
+            state['buffered'] += data
+            while True:
+                if state['head'] == None:
+                    end = state['buffered'].find( '\n' )
+                    if end < 0:
+                        return
+                    head = json.loads( state['buffered'][ :end ] )
+                    state['buffered'] = state['buffered'][ end + 1: ]
+                    path = head['path'] = head['path'].encode( 'utf-8' )
+                    checkpoint = checkpoints.setdefault( path, { 'local': 0 } )
+                    local_path = self._local( host, path )
+                    if not os.path.exists( local_path ): checkpoint['local'] = 0
+                    state['head'], state['left'] = head, head['length']
+                    state['file'] = self._open( local_path, checkpoint['local'] )
+                piece = state['buffered'][ :state['left'] ]
+                state['file'].write( piece )
+                state['buffered'] = state['buffered'][ len( piece ): ]
+                state['left'] -= len( piece )
+                if state['left']:
+                    return
+                state['file'].close()
+                head, state['head'], state['file'] = state['head'], None, None
+                path, length = head['path'], head['length']
+                checkpoint = checkpoints[ path ]
+                checkpoint['local'] += length
+                checkpoint['inode'], checkpoint['offset'] = head['inode'], head['offset'] + length
+                if head.get( 'rotated' ) and not path in result.rotated:
+                    result.rotated.append( path )
+                if length:
+                    result.files[ path ] = result.files.get( path, 0 ) + length
+                    result.bytes += length
+
+        stream = box.execute_stream( "python -c '%s'" % self.HARVEST_SCRIPT, stdin=zlib.compress( json.dumps( args ) ) )
+        gunzip = self.compress and zlib.decompressobj()
+        errors = []
+        try:
+            for name, data in stream:
+                if name == 'stderr':
+                    errors.append( data )
+                elif gunzip:
+                    feed( gunzip.decompress( data ) )
+                else:
+                    feed( data )
+            if gunzip: feed( gunzip.flush() )
+        finally:
+            if state['file']: state['file'].close()
+        result.return_code, result.stderr = stream.return_code, ''.join( errors )
+        # what was written of a harvest that didn't finish is cut off again next time, see Notes
+        if result.return_code != 0 or state['head'] or state['buffered']:
+            return result
+        self.checkpoints.put( host, box.login, checkpoints )
+        self.logger.debug( "%s", result )
+        return result
+
+
+    def harvest( self ):
+        """Pull what's new in paths from every host, concurrency hosts at a time.
+
+        Returns: (dict) HarvestResults keyed by host.
+        """
+        results = {}
+        for result in self._threaded( self._harvest ):
+            if not isinstance( result, HarvestResult ):
+                result = HarvestResult( result.host, error=result.error, duration=result.duration )
+            results[ result.host ] = result
+        return results
+
+
+    def run( self, interval=10, cycles=0, progress=None ):
+        """harvest() every interval seconds, cycles times (0 for forever).
+
+        Optional: interval, cycles, progress
+            progress: (function) Called with every HarvestResult.
+        """
+        cycle = 0
+        while not cycles or cycle < cycles:
+            start_time = now()
+            for result in self.harvest().values():
+                if progress: progress( result )
+            cycle += 1
+            if not cycles or cycle < cycles:
+                sleep( max( 0, interval - ( now() - start_time ) ) )
+        return True
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,351 @@
+#!/usr/bin/env python2.6
+# encoding: utf-8
+"""pool - Run SSHRPC operations across many hosts at once.
+
+Usage
+=====
+    from sshrpc.pool import SSHRPCPool
+    pool = SSHRPCPool( [ 'idx01', { 'host': 'idx02', 'login': 'splunk' } ], concurrency=32 )
+    for result in pool.imap_execute( 'uptime' ):
+        print result.host, result.return_code, result.duration
+
+    See help(SSHRPCPool), help(EventPool) and help(poll_jobs).
+"""
+
+import os
+import sys
+import logging
+import threading
+
+from Queue import Queue
+from select import select
+from subprocess import Popen, PIPE
+from time import sleep, time as now
+
+from sshrpc import SSHRPC, CommandTimeout
+
+
+class HostResult(object):
+    """The outcome of one operation on one host.
+
+    Attributes
+    ==========
+        host: (str) The host the operation ran on.
+        return_code: (int) Exit code of the operation, None if it never ran.
+        stdout, stderr: (str) Output of the operation.
+        duration: (float) Seconds the operation took.
+        error: (str) Why the operation failed to run (exception text), empty if it ran.
+    """
+
+    def __init__( self, host, return_code=None, stdout='', stderr='', duration=0.0, error='' ):
+        self.host        = host
+        self.return_code = return_code
+        self.stdout      = stdout
+        self.stderr      = stderr
+        self.duration    = duration
+        self.error       = error
+
+
+    def __repr__( self ):
+        return "<HostResult host=%s return_code=%s duration=%.3f>" % (self.host, self.return_code, self.duration)
+
+
+    def __nonzero__( self ):
+        """True if the operation ran and returned 0."""
+        return self.return_code == 0 and not self.error
+
+
+class HostGroup(object):
+    """A list of hosts, and the SSHRPC objects that talk to them.
+
+    Usage
+    =====
+    Required: hosts
+        hosts: (list) Host names, or dicts of SSHRPC keyword arguments (host, login, identity, ...).
+            Results are keyed by host name, so a host may only be listed once.
+    Optional: login, identity, concurrency, factory, others
+        login, identity: Defaults for hosts that don't name their own.
+        concurrency: (int) Maximum number of hosts worked on at the same time. (default = 16)
+        factory: (class) What to build per host. (default = SSHRPC)
+        others: Passed to factory for every host, e.g. transport='channel'.
+
+    Test
+    ====
+        >>> HostGroup( [ 'localhost', { 'host': 'localhost', 'login': 'splunk' } ] ) # doctest: +IGNORE_EXCEPTION_DETAIL
+        Traceback (most recent call last):
+        Exception: Host localhost is listed more than once.
+    """
+    logger = logging.getLogger( 'SSHRPC' )
+
+    def __init__( self, hosts, login='', identity='', concurrency=16, factory=SSHRPC, **kwargs ):
+        self.concurrency = concurrency
+        self.factory     = factory
+        self.hosts       = []
+        self.host_args   = {}
+        self.boxes       = {}
+        self.lock        = threading.Lock()
+        for host in hosts:
+            host_args = dict( kwargs )
+            if login:    host_args['login'] = login
+            if identity: host_args['identity'] = identity
+            if isinstance( host, dict ):
+                host_args.update( host )
+            else:
+                host_args['host'] = host
+            if host_args['host'] in self.host_args:
+                raise Exception, "Host %s is listed more than once." % host_args['host']
+            self.hosts.append( host_args['host'] )
+            self.host_args[ host_args['host'] ] = host_args
+
+
+    def box( self, host ):
+        """Return the SSHRPC object for host, building (and connecting) it on first use."""
+        self.lock.acquire()
+        try:
+            if host in self.boxes:
+                return self.boxes[ host ]
+        finally:
+            self.lock.release()
+        # build outside of the lock, construction talks to the host
+        box = self.factory( **self.host_args[ host ] )
+        self.lock.acquire()
+        try:
+            return self.boxes.setdefault( host, box )
+        finally:
+            self.lock.release()
+
+
+    def disconnect( self ):
+        """Disconnect every SSHRPC object we built."""
+        for host in self.boxes.keys():
+            try:
+                self.boxes.pop( host ).disconnect()
+            except:
+                self.logger.debug( "Non-fatal error disconnecting %s: %s", host, sys.exc_info() )
+        return True
+
+
+    def _threaded( self, func, hosts=None ):
+        """PRIVATE - Call func(host) for each host in concurrency threads.
+
+        Returns: (generator) HostResults in the order hosts finish.
+        """
+        if hosts == None:
+            hosts = self.hosts
+        tasks, results = Queue(), Queue()
+        for host in hosts:
+            tasks.put( host )
+
+        def worker():
+            while True:
+                host = tasks.get()
+                if host == None:
+                    return
+                start_time = now()
+                try:
+                    result = func( host )
+                except:
+                    result = HostResult( host, error=str( sys.exc_info()[1] ) )
+                result.duration = now() - start_time
+                results.put( result )
+
+        threads = []
+        for i in range( min( self.concurrency, len( hosts ) ) ):
+            tasks.put( None )
+            thread = threading.Thread( target=worker )
+            thread.setDaemon( True )
+            thread.start()
+            threads.append( thread )
+        for i in range( len( hosts ) ):
+            yield results.get()
+        for thread in threads:
+            thread.join()
+
+
+    def connect( self ):
+        """Build (and connect) every host's SSHRPC object, concurrency at a time.
+
+        Returns: (dict) HostResults keyed by host, return_code 0 for hosts that came up.
+        """
+        def connect( host ):
+            self.box( host )
+            return HostResult( host, return_code=0 )
+        hosts = [ host for host in self.hosts if not host in self.boxes ]
+        return dict( [ ( result.host, result ) for result in self._threaded( connect, hosts ) ] )
+
+
+class SSHRPCPool(HostGroup):
+    """Run SSHRPC.execute(), rsync() and python() on many hosts, concurrency at a time, in threads.
+
+    Description
+    ===========
+        Every imap_* method is a generator that yields a HostResult as each host finishes,
+        the plain methods wait for every host and return a dict of HostResults keyed by host.
+        Failures never raise, they show up as HostResult.error or a non-zero return_code.
+
+    Test
+    ====
+        >>> pool = SSHRPCPool( [ 'localhost' ] )
+        >>> pool.execute( 'echo -n hi' )['localhost'].stdout
+        'hi'
+        >>> pool.python( "print 'hi'" )['localhost'].return_code
+        0
+    """
+
+    def imap_execute( self, cmd, dir='', env={}, timeout=0 ):
+        def execute( host ):
+            box, _std = self.box( host ), {}
+            return_code = box._execute( cmd, dir=dir, env=env, pipes=_std, timeout=timeout )
+            if isinstance( return_code, CommandTimeout ):
+                return HostResult( host, None, _std.get( 'stdout', '' ), _std.get( 'stderr', '' ), error=repr( return_code ) )
+            return HostResult( host, return_code, _std.get( 'stdout', '' ), _std.get( 'stderr', '' ) )
+        return self._threaded( execute )
+
+
+    def imap_python( self, program ):
+        return self.imap_execute( 'python -c "import os,sys;%s"' % program )
+
+
+    def imap_rsync( self, local, remote='', reverse=False ):
+        def rsync( host ):
+            return HostResult( host, self.box( host ).rsync( local, remote=remote, reverse=reverse ) and 0 or 1 )
+        return self._threaded( rsync )
+
+
+    def execute( self, cmd, dir='', env={}, timeout=0 ):
+        return dict( [ ( result.host, result ) for result in self.imap_execute( cmd, dir=dir, env=env, timeout=timeout ) ] )
+
+
+    def python( self, program ):
+        return dict( [ ( result.host, result ) for result in self.imap_python( program ) ] )
+
+
+    def rsync( self, local, remote='', reverse=False ):
+        return dict( [ ( result.host, result ) for result in self.imap_rsync( local, remote=remote, reverse=reverse ) ] )
+
+
+class EventPool(HostGroup):
+    """Run commands on many hosts from a single thread, with a select() loop over the ssh processes.
+
+    Description
+    ===========
+        Same surface as SSHRPCPool, but instead of a thread per host in flight every ssh (or
+        rsync) process is started with its pipes watched by one select() loop. This scales
+        to far more hosts in flight than threads do, and it is the building block to use when
+        the caller already has its own event loop.
+        SSHRPC objects are still built with SSHRPCPool.connect() style threads the first time
+        a host is used, since constructing them blocks.
+
+    Test
+    ====
+        >>> pool = EventPool( [ 'localhost' ] )
+        >>> pool.execute( 'echo -n hi' )['localhost'].stdout
+        'hi'
+    """
+
+    def _evented( self, build ):
+        """PRIVATE - Run the command line build(box) returns for every host, concurrency at a time.
+
+        Returns: (generator) HostResults in the order hosts finish.
+        """
+        pending = list( self.hosts )
+        # build (and connect) the boxes up front, concurrently
+        for result in self.connect().values():
+            if result.error:
+                pending.remove( result.host )
+                yield result
+        running = {}  # fd -> state, both of a process's fds map to the same state
+        active  = 0
+        while pending or running:
+            while pending and active < self.concurrency:
+                host = pending.pop( 0 )
+                start_time = now()
+                try:
+                    po = Popen( build( self.boxes[ host ] ), stdout=PIPE, stderr=PIPE )
+                except:
+                    yield HostResult( host, error=str( sys.exc_info()[1] ), duration=now() - start_time )
+                    continue
+                state = { 'host': host, 'po': po, 'start_time': start_time,
+                          'chunks': { po.stdout.fileno(): [], po.stderr.fileno(): [] } }
+                for fd in state['chunks']:
+                    running[ fd ] = state
+                active += 1
+            if not running:
+                continue
+            for fd in select( running.keys(), [], [] )[0]:
+                state = running[ fd ]
+                chunk = os.read( fd, 65536 )
+                if chunk:
+                    state['chunks'][ fd ].append( chunk )
+                    continue
+                # EOF, the process is done once both of its pipes are
+                del running[ fd ]
+                if [ f for f in state['chunks'] if f in running ]:
+                    continue
+                active -= 1
+                po, chunks = state['po'], state['chunks']
+                yield HostResult( state['host'], po.wait(), ''.join( chunks[ po.stdout.fileno() ] ),
+                                  ''.join( chunks[ po.stderr.fileno() ] ), now() - state['start_time'] )
+
+
+    def imap_execute( self, cmd, dir='', env={} ):
+        return self._evented( lambda box: box._ssh_cmd( cmd, dir=dir, env=env )[0] )
+
+
+    def imap_python( self, program ):
+        return self.imap_execute( 'python -c "import os,sys;%s"' % program )
+
+
+    def imap_rsync( self, local, remote='', reverse=False ):
+        def build( box ):
+            if reverse:
+                return box._rsync_cmd( local, remote=remote, reverse=True )
+            # fold SSHRPC.rsync()'s 'mkdir -p' round trip into the rsync itself
+            return box._rsync_cmd( local, remote=remote, rsync_path='mkdir -p %s && rsync' % box.shesc( remote or '.' ) )
+        return self._evented( build )
+
+
+    def execute( self, cmd, dir='', env={} ):
+        return dict( [ ( result.host, result ) for result in self.imap_execute( cmd, dir=dir, env=env ) ] )
+
+
+    def python( self, program ):
+        return dict( [ ( result.host, result ) for result in self.imap_python( program ) ] )
+
+
+    def rsync( self, local, remote='', reverse=False ):
+        return dict( [ ( result.host, result ) for result in self.imap_rsync( local, remote=remote, reverse=reverse ) ] )
+
+
+def poll_jobs( jobs, concurrency=16 ):
+    """Check on RemoteJobs (see SSHRPC.execute_background()) across any number of hosts, with one
+    round trip per host, concurrency hosts at a time.
+
+    Returns: (list) jobs, with their state and return_code updated. Jobs on a host that couldn't
+        be polled are left as they were.
+
+    Test
+    ====
+        >>> jobs = [ SSHRPC().execute_background( 'exit %d' % i ) for i in range( 3 ) ]
+        >>> sleep( 1 )
+        >>> [ job.return_code for job in poll_jobs( jobs ) ]
+        [0, 1, 2]
+        >>> all( [ job.cleanup() for job in jobs ] )
+        True
+    """
+    by_box = {}
+    for job in jobs:
+        by_box.setdefault( job.box, [] ).append( job )
+    def poll( box ):
+        box.poll_jobs( by_box[ box ] )
+        return HostResult( box.host, return_code=0 )
+    group = HostGroup( [], concurrency=concurrency )
+    for result in group._threaded( poll, by_box.keys() ):
+        if result.error:
+            group.logger.warn( "Couldn't poll jobs on %s: %s", result.host, result.error )
+    return jobs
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
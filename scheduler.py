@@ -0,0 +1,343 @@
+#!/usr/bin/env python2.6
+# encoding: utf-8
+"""scheduler - Run SSHRPC operations on a fleet without flooding it with ssh handshakes.
+
+Usage
+=====
+    from sshrpc.scheduler import HostScheduler
+    scheduler = HostScheduler( [ 'idx%02d' % i for i in range( 200 ) ], login='splunk', concurrency=64,
+                               per_host=2, connect_rate=20 )
+    for result in scheduler.imap_execute( 'uptime' ):
+        print result.host, result.return_code, result.attempts
+
+    See help(HostScheduler).
+"""
+
+import sys
+import random
+import threading
+
+from time import sleep, time as now
+
+from sshrpc import CommandTimeout
+from sshrpc.pool import HostGroup, HostResult
+
+
+class ScheduledResult(HostResult):
+    """The outcome of one operation on one host, run through a HostScheduler.
+
+    Attributes
+    ==========
+        attempts: (int) How many times it was tried, 0 if the host's circuit was open.
+        waited: (float) Seconds spent waiting for a slot, a connection or a retry.
+        others: see HostResult, duration covers every attempt and all the waiting.
+    """
+
+    def __init__( self, host, attempts=0, waited=0.0, **kwargs ):
+        HostResult.__init__( self, host, **kwargs )
+        self.attempts = attempts
+        self.waited   = waited
+
+
+    def __repr__( self ):
+        return "<ScheduledResult host=%s return_code=%s attempts=%d waited=%.3f duration=%.3f>" % (
+            self.host, self.return_code, self.attempts, self.waited, self.duration)
+
+
+class TokenBucket(object):
+    """Hands out rate tokens a second, and up to burst at once, to any number of threads.
+
+    Test
+    ====
+        >>> bucket = TokenBucket( 10, burst=2 )
+        >>> bucket.take() + bucket.take() < 0.01
+        True
+        >>> 0.05 < bucket.take() < 0.2
+        True
+    """
+
+    def __init__( self, rate, burst=0 ):
+        self.rate   = rate
+        self.burst  = burst or max( 1, rate )
+        self.tokens = float( self.burst )
+        self.stamp  = now()
+        self.lock   = threading.Lock()
+
+
+    def take( self ):
+        """Wait for a token, returns: (float) Seconds waited. A rate of 0 never waits."""
+        if not self.rate:
+            return 0.0
+        start_time = now()
+        while True:
+            self.lock.acquire()
+            try:
+                stamp = now()
+                self.tokens = min( self.burst, self.tokens + ( stamp - self.stamp ) * self.rate )
+                self.stamp = stamp
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return stamp - start_time
+                wait = ( 1 - self.tokens ) / self.rate
+            finally:
+                self.lock.release()
+            sleep( wait )
+
+
+class CircuitBreaker(object):
+    """Stops work going to a host after threshold transport failures in a row, for cooldown
+    seconds, then lets a single attempt through: if it works the host is back, if not the
+    breaker opens for another cooldown.
+
+    Test
+    ====
+        >>> breaker = CircuitBreaker( threshold=2, cooldown=0.1 )
+        >>> breaker.record( False ); breaker.record( False ); breaker.state()
+        'open'
+        >>> breaker.allow()
+        False
+        >>> sleep( 0.1 ); breaker.allow(), breaker.allow(), breaker.state()
+        (True, False, 'half-open')
+        >>> breaker.record( True ); breaker.state()
+        'closed'
+    """
+
+    def __init__( self, threshold=5, cooldown=60 ):
+        self.threshold = threshold
+        self.cooldown  = cooldown
+        self.failures  = 0
+        self.opened    = 0
+        self.trial     = False
+        self.lock      = threading.Lock()
+
+
+    def state( self ):
+        if self.failures < self.threshold:
+            return 'closed'
+        if self.trial or now() - self.opened >= self.cooldown:
+            return 'half-open'
+        return 'open'
+
+
+    def allow( self ):
+        """Returns: (bool) True if an attempt may go to the host now."""
+        self.lock.acquire()
+        try:
+            if self.failures < self.threshold:
+                return True
+            if not self.trial and now() - self.opened >= self.cooldown:
+                self.trial = True
+                return True
+            return False
+        finally:
+            self.lock.release()
+
+
+    def record( self, ok ):
+        """Count an attempt that got through to the host (ok=True) or didn't."""
+        self.lock.acquire()
+        try:
+            self.trial = False
+            if ok:
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened = now()
+        finally:
+            self.lock.release()
+
+
+    def skip( self ):
+        """Count an attempt that told us nothing about the host, e.g. a command that timed out."""
+        self.lock.acquire()
+        try:
+            self.trial = False
+        finally:
+            self.lock.release()
+
+
+class HostScheduler(HostGroup):
+    """Run SSHRPC.execute() and rsync() (or anything else) on many hosts, with limits on the
+    commands per host and on the ssh connections opened per second across all of them,
+    retrying transport failures and leaving failing hosts alone for a while.
+
+    Description
+    ===========
+        Opening hundreds of ssh sessions at once trips sshd's MaxStartups on the targets (and
+        on jump hosts), which drops handshakes and leaves ssh waiting out ConnectTimeout.
+        Every new connection (building a host's SSHRPC, and every later command that doesn't go
+        over a master or a channel) first takes a token from a TokenBucket, so they go out at
+        connect_rate a second, bursts of up to burst.
+        No more than per_host operations run on a host at once.
+        An operation that fails in transport (ssh's exit code 255, or building the host's SSHRPC
+        raised) is retried
+        up to retries times, after a random wait of up to backoff * 2 ** attempt seconds
+        (capped at max_backoff), so retries from many hosts don't arrive together. A command
+        that timed out got through, and so did one whose func raised, they're returned straight away.
+        Each host has a CircuitBreaker: after breaker_threshold transport failures in a row
+        operations on it fail straight away, with error 'circuit open', for breaker_cooldown
+        seconds.
+
+    Usage
+    =====
+        Required: hosts
+            hosts: see HostGroup.
+        Optional: per_host, connect_rate, burst, retries, backoff, max_backoff, breaker_threshold,
+                  breaker_cooldown, others
+            per_host: (int) Operations at once per host. (default = 1)
+            connect_rate: (float) New ssh connections a second, 0 for no limit. (default = 10)
+            burst: (int) New ssh connections at once. (default = connect_rate)
+            retries: (int) Retries of an operation that failed in transport. (default = 3)
+            backoff, max_backoff: (float) Seconds, see above. (default = 0.5, 30)
+            breaker_threshold, breaker_cooldown: see above. (default = 5, 60)
+            others: see HostGroup, concurrency is the number of operations at once overall.
+                Hosts are built with lazy=True unless told otherwise.
+
+    Test
+    ====
+        >>> scheduler = HostScheduler( [ 'localhost' ], connect_rate=5 )
+        >>> result = scheduler.execute( 'echo -n hi' )['localhost']
+        >>> result.stdout, result.attempts
+        ('hi', 1)
+        >>> result = scheduler.execute( 'exit 255' )['localhost']
+        >>> result.return_code, result.attempts
+        (255, 4)
+        >>> scheduler = HostScheduler( [ 'localhost' ], breaker_threshold=1 )
+        >>> result = scheduler.execute( 'sleep 2', timeout=1 )['localhost']
+        >>> result.return_code, result.attempts, scheduler.open_circuits()
+        (None, 1, [])
+        >>> def broken( box ): raise ValueError, 'not a transport failure'
+        >>> result = scheduler.call( 'localhost', broken )
+        >>> result.error, result.attempts, scheduler.open_circuits()
+        ('not a transport failure', 1, [])
+    """
+    TRANSPORT_FAILURE = 255
+
+    def __init__( self, hosts, per_host=1, connect_rate=10, burst=0, retries=3, backoff=0.5, max_backoff=30,
+                  breaker_threshold=5, breaker_cooldown=60, **kwargs ):
+        kwargs.setdefault( 'lazy', True )
+        HostGroup.__init__( self, hosts, **kwargs )
+        self.per_host    = per_host
+        self.bucket      = TokenBucket( connect_rate, burst )
+        self.retries     = retries
+        self.backoff     = backoff
+        self.max_backoff = max_backoff
+        self.slots       = dict( [ ( host, threading.Semaphore( per_host ) ) for host in self.hosts ] )
+        self.breakers    = dict( [ ( host, CircuitBreaker( breaker_threshold, breaker_cooldown ) ) for host in self.hosts ] )
+
+
+    def _connects( self, box ):
+        """PRIVATE - Whether the next command on box opens a new ssh connection."""
+        if box.master_lease:
+            return False
+        return not ( box.channel and box.channel.po and box.channel.po.poll() == None )
+
+
+    def _attempt( self, host, func ):
+        """PRIVATE - Run func( box ) once, in one of host's slots.
+
+        Returns: (HostResult, seconds waited, 'transport' if building the box raised, 'error' if func raised, or None)
+        """
+        slot = self.slots[ host ]
+        start_time = now()
+        slot.acquire()
+        waited = now() - start_time
+        failure = 'transport'
+        try:
+            # a host's first operation takes one token, for building its box
+            if not host in self.boxes:
+                waited += self.bucket.take()
+                box = self.box( host )
+            else:
+                box = self.box( host )
+                if self._connects( box ):
+                    waited += self.bucket.take()
+            failure = 'error'
+            result = func( box )
+            failure = None
+        except:
+            # a box that failed to build isn't kept, it's built again next time
+            result = HostResult( host, error=str( sys.exc_info()[1] ) )
+        slot.release()
+        return result, waited, failure
+
+
+    def call( self, host, func ):
+        """Run func( box ) for host's SSHRPC within our limits, retrying transport failures.
+
+        Returns: (ScheduledResult) With what func returned (a HostResult), or what went wrong.
+        Required: host, func
+            func: (function) Takes an SSHRPC and returns a HostResult, see imap_execute().
+                A HostResult with an error and no return_code (a timeout) is returned as it is,
+                it isn't retried and doesn't count against the host's CircuitBreaker, nor is an
+                exception func raises (it's returned as the error).
+        """
+        breaker = self.breakers[ host ]
+        start_time, waited = now(), 0.0
+        for attempt in range( self.retries + 1 ):
+            if not breaker.allow():
+                return ScheduledResult( host, attempts=attempt, waited=waited, duration=now() - start_time,
+                                        error='circuit open, %d transport failures in a row' % breaker.failures )
+            result, attempt_waited, failure = self._attempt( host, func )
+            waited += attempt_waited
+            if failure == 'error' or ( not failure and result.return_code == None ):
+                breaker.skip()
+                break
+            transport_failed = failure == 'transport' or result.return_code == self.TRANSPORT_FAILURE
+            breaker.record( not transport_failed )
+            if not transport_failed or attempt == self.retries:
+                break
+            delay = random.uniform( 0, min( self.max_backoff, self.backoff * 2 ** attempt ) )
+            self.logger.debug( "%s failed in transport (attempt %d), retrying in %.3fs", host, attempt + 1, delay )
+            sleep( delay )
+            waited += delay
+        return ScheduledResult( host, return_code=result.return_code, stdout=result.stdout, stderr=result.stderr,
+                                error=result.error, attempts=attempt + 1, waited=waited, duration=now() - start_time )
+
+
+    def imap( self, tasks ):
+        """Run every (host, func) of tasks through call(), concurrency at a time, hosts can repeat.
+
+        Returns: (generator) ScheduledResults in the order they finish.
+        """
+        return self._threaded( lambda task: self.call( task[0], task[1] ), list( tasks ) )
+
+
+    def imap_execute( self, cmd, hosts=None, dir='', env={}, timeout=0 ):
+        def execute( box ):
+            _std = {}
+            return_code = box._execute( cmd, dir=dir, env=env, pipes=_std, timeout=timeout )
+            if isinstance( return_code, CommandTimeout ):
+                return HostResult( box.host, None, _std.get( 'stdout', '' ), _std.get( 'stderr', '' ), error=repr( return_code ) )
+            return HostResult( box.host, return_code, _std.get( 'stdout', '' ), _std.get( 'stderr', '' ) )
+        return self.imap( [ ( host, execute ) for host in hosts or self.hosts ] )
+
+
+    def imap_rsync( self, local, remote='', reverse=False, hosts=None ):
+        def rsync( box ):
+            # rsync() only says yes or no, check the connection ourselves when it says no
+            if box.rsync( local, remote=remote, reverse=reverse ):
+                return HostResult( box.host, 0 )
+            if self._connects( box ):
+                self.bucket.take()
+            return HostResult( box.host, box.check() and 1 or self.TRANSPORT_FAILURE )
+        return self.imap( [ ( host, rsync ) for host in hosts or self.hosts ] )
+
+
+    def execute( self, cmd, hosts=None, dir='', env={}, timeout=0 ):
+        return dict( [ ( result.host, result ) for result in self.imap_execute( cmd, hosts=hosts, dir=dir, env=env, timeout=timeout ) ] )
+
+
+    def rsync( self, local, remote='', reverse=False, hosts=None ):
+        return dict( [ ( result.host, result ) for result in self.imap_rsync( local, remote=remote, reverse=reverse, hosts=hosts ) ] )
+
+
+    def open_circuits( self ):
+        """Returns: (list) Hosts that operations aren't being sent to right now."""
+        return [ host for host in self.hosts if self.breakers[ host ].state() == 'open' ]
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()